@@ -0,0 +1,36 @@
+# 离线批量推理, 不经过HTTP服务
+# python -m app.batch_offline --input requests.jsonl --output results.jsonl
+import argparse
+import json
+
+from app import config
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool.logger import init_logger, logger
+from llmbase.main.llm import LLM
+from llmbase.main.services.offline_batch_service import OfflineBatchRunner
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a JSONL file of chat requests through the model')
+    parser.add_argument('--input', required=True, help='输入JSONL, 每行一个chat请求或OpenAI batch请求')
+    parser.add_argument('--output', required=True, help='输出JSONL, 中断后用相同参数重新运行即可续跑')
+    parser.add_argument('--checkpoint', default=None, help='检查点文件, 默认为output + .ckpt')
+    parser.add_argument('--token-budget', type=int, default=65536, help='每批prompt tokens与max_tokens之和的上限')
+    parser.add_argument('--max-batch-rows', type=int, default=256, help='每批最多的行数')
+    parser.add_argument('--max-tokens', type=int, default=1024, help='请求未指定max_tokens时使用')
+    args = parser.parse_args()
+
+    cosmos.config = config.Config
+    init_logger(debug=True, package='llmbase.main', level=config.Config.LOGGER_LEVEL)
+    cosmos.llm = LLM.from_config(llm_config=config.Config.LLM_CONFIG,
+                                 token_cache_config=getattr(config.Config, 'TOKEN_CACHE_CONFIG', None))
+
+    _batch_config = getattr(config.Config, 'BATCH_CONFIG', None) or {}
+    runner = OfflineBatchRunner(cosmos.llm, input_path=args.input, output_path=args.output,
+                                checkpoint_path=args.checkpoint, token_budget=args.token_budget,
+                                max_batch_rows=args.max_batch_rows, default_max_tokens=args.max_tokens,
+                                max_padding_ratio=_batch_config.get('max_padding_ratio'),
+                                max_bucket_size=_batch_config.get('max_bucket_size'))
+    stats = runner.run()
+    logger.info(f"offline batch done: {stats['rows']} rows in {stats['elapsed']:.1f}s, "
+                f"{stats['rows_per_second']:.2f} rows/s, {stats['tokens_per_second']:.1f} tokens/s")
+    logger.info(f"offline batch stats: {json.dumps(stats, ensure_ascii=False)}")
@@ -2,11 +2,13 @@
 import uvicorn
 from llmbase.main import get_asgi_app
 from app import config
-from llmbase.main.common.god import cosmos
 
-app = get_asgi_app(config=config.Config)
+# 多个工作进程时由各工作进程导入本模块创建app, 主进程不加载模型
+app = get_asgi_app(config=config.Config) if __name__ != '__main__' or config.Config.WORKERS == 1 else None
 
 if __name__ == '__main__':
-    _host = cosmos.config.SERVICE.get("host") or '0.0.0.0'
-    _port = cosmos.config.SERVICE.get("port") or 5012
-    uvicorn.run(app=app, host=_host, port=_port, workers=config.Config.WORKERS, reload=False)
+    _host = config.Config.SERVICE.get("host") or '0.0.0.0'
+    _port = config.Config.SERVICE.get("port") or 5012
+    # 多个工作进程时uvicorn需要以字符串形式导入app
+    uvicorn.run(app=app if config.Config.WORKERS == 1 else 'app.batch_run:app', host=_host, port=_port,
+                workers=config.Config.WORKERS, reload=False)
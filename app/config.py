@@ -24,17 +24,167 @@ class Config(StarletteConfig):
 
     # 工作进程
     WORKERS = 1
+    # 同步路由(例如/v1/chat/completions)所用线程池的大小, anyio默认为40
+    THREAD_POOL_SIZE = 40
 
     SERVICE = {
         'host': "0.0.0.0",
         'port': 5012
     }
 
+    # 启动: background为True时模型在后台线程中并行加载(tokenizer, embedding, LLM), 服务先开始监听, 加载完成前/v1/ready返回503
+    STARTUP_CONFIG = {
+        'background': True
+    }
+
+    # 前后端分离: 多个HTTP前端进程(app/frontend_run.py)经Unix socket把请求转发给唯一加载模型的引擎进程(app/engine_run.py)
+    IPC_CONFIG = {
+        'socket_path': '/tmp/guoxin/engine.sock',
+        'frontend_workers': 4,
+        'connect_timeout': 5.0
+    }
+
     # LLM配置
     LLM_CONFIG = {
         'class': 'ChatGLM4',
         'pretrained_model_path': '/var/llm/glm-4-9b-chat',
-        'cuda_devices': '0'
+        'cuda_devices': '0',
+        # embedding模型所在设备, 例如'cuda:1', 'cpu', None表示与模型相同
+        'embedding_device': None,
+        # 数据并行: 每个设备加载一个模型副本, 例如['cuda:0', 'cuda:1'], 测试时可用['cpu', 'cpu']; None表示单实例
+        'replica_devices': None,
+        # 选择副本的依据: 'tokens'在途token估计量最少, 'requests'在途请求数最少
+        'replica_balance': 'tokens',
+        # CPU推理且WORKERS > 1时, 权重只物化一次到该目录(建议/dev/shm下), 各工作进程以内存映射方式共享; None表示各自加载
+        'shared_weights_path': None
+    }
+
+    # 多模型: 按请求的model字段路由, 首次使用时加载; LLM_CONFIG为默认模型(常驻), 未知的model名返回404 model_not_found
+    MODEL_REGISTRY_CONFIG = {
+        'enable': False,
+        # 未知的model名由默认模型处理, 而不是返回404
+        'fallback_to_default': False,
+        # 常驻模型权重的显存上限(字节), 超出时按最近最少使用淘汰空闲模型, None表示不限制
+        'max_memory': 40 * 1024 ** 3,
+        # 'offload'移到CPU内存, 'unload'完全释放
+        'eviction': 'offload',
+        # 模型名 -> 与LLM_CONFIG格式相同的配置, pretrained_model_path可以是微调(PEFT)后的adapter目录;
+        # 首次加载前按memory_bytes(可选)或权重文件大小估算显存占用
+        'models': {
+            # 'chatglm3-6b': {
+            #     'class': 'ChatGLM3',
+            #     'pretrained_model_path': '/var/llm/chatglm3-6b',
+            #     'embedding_model_path': '/var/llm/bge-large-zh-v1.5',
+            #     'cuda_devices': '0'
+            # },
+        }
+    }
+
+    # 推理引擎配置
+    ENGINE_CONFIG = {
+        # 开启后所有chat请求共享一个解码循环(连续批处理)
+        'enable': True,
+        'max_batch_size': 32,
+        'max_prefill_per_step': 4,
+        # 'auto', 'seq_first'(ChatGLM3), 'batch_first'
+        'kv_layout': 'auto',
+        # 跨请求复用相同前缀(系统提示词/工具说明)的KV cache
+        'prefix_cache': {
+            'enable': True,
+            'block_size': 16,
+            'max_bytes': 2 * 1024 ** 3
+        }
+    }
+
+    # /v1/embeddings: 所有输入按长度排序后分批编码, batch_size为每次前向计算的文本数
+    EMBEDDING_CONFIG = {
+        'batch_size': 64,
+        # 独立线程池, 不与生成请求争用默认线程池; 排队超过max_queue时返回503
+        'executor': {
+            'max_workers': 2,
+            'max_queue': 256
+        },
+        # 按模型+文本哈希缓存向量: 进程内LRU + 同机多进程共享的内存映射文件
+        # disk_path为空时只使用进程内LRU; 设置后(例如'/var/cache/llmbase/embeddings')预先创建disk_entries x 维度的float32文件
+        'cache': {
+            'enable': True,
+            'max_entries': 100000,
+            'disk_path': None,
+            'disk_entries': 1000000
+        }
+    }
+
+    # 生成时间预算(秒): 请求未指定timeout时使用default_timeout, 请求的timeout不超过max_timeout, None表示不限制
+    DEADLINE_CONFIG = {
+        'default_timeout': 120.0,
+        'max_timeout': 600.0
+    }
+
+    # 准入控制: 按端点限制已接纳未完成请求的token估计总量(prompt tokens + max_tokens)和请求数, 超出时返回429
+    ADMISSION_CONFIG = {
+        'enable': True,
+        # 估算prompt tokens时每个token对应的字符数
+        'chars_per_token': 1.0,
+        'endpoints': {
+            'chat': {
+                'max_tokens': 262144,
+                'max_requests': 256
+            },
+            'embeddings': {
+                'max_tokens': 1048576,
+                'max_requests': 1024
+            }
+        }
+    }
+
+    # 对话模板按token id拼接, 文本片段的分词结果按LRU缓存; 仅适用于ChatGLM3, 其他模型(包括ChatGLM4)仍由tokenizer分词
+    TOKEN_CACHE_CONFIG = {
+        'enable': True,
+        'max_entries': 8192
+    }
+
+    # 非流式单轮请求合并: 最多等待window_ms毫秒或凑满max_batch_size个请求后一次性生成
+    MICRO_BATCH_CONFIG = {
+        'enable': False,
+        'window_ms': 10,
+        'max_batch_size': 32
+    }
+
+    # 批量推理: 按prompt长度分桶, 每个桶的padding占比不超过max_padding_ratio
+    BATCH_CONFIG = {
+        'max_padding_ratio': 0.2,
+        'max_bucket_size': 64
+    }
+
+    # OpenAI兼容的批任务接口(/v1/files, /v1/batches), 服务空闲idle_seconds秒后才处理批任务;
+    # 开启后上传的文件和结果写入storage_path
+    BATCH_API_CONFIG = {
+        'enable': False,
+        'storage_path': '/tmp/guoxin/batches',
+        'idle_seconds': 1.0,
+        'token_budget': 131072,
+        'max_batch_rows': 512
+    }
+
+    # 显存回收: 'watermark'仅在已分配显存超过high_watermark时回收, 'always'每个请求后都回收, 'never'不回收
+    MEMORY_CONFIG = {
+        'policy': 'watermark',
+        'high_watermark': 0.9,
+        'min_interval': 5.0,
+        # 模型加载后冻结gc, 之后的回收不再扫描模型相关的长期对象
+        'freeze_after_load': True
+    }
+
+    # Prometheus指标: /metrics暴露TTFT, TPOT, 端到端延迟, 排队时间, 批大小的直方图, token计数和负载
+    METRICS_CONFIG = {
+        'enable': True
+    }
+
+    # 请求分阶段计时: 按sample_rate抽样, 在Server-Timing响应头和日志中给出tokenize, queue, prefill, decode,
+    # detokenize, serialize各阶段耗时; 流式请求的响应头只含开始发送前的阶段, 完整结果见日志
+    TIMING_CONFIG = {
+        'enable': True,
+        'sample_rate': 0.01
     }
 
     # 配置中心
@@ -53,5 +203,13 @@ class Config(StarletteConfig):
             'healthy': True,
             'ephemeral': False,
             'group_name': 'DEFAULT_GROUP'
+        },
+        # 定期把实时负载(排队数, 在途token, 显存, tokens/s)写入实例的metadata, 并按负载调低weight; 负载达到disable_pressure时下线
+        'reporter': {
+            'enable': True,
+            'interval': 5.0,
+            'min_weight': 0.1,
+            'disable_pressure': 0.95,
+            'enable_pressure': 0.8
         }
     }
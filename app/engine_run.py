@@ -0,0 +1,6 @@
+# 前后端分离模式的引擎进程: 唯一加载模型的进程, 通过Unix socket为前端进程(app/frontend_run.py)提供服务
+from llmbase.main import get_engine_server
+from app import config
+
+if __name__ == '__main__':
+    get_engine_server(config=config.Config).run()
@@ -0,0 +1,14 @@
+# 前后端分离模式的HTTP前端: 不加载模型, 多个工作进程共享引擎进程(app/engine_run.py)中的一份权重
+import uvicorn
+from llmbase.main import get_frontend_app
+from app import config
+from llmbase.main.common.god import cosmos
+
+app = get_frontend_app(config=config.Config)
+
+if __name__ == '__main__':
+    _host = cosmos.config.SERVICE.get("host") or '0.0.0.0'
+    _port = cosmos.config.SERVICE.get("port") or 5012
+    # 多个工作进程时uvicorn需要以字符串形式导入app
+    uvicorn.run(app='app.frontend_run:app', host=_host, port=_port,
+                workers=config.Config.IPC_CONFIG.get('frontend_workers', 1), reload=False)
@@ -1,31 +1,66 @@
 from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import AsyncIterator
 
+import anyio.to_thread
 import nacos
+import orjson
 from fastapi import FastAPI, Request
 from starlette.middleware.cors import CORSMiddleware
 
 from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import timing
 from llmbase.main.common.tool.logger import init_logger, logger
-from llmbase.main.routers import openai
+from llmbase.main.engine.activity import ActivityMonitor
+from llmbase.main.engine.admission import Admission
+from llmbase.main.engine.memory import MemoryManager
+from llmbase.main.routers import openai, batches
+
+# 交互请求, 后台批任务只在这些请求都结束后运行
+INTERACTIVE_PATHS = ('/v1/chat/completions', '/v1/embeddings')
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # app启动
+    startup_runtime()
     yield
     # app关闭
+    shutdown_runtime()
+
+
+def startup_runtime() -> None:
+    """
+    Called from the running event loop before serving requests.
+    """
+    _thread_pool_size = getattr(cosmos.config, 'THREAD_POOL_SIZE', None)
+    if _thread_pool_size:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = _thread_pool_size
+
+
+def shutdown_runtime() -> None:
+    if getattr(cosmos, 'startup', None) is not None:
+        # 停止尚未完成的加载
+        cosmos.startup.cancel()
+    if getattr(cosmos, 'nacos_reporter', None) is not None:
+        cosmos.nacos_reporter.stop()
+    if getattr(cosmos, 'model_registry', None) is not None:
+        cosmos.model_registry.shutdown()
+    _llm = getattr(cosmos, 'llm', None)
+    if _llm is not None:
+        # 数据并行时每个副本有自己的引擎和合并队列
+        for _member in (_llm.replicas.llms if _llm.replicas is not None else [_llm]):
+            detach_runtime(_member)
+    if getattr(cosmos, 'batch_worker', None) is not None:
+        cosmos.batch_worker.stop()
+    if getattr(cosmos, 'embedding_executor', None) is not None:
+        cosmos.embedding_executor.shutdown()
 
 
 def get_asgi_app(config) -> FastAPI:
     app = FastAPI(debug=config.DEBUG, lifespan=lifespan)
 
-    # 保存全局配置到全局变量
-    cosmos.config = config
-    # 日志
-    init_logger(debug=config.DEBUG, package=__package__, level=config.LOGGER_LEVEL, logger_path=config.LOGGER_PATH)
-
-    logger.debug('这是debug消息')
+    init_runtime(config)
 
     """
     支持跨域访问
@@ -40,30 +75,118 @@ def get_asgi_app(config) -> FastAPI:
 
     for __router in __routers:
         app.include_router(__router)
+    # Prometheus指标
+    _metrics_config = getattr(config, 'METRICS_CONFIG', None) or {}
+    if _metrics_config.get('enable', False):
+        from llmbase.main.routers.metrics import router as metrics_router
+        app.include_router(metrics_router)
+    # 批任务(/v1/files, /v1/batches)
+    _batch_api_config = getattr(config, 'BATCH_API_CONFIG', None) or {}
+    if _batch_api_config.get('enable', False):
+        app.include_router(batches.router)
+
+    init_middleware(app)
+    return app
 
-    # 预训练大模型
-    try:
-        from llmbase.main.llm import LLM
-        _llm_class = LLM.get_pretrained_class(llm_config=config.LLM_CONFIG)
-        cosmos.llm = _llm_class(pretrained_model_name_or_path=config.LLM_CONFIG.get('pretrained_model_path'),
-                                embedding_model_path=config.LLM_CONFIG.get('embedding_model_path'),
-                                cuda_devices=config.LLM_CONFIG.get('cuda_devices'))
-        cosmos.nacos_client = nacos.NacosClient(server_addresses='%s:%s' % (config.NACOS_CONFIG.get('host'),
-                                                                            config.NACOS_CONFIG.get('port')),
-                                                namespace=config.NACOS_CONFIG.get('namespace'))
-        # [服务提供方]注册服务
-        _service_config = config.NACOS_CONFIG.get('service')
-        cosmos.nacos_client.add_naming_instance(service_name=_service_config.get('name'),
-                                                ip=_service_config.get('ip'),
-                                                port=_service_config.get('port'),
-                                                weight=_service_config.get('weight'),
-                                                metadata=_service_config.get('metadata'),
-                                                enable=_service_config.get('enable'),
-                                                ephemeral=_service_config.get('ephemeral'),
-                                                group_name=_service_config.get('group_name'),
-                                                healthy=_service_config.get('healthy'))
-    except Exception as e:
-        logger.error(e)
+
+def init_runtime(config) -> None:
+    """
+    Everything of a model-serving process besides the HTTP app: logging, admission, batch storage, executors and
+    the (background) model loading. Shared by get_asgi_app and the engine process of the split mode.
+    """
+    # 保存全局配置到全局变量
+    cosmos.config = config
+    # 日志
+    init_logger(debug=config.DEBUG, package=__package__, level=config.LOGGER_LEVEL, logger_path=config.LOGGER_PATH)
+
+    logger.debug('这是debug消息')
+
+    # Prometheus指标
+    _metrics_config = getattr(config, 'METRICS_CONFIG', None) or {}
+    if _metrics_config.get('enable', False):
+        from llmbase.main.common.tool import metrics
+        from llmbase.main.services.chatglm4_service import ChatGLM4Service
+        metrics.bind_load(ChatGLM4Service.load)
+
+    cosmos.activity_monitor = ActivityMonitor()
+    # 准入控制
+    _admission_config = dict(getattr(config, 'ADMISSION_CONFIG', None) or {})
+    cosmos.admission = None
+    if _admission_config.pop('enable', False):
+        cosmos.admission = Admission(**_admission_config)
+    # 批任务(/v1/files, /v1/batches)存储
+    _batch_api_config = getattr(config, 'BATCH_API_CONFIG', None) or {}
+    cosmos.batch_worker = None
+    if _batch_api_config.get('enable', False):
+        from llmbase.main.services.batch_api_service import BatchStore
+        cosmos.batch_store = BatchStore(storage_path=_batch_api_config.get('storage_path'))
+
+    from llmbase.main.engine.executor import IsolatedExecutor
+    _embedding_config = getattr(config, 'EMBEDDING_CONFIG', None) or {}
+    cosmos.embedding_executor = IsolatedExecutor(name='embedding', **_embedding_config.get('executor', {}))
+    cosmos.llm = None
+    cosmos.model_registry = None
+    # 预训练大模型: 在后台线程中加载, 服务先开始监听, 加载完成前/v1/ready返回503
+    from llmbase.main.engine.startup import StartupProgress
+    cosmos.startup = StartupProgress()
+    _startup_config = getattr(config, 'STARTUP_CONFIG', None) or {}
+    if _startup_config.get('background', True):
+        cosmos.startup.start(lambda startup: load_runtime(config, startup))
+    else:
+        try:
+            cosmos.startup.run(lambda startup: load_runtime(config, startup))
+        except Exception as e:
+            logger.error(e)
+
+
+def get_frontend_app(config) -> FastAPI:
+    """
+    HTTP frontend of the split mode: no model is loaded, chat/embedding requests are forwarded to the engine process
+    (see get_engine_server), so several uvicorn workers share one copy of the weights.
+    """
+    app = FastAPI(debug=config.DEBUG)
+    cosmos.config = config
+    init_logger(debug=config.DEBUG, package=__package__, level=config.LOGGER_LEVEL, logger_path=config.LOGGER_PATH)
+    init_cors(app=app)
+
+    from llmbase.main.ipc.client import EngineClient
+    from llmbase.main.routers import frontend
+    _ipc_config = getattr(config, 'IPC_CONFIG', None) or {}
+    cosmos.engine_client = EngineClient(socket_path=_ipc_config.get('socket_path'),
+                                        connect_timeout=_ipc_config.get('connect_timeout', 5.0))
+    app.include_router(frontend.router)
+    # 指标由引擎进程记录, /metrics转发给引擎
+    _metrics_config = getattr(config, 'METRICS_CONFIG', None) or {}
+    if _metrics_config.get('enable', False):
+        app.include_router(frontend.metrics_router)
+    # 批任务只读写存储目录, 由引擎进程的BatchWorker处理
+    _batch_api_config = getattr(config, 'BATCH_API_CONFIG', None) or {}
+    if _batch_api_config.get('enable', False):
+        from llmbase.main.services.batch_api_service import BatchStore
+        cosmos.batch_store = BatchStore(storage_path=_batch_api_config.get('storage_path'))
+        app.include_router(batches.router)
+
+    # 交互活动由引擎进程统计
+    cosmos.activity_monitor = None
+    init_middleware(app)
+    return app
+
+
+def get_engine_server(config):
+    """
+    Engine process of the split mode: loads the models exactly like get_asgi_app (see init_runtime) and serves
+    the frontends over a Unix socket instead of HTTP.
+    """
+    from llmbase.main.ipc.server import EngineServer
+    init_runtime(config)
+    _ipc_config = getattr(config, 'IPC_CONFIG', None) or {}
+    return EngineServer(socket_path=_ipc_config.get('socket_path'), startup=startup_runtime,
+                        shutdown=shutdown_runtime)
+
+
+def init_middleware(app: FastAPI) -> None:
+    _timing_config = getattr(cosmos.config, 'TIMING_CONFIG', None) or {}
+    _sample_rate = _timing_config.get('sample_rate', 0.0) if _timing_config.get('enable', False) else 0.0
 
     @app.middleware('http')
     async def _middleware(request: Request, call_next):
@@ -80,8 +203,20 @@ def get_asgi_app(config) -> FastAPI:
         request的修改无法传递到之后的流程, 只能修改request内部的对象
         """
         start_time = datetime.now()
+        _interactive = request.url.path in INTERACTIVE_PATHS and cosmos.activity_monitor is not None
+        if _interactive:
+            cosmos.activity_monitor.begin()
+        # 抽样请求分阶段计时, 计时器经contextvar传到处理请求的线程
+        _timer = timing.start(_sample_rate, request.url.path) if request.url.path in INTERACTIVE_PATHS else None
         # request.app.db = cosmos.db_session()
-        _response = await call_next(request)
+        try:
+            _response = await call_next(request)
+        finally:
+            if _interactive:
+                cosmos.activity_monitor.end()
+        if _timer is not None:
+            _response.headers['Server-Timing'] = _timer.server_timing()
+            _response.body_iterator = _log_timing(_response.body_iterator, _timer)
         # print('after request')
         # print(f'线程id: {threading.current_thread().ident}, request:{request}')
         # cosmos.db_session.remove()
@@ -91,7 +226,165 @@ def get_asgi_app(config) -> FastAPI:
             f"{_response.status_code} {request.client.host} {request.method} {request.url} {end_time - start_time}")
         return _response
 
-    return app
+
+async def _log_timing(body_iterator, timer) -> AsyncIterator[bytes]:
+    """
+    Log the phase timing once the body has been sent, streaming responses only finish their phases here.
+    """
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        _record = timer.record()
+        logger.info(f'timing {orjson.dumps(_record).decode()}', extra={'timing': _record})
+
+
+def load_runtime(config, startup) -> None:
+    """
+    Load the default model and start everything that depends on it, phase by phase (see StartupProgress).
+    """
+    _batch_api_config = getattr(config, 'BATCH_API_CONFIG', None) or {}
+    _registry_config = dict(getattr(config, 'MODEL_REGISTRY_CONFIG', None) or {})
+    _registry_enable = _registry_config.pop('enable', False)
+    # 各模型类自己的组件(tokenizer, embedding, model)在开始加载时登记
+    startup.declare('model', 'runtime')
+    if _registry_enable:
+        startup.declare('registry')
+    if _batch_api_config.get('enable', False):
+        startup.declare('batch_worker')
+    startup.declare('nacos', required=False)
+
+    _llm = load_llm(config, config.LLM_CONFIG, startup=startup)
+    cosmos.llm = _llm
+    if startup.cancelled:
+        # 加载期间服务已关闭, 停止刚创建的引擎
+        for _member in (_llm.replicas.llms if _llm.replicas is not None else [_llm]):
+            detach_runtime(_member)
+        startup.check()
+    # 多模型, 按请求的model字段路由
+    if _registry_enable:
+        with startup.phase('registry'):
+            from llmbase.main.llm.registry import ModelRegistry
+            _models = _registry_config.pop('models', None) or {}
+            _registry = ModelRegistry(load=lambda llm_config: load_llm(config, llm_config),
+                                      attach=lambda llm: attach_runtime(config, llm, llm.llm_config),
+                                      detach=detach_runtime, **_registry_config)
+            _registry.register(config.LLM_CONFIG.get('name') or _llm.name, config.LLM_CONFIG,
+                               llm=_llm, pinned=True, default=True)
+            for _name, _llm_config in _models.items():
+                _registry.register(_name, _llm_config)
+            cosmos.model_registry = _registry
+    # 显存回收策略
+    _memory_config = getattr(config, 'MEMORY_CONFIG', None) or {}
+    cosmos.memory_manager = MemoryManager(**_memory_config)
+    cosmos.memory_manager.freeze()
+    # 后台批任务, 服务空闲时才运行
+    if _batch_api_config.get('enable', False):
+        with startup.phase('batch_worker'):
+            from llmbase.main.services.batch_api_service import BatchWorker
+            _idle_seconds = _batch_api_config.get('idle_seconds', 1.0)
+            _batch_config = getattr(config, 'BATCH_CONFIG', None) or {}
+            cosmos.batch_worker = BatchWorker(
+                store=cosmos.batch_store, llm=cosmos.llm,
+                is_idle=lambda: cosmos.activity_monitor.is_idle(_idle_seconds) and (
+                        cosmos.llm.engine is None or cosmos.llm.engine.is_idle()),
+                token_budget=_batch_api_config.get('token_budget', 131072),
+                max_batch_rows=_batch_api_config.get('max_batch_rows', 512),
+                max_padding_ratio=_batch_config.get('max_padding_ratio'),
+                max_bucket_size=_batch_config.get('max_bucket_size'))
+            cosmos.batch_worker.start()
+    # 模型就绪后才注册服务, 注册中心不可用不影响就绪
+    try:
+        with startup.phase('nacos', required=False):
+            cosmos.nacos_client = nacos.NacosClient(server_addresses='%s:%s' % (config.NACOS_CONFIG.get('host'),
+                                                                                config.NACOS_CONFIG.get('port')),
+                                                    namespace=config.NACOS_CONFIG.get('namespace'))
+            # [服务提供方]注册服务
+            _service_config = config.NACOS_CONFIG.get('service')
+            cosmos.nacos_client.add_naming_instance(service_name=_service_config.get('name'),
+                                                    ip=_service_config.get('ip'),
+                                                    port=_service_config.get('port'),
+                                                    weight=_service_config.get('weight'),
+                                                    metadata=_service_config.get('metadata'),
+                                                    enable=_service_config.get('enable'),
+                                                    ephemeral=_service_config.get('ephemeral'),
+                                                    group_name=_service_config.get('group_name'),
+                                                    healthy=_service_config.get('healthy'))
+            # 按实时负载更新权重
+            _reporter_config = dict(config.NACOS_CONFIG.get('reporter') or {})
+            if _reporter_config.pop('enable', False):
+                from llmbase.main.services.chatglm4_service import ChatGLM4Service
+                from llmbase.main.utils.nacos_reporter import NacosReporter
+                cosmos.nacos_reporter = NacosReporter(cosmos.nacos_client, _service_config,
+                                                      sample=ChatGLM4Service.load, **_reporter_config)
+                cosmos.nacos_reporter.start()
+    except Exception as e:
+        logger.error(e)
+
+
+def load_llm(config, llm_config: dict, startup=None):
+    """
+    Load one LLM and create its runtime (engine, embedding encoder, micro batcher).
+    With several replica_devices one copy is loaded per device, the first one carries the ReplicaPool.
+    :param startup: StartupProgress, 启动时加载默认模型才传入, 每个副本的组件按设备分别记录
+    """
+    from llmbase.main.engine.startup import StartupProgress
+    from llmbase.main.llm import LLM
+    _devices = llm_config.get('replica_devices') or [None]
+    _replicas = []
+    for _index, _device in enumerate(_devices):
+        _startup = startup or StartupProgress()
+        if _index > 0:
+            _startup = _startup.scoped(f'replica{_index}')
+        llm = LLM.from_config(llm_config=llm_config, token_cache_config=getattr(config, 'TOKEN_CACHE_CONFIG', None),
+                              device=_device, startup=_startup)
+        llm.llm_config = llm_config
+        with _startup.phase('runtime'):
+            attach_runtime(config, llm, llm_config)
+        _replicas.append(llm)
+    if len(_replicas) > 1:
+        from llmbase.main.llm.replicas import ReplicaPool
+        _replicas[0].replicas = ReplicaPool(_replicas, _devices, balance=llm_config.get('replica_balance', 'tokens'))
+    return _replicas[0]
+
+
+def attach_runtime(config, llm, llm_config: dict) -> None:
+    # 连续批处理引擎
+    _engine_config = dict(getattr(config, 'ENGINE_CONFIG', None) or {})
+    if _engine_config.pop('enable', False):
+        from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+        llm.engine = ContinuousBatchingEngine(model=llm.model, tokenizer=llm.tokenizer, **_engine_config)
+        llm.engine.start()
+    # embedding批量编码, 未加载embedding模型的模型类(InternLMChat20B, ChatGLM2)没有
+    if llm.embedding_encoder is None and getattr(llm, 'embedding', None) is not None:
+        from llmbase.main.engine.embedding import EmbeddingEncoder
+        _embedding_config = dict(getattr(config, 'EMBEDDING_CONFIG', None) or {})
+        _embedding_config.pop('executor', None)
+        # 未配置embedding_model_path时以模型名作为缓存key中的模型标识
+        llm.embedding_encoder = EmbeddingEncoder(llm.embedding,
+                                                 model_id=llm_config.get('embedding_model_path') or llm.model_name,
+                                                 **_embedding_config)
+    # 非流式请求合并
+    _micro_batch_config = dict(getattr(config, 'MICRO_BATCH_CONFIG', None) or {})
+    if _micro_batch_config.pop('enable', False):
+        from functools import partial
+        from llmbase.main.engine.micro_batch import MicroBatcher
+        from llmbase.main.services.chatglm4_service import ChatGLM4Service
+        llm.micro_batcher = MicroBatcher(run_batch=partial(ChatGLM4Service.run_micro_batch, llm=llm),
+                                         **_micro_batch_config)
+        llm.micro_batcher.start()
+
+
+def detach_runtime(llm) -> None:
+    """
+    Stop the engine and the micro batcher of an LLM before it is evicted, the embedding encoder is kept.
+    """
+    if llm.engine is not None:
+        llm.engine.stop()
+        llm.engine = None
+    if llm.micro_batcher is not None:
+        llm.micro_batcher.stop()
+        llm.micro_batcher = None
 
 
 def init_cors(app: FastAPI) -> None:
@@ -0,0 +1,13 @@
+from typing import Dict, Literal, Optional
+
+from pydantic import BaseModel
+
+
+class BatchCreateRequest(BaseModel):
+    """
+    OpenAI POST /v1/batches
+    """
+    input_file_id: str
+    endpoint: Literal["/v1/chat/completions"]
+    completion_window: Literal["24h"] = "24h"
+    metadata: Optional[Dict[str, str]] = None
@@ -0,0 +1,51 @@
+import time
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+class FileObject(BaseModel):
+    id: str
+    object: Literal["file"] = "file"
+    bytes: int
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    filename: str
+    purpose: str
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    id: str
+    object: Literal["batch"] = "batch"
+    endpoint: str
+    errors: Optional[dict] = None
+    input_file_id: str
+    completion_window: str
+    status: Literal["validating", "failed", "in_progress", "finalizing", "completed", "expired", "cancelling",
+                    "cancelled"]
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchList(BaseModel):
+    object: Literal["list"] = "list"
+    data: List[BatchObject] = []
+    first_id: Optional[str] = None
+    last_id: Optional[str] = None
+    has_more: bool = False
@@ -0,0 +1,262 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Prometheus文本格式(0.0.4)的指标, 不依赖prometheus_client; 记录一次只需一次字典查找和一次加锁的累加
+
+
+class _Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        The child for one combination of label values, created on first use.
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[Tuple[str, tuple, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class _CounterChild(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [('_total', tuple(zip(self.labelnames, key)), child.value) for key, child in list(self._children.items())]
+
+
+class _HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # 最后一个为+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        for key, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, key))
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', labels + (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Gauge(_Metric):
+    """
+    Read at scrape time from a callback, nothing is recorded on the request path.
+    The callback returns {label values tuple: value}, () for a gauge without labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Callable[[], Dict[tuple, float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _samples(self):
+        values = self.collect() if self.collect is not None else {}
+        return [('', tuple(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = None) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, **({'buckets': buckets} if buckets else {})))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              collect: Callable[[], Dict[tuple, float]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect=collect))
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(float(value))
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# ---------------------------------------------------------------- inference metrics
+
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    'llm_time_to_first_token_seconds', 'Time from request arrival to the first generated token.', ('model',),
+    buckets=(.025, .05, .1, .25, .5, .75, 1, 2.5, 5, 10, 30))
+TIME_PER_OUTPUT_TOKEN = REGISTRY.histogram(
+    'llm_time_per_output_token_seconds', 'Average time between output tokens of a request after the first one.',
+    ('model',), buckets=(.005, .01, .02, .03, .05, .075, .1, .15, .25, .5, 1))
+REQUEST_DURATION = REGISTRY.histogram(
+    'llm_request_duration_seconds', 'End-to-end latency until the last byte of the response.',
+    ('endpoint', 'status'), buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+QUEUE_WAIT = REGISTRY.histogram(
+    'llm_queue_wait_seconds', 'Time a sequence waited in the engine queue before its prefill.',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+PREFILL_BATCH_SIZE = REGISTRY.histogram(
+    'llm_prefill_batch_size', 'Sequences prefilled between two decode steps.', buckets=(1, 2, 4, 8, 16, 32))
+DECODE_BATCH_SIZE = REGISTRY.histogram(
+    'llm_decode_batch_size', 'Sequences in one decode step.', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+PROMPT_TOKENS = REGISTRY.counter(
+    'llm_prompt_tokens', 'Prompt tokens processed.', ('model', 'endpoint'))
+COMPLETION_TOKENS = REGISTRY.counter(
+    'llm_completion_tokens', 'Tokens generated.', ('model', 'endpoint'))
+
+
+def record_tokens(model: str, endpoint: str, prompt_tokens: int, completion_tokens: int = 0):
+    PROMPT_TOKENS.labels(model, endpoint).inc(prompt_tokens)
+    if completion_tokens:
+        COMPLETION_TOKENS.labels(model, endpoint).inc(completion_tokens)
+
+
+def record_generation(model: str, started: float, first_token: Optional[float], finished: float,
+                      completion_tokens: int):
+    """
+    TTFT and TPOT of one generated response, times from time.monotonic().
+    """
+    if first_token is None:
+        return
+    TIME_TO_FIRST_TOKEN.labels(model).observe(first_token - started)
+    if completion_tokens > 1:
+        TIME_PER_OUTPUT_TOKEN.labels(model).observe((finished - first_token) / (completion_tokens - 1))
+
+
+def bind_load(sample: Callable[[], dict], max_age: float = 1.0):
+    """
+    Register the gauges read from the live load (see ChatGLM4Service.load), sampled at most once per scrape.
+    :param sample: 返回当前负载
+    :param max_age: 同一次抓取内复用采样结果的时间(秒)
+    """
+    if any(metric.name == 'llm_running_sequences' for metric in REGISTRY._metrics):
+        return
+    cache = {'time': None, 'load': {}}
+    lock = threading.Lock()
+
+    def _load() -> dict:
+        now = time.monotonic()
+        with lock:
+            if cache['time'] is None or now - cache['time'] > max_age:
+                try:
+                    cache['load'] = sample()
+                except Exception:
+                    # 模型加载完成前没有负载数据
+                    cache['load'] = {}
+                cache['time'] = now
+            return cache['load']
+
+    def _gauge(key: str):
+        def _collect():
+            load = _load()
+            return {(): load[key]} if key in load else {}
+        return _collect
+
+    REGISTRY.gauge('llm_running_sequences', 'Sequences in the decode batch of the engines.',
+                   collect=_gauge('running'))
+    REGISTRY.gauge('llm_waiting_sequences', 'Sequences queued in the engines before their prefill.',
+                   collect=_gauge('queue_depth'))
+    REGISTRY.gauge('llm_inflight_requests', 'Requests admitted and not finished.', collect=_gauge('inflight_requests'))
+    REGISTRY.gauge('llm_inflight_tokens', 'Token budget held by admitted requests.', collect=_gauge('inflight_tokens'))
+    REGISTRY.gauge('llm_pressure', 'Load of the instance, 1 means full.', collect=_gauge('pressure'))
+    REGISTRY.gauge('llm_gpu_memory_allocated_bytes', 'Memory allocated by tensors per GPU.', ('device',),
+                   collect=_gpu_memory)
+
+
+def _gpu_memory() -> Dict[tuple, float]:
+    import torch
+    if not torch.cuda.is_available():
+        return {}
+    return {(device,): torch.cuda.memory_allocated(device) for device in range(torch.cuda.device_count())}
@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# 按请求分阶段计时(tokenize, queue, prefill, decode, detokenize, encode, serialize), 只对抽样的请求计时
+
+
+class PhaseTimer(object):
+    """
+    Time spent in each phase of one request, a phase entered several times (detokenize, serialize) is summed.
+    The timer of the current request is found through a context variable, which follows run_in_threadpool;
+    the engine thread stamps its times on the Sequence instead (see _stream_new_ids).
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: 请求路径, 写入日志
+        """
+        self.path = path
+        self.started = time.monotonic()
+        self.phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + max(seconds, 0.0)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def server_timing(self) -> str:
+        """
+        Server-Timing header value, durations in milliseconds.
+        """
+        with self._lock:
+            phases = list(self.phases.items())
+        phases.append(('total', time.monotonic() - self.started))
+        return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in phases)
+
+    def record(self) -> dict:
+        with self._lock:
+            phases = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        return {'path': self.path, 'total_ms': round((time.monotonic() - self.started) * 1000, 3), 'phases_ms': phases}
+
+
+_current: ContextVar[Optional[PhaseTimer]] = ContextVar('phase_timer', default=None)
+
+
+def start(sample_rate: float, path: str = None) -> Optional[PhaseTimer]:
+    """
+    Start timing the current request with probability sample_rate, None when it is not sampled.
+    :param sample_rate: 抽样比例, 0不计时, 1每个请求都计时
+    """
+    if sample_rate <= 0 or (sample_rate < 1 and random.random() >= sample_rate):
+        return None
+    timer = PhaseTimer(path)
+    _current.set(timer)
+    return timer
+
+
+def current() -> Optional[PhaseTimer]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a block into the current request's timer, nothing is recorded when the request is not sampled.
+    """
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class ActivityMonitor(object):
+    """
+    Counts interactive requests in flight so background work can yield the GPU to them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_active = 0.0
+
+    def begin(self):
+        with self._lock:
+            self._active += 1
+            self._last_active = time.time()
+
+    def end(self):
+        with self._lock:
+            self._active -= 1
+            self._last_active = time.time()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def is_idle(self, idle_seconds: float = 0.0) -> bool:
+        """
+        :param idle_seconds: 最近一个交互请求结束后至少空闲的秒数
+        """
+        with self._lock:
+            return self._active == 0 and time.time() - self._last_active >= idle_seconds
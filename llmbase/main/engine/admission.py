@@ -0,0 +1,125 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+
+class Ticket(object):
+    """
+    Admission of one request, release() gives its tokens back (idempotent).
+    """
+    __slots__ = ('controller', 'cost', 'released')
+
+    def __init__(self, controller: 'AdmissionController', cost: int):
+        self.controller = controller
+        self.cost = cost
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController(object):
+    """
+    Bounded admission of one endpoint, measured in estimated tokens (prompt tokens + max_tokens).
+
+    A request is admitted while the admitted-but-unfinished work stays within `max_tokens` and `max_requests`,
+    otherwise it is rejected right away with 429. Retry-After is the time the current excess needs to drain at
+    the throughput observed over the last `window` seconds. A single request larger than the whole budget is
+    still admitted when nothing else is in flight.
+    """
+
+    def __init__(self, name: str, max_tokens: int = 262144, max_requests: int = 256, window: float = 30.0,
+                 max_retry_after: int = 60):
+        """
+        :param max_tokens: 已接纳未完成请求的token估计总量上限
+        :param max_requests: 已接纳未完成请求数上限
+        :param window: 计算吞吐量的时间窗口(秒)
+        :param max_retry_after: Retry-After的上限(秒)
+        """
+        self.name = name
+        self.max_tokens = max_tokens
+        self.max_requests = max_requests
+        self.window = window
+        self.max_retry_after = max_retry_after
+
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._requests = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._done = deque()
+
+    def admit(self, cost: int) -> Ticket:
+        with self._lock:
+            if self._requests > 0 and (self._tokens + cost > self.max_tokens or self._requests >= self.max_requests):
+                self._rejected += 1
+                retry_after = self._retry_after(self._tokens + cost - self.max_tokens)
+                raise HTTPException(status_code=429, headers={'Retry-After': str(retry_after)},
+                                    detail=f'{self.name} is overloaded, retry after {retry_after}s')
+            self._tokens += cost
+            self._requests += 1
+            self._admitted += 1
+            return Ticket(self, cost)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'inflight_requests': self._requests,
+                'inflight_tokens': self._tokens,
+                'max_requests': self.max_requests,
+                'max_tokens': self.max_tokens,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'tokens_per_second': self._throughput(),
+            }
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            self._tokens -= ticket.cost
+            self._requests -= 1
+            self._done.append((time.time(), ticket.cost))
+
+    def _throughput(self) -> float:
+        now = time.time()
+        while self._done and self._done[0][0] < now - self.window:
+            self._done.popleft()
+        return sum(cost for _, cost in self._done) / self.window
+
+    def _retry_after(self, excess_tokens: int) -> int:
+        throughput = self._throughput()
+        if throughput <= 0:
+            return 1
+        return max(1, min(self.max_retry_after, math.ceil(excess_tokens / throughput)))
+
+
+class Admission(object):
+    """
+    One AdmissionController per endpoint, see Config.ADMISSION_CONFIG.
+    """
+
+    def __init__(self, endpoints: Dict[str, dict], chars_per_token: float = 1.0):
+        """
+        :param endpoints: 端点名 -> AdmissionController参数
+        :param chars_per_token: 估算prompt tokens时每个token对应的字符数, 中文约为1
+        """
+        self.controllers = {name: AdmissionController(name, **options) for name, options in endpoints.items()}
+        self.chars_per_token = chars_per_token
+
+    def admit(self, endpoint: str, cost: int) -> Optional[Ticket]:
+        """
+        :return: 未配置该端点时返回None(不限制)
+        """
+        controller = self.controllers.get(endpoint)
+        return controller.admit(cost) if controller is not None else None
+
+    def estimate_tokens(self, text: str) -> int:
+        return math.ceil(len(text or '') / self.chars_per_token)
+
+    def stats(self) -> dict:
+        return {name: controller.stats() for name, controller in self.controllers.items()}
@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+
+class GenerationControl(object):
+    """
+    Cancellation handle and deadline shared between the HTTP handler and the generation of one request.
+
+    The handler calls cancel() when the client goes away; generation either polls `cancelled` or registers a
+    callback with on_cancel() (the engine uses it to retire the sequence even if nobody is reading the stream).
+    Unlike cancellation, an expired deadline keeps the output generated so far and finishes with 'length'.
+    """
+    _lock = threading.Lock()
+    _cancellations = 0
+    _wasted_tokens = 0
+
+    def __init__(self, timeout: Optional[float] = None):
+        """
+        :param timeout: 从现在起的生成时间预算(秒), None表示不限制
+        """
+        # 请求到达时间, 用于TTFT等指标
+        self.created = time.monotonic()
+        self.deadline = self.created + timeout if timeout is not None else None
+        self.reason = None
+        self._callbacks: List[Callable[[], None]] = []
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cancel(self, reason: str = 'disconnect'):
+        with GenerationControl._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            GenerationControl._cancellations += 1
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        with GenerationControl._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @staticmethod
+    def record_wasted(tokens: int):
+        """
+        :param tokens: 被取消的请求已生成但未送达的token数
+        """
+        with GenerationControl._lock:
+            GenerationControl._wasted_tokens += tokens
+
+    @staticmethod
+    def stats() -> dict:
+        with GenerationControl._lock:
+            return {
+                'cancellations': GenerationControl._cancellations,
+                'wasted_tokens': GenerationControl._wasted_tokens,
+            }
+
+
+class ControlStoppingCriteria(StoppingCriteria):
+    """
+    Stop model.generate / stream_generate at the next step once the request is cancelled or its deadline passed.
+    `deadline_reached` records that generation was actually cut by the deadline, for finish_reason='length'.
+    """
+
+    def __init__(self, control: GenerationControl):
+        self.control = control
+        self.deadline_reached = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if self.control.cancelled:
+            return True
+        if self.control.expired:
+            self.deadline_reached = True
+            return True
+        return False
@@ -0,0 +1,43 @@
+from typing import List
+
+from transformers import PreTrainedTokenizer
+
+
+class IncrementalDetokenizer(object):
+    """
+    Decode a growing token sequence without re-decoding everything on each step.
+
+    Only the window tokens[prefix_offset:] is decoded. The text of tokens[prefix_offset:read_offset] was already
+    emitted, so the new text is whatever the window adds on top of it. The previous window is kept as context
+    because tokenizers like sentencepiece decode a token differently at the start of a string (leading space).
+    Text ending in the replacement character is held back until the rest of the UTF-8 sequence arrives.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, skip_special_tokens: bool = False):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.text = ""
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """
+        :param token_ids: 新生成的token
+        :return: 新增的文本, 尚无完整字符时返回空字符串
+        """
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+        delta = new_text[len(prefix_text):]
+        self.text += delta
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return delta
+
+    def _decode(self, token_ids: List[int]) -> str:
+        if not token_ids:
+            return ""
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
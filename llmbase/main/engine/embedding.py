@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from llmbase.main.engine.embedding_cache import EmbeddingCache
+
+
+class EmbeddingEncoder(object):
+    """
+    Encode all inputs of an embeddings request in one SentenceTransformer.encode call.
+
+    encode sorts the texts by length and runs them in batches of `batch_size`, so every forward pass pads to a
+    similar length; the vectors come back in input order as one float32 array.
+    Usage is counted with the embedding model's own tokenizer, the same tokens the model actually sees.
+    With a cache only the texts it does not know yet are encoded, duplicates within a request once.
+    """
+
+    def __init__(self, model: SentenceTransformer, batch_size: int = 64, model_id: str = '', cache: dict = None):
+        """
+        :param batch_size: 每次前向计算的文本数
+        :param model_id: 缓存key中的模型标识
+        :param cache: EmbeddingCache的参数, 为空或enable=False时不缓存
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.cache: Optional[EmbeddingCache] = None
+        _cache_config = dict(cache or {})
+        if _cache_config.pop('enable', False):
+            self.cache = EmbeddingCache(model_id=model_id or '', **_cache_config)
+        self.tokenizer = model.tokenizer
+        self.max_seq_length = model.max_seq_length
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._texts = 0
+        self._tokens = 0
+        self._seconds = 0.0
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: shape为(len(texts), dim)的float32数组
+        """
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension() or 0), dtype=np.float32)
+        if self.cache is None:
+            return self._encode(texts)
+        cached = self.cache.get_many(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+        if not missing:
+            return np.stack(cached)
+        encoded = self._encode(missing)
+        self.cache.put_many(missing, encoded)
+        rows = {text: row for row, text in enumerate(missing)}
+        return np.stack([vector if vector is not None else encoded[rows[text]] for text, vector in zip(texts, cached)])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        start_time = time.time()
+        embeddings = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                       show_progress_bar=False)
+        elapsed = time.time() - start_time
+        with self._lock:
+            self._requests += 1
+            self._texts += len(texts)
+            self._seconds += elapsed
+        return embeddings
+
+    def count_tokens(self, texts: List[str]) -> int:
+        """
+        Number of tokens the model sees for `texts`, truncated at max_seq_length like encode does.
+        """
+        if not texts:
+            return 0
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)["input_ids"]
+        tokens = sum(len(input_ids) for input_ids in encoded)
+        with self._lock:
+            self._tokens += tokens
+        return tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'texts': self._texts,
+                'tokens': self._tokens,
+                'encode_ms': self._seconds * 1000,
+                'texts_per_second': self._texts / self._seconds if self._seconds else 0.0,
+                'cache': self.cache.stats() if self.cache is not None else None,
+            }
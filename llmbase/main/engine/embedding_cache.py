@@ -0,0 +1,217 @@
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+KEY_BYTES = 16
+
+
+class MmapVectorStore(object):
+    """
+    Persistent fixed-size vector store shared by every worker on the host.
+
+    {path}/vectors.bin  capacity x dim 的float32数组
+    {path}/keys.bin     capacity x 16 字节, 每个槽位对应的key
+    {path}/head.bin     [已写入次数, dim, capacity]
+
+    Slots are used as a ring: the n-th write goes to slot n % capacity, so the oldest vector is evicted first.
+    Writers serialize on a file lock. Readers keep a key -> slot index and catch up with writes of other
+    processes by scanning the slots written since they last looked at the counter.
+    """
+
+    def __init__(self, path: str, capacity: int = 1000000):
+        self.path = path
+        self.capacity = capacity
+        self.dim: Optional[int] = None
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index: Dict[bytes, int] = {}
+        self._seen = 0
+        self._head = None
+        self._keys = None
+        self._vectors = None
+        self._open_existing()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            if self._head is None and not self._open_existing():
+                return None
+            self._refresh()
+            slot = self._index.get(key)
+            if slot is None:
+                return None
+            vector = np.array(self._vectors[slot])
+            # 读取期间可能被其他进程覆盖
+            if self._keys[slot].tobytes() != key:
+                del self._index[key]
+                return None
+            return vector
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        if not keys:
+            return
+        with self._lock:
+            if self._head is None:
+                self._open(dim=vectors.shape[1], capacity=self.capacity)
+            if vectors.shape[1] != self.dim:
+                return
+            with open(os.path.join(self.path, 'lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._refresh()
+                for key, vector in zip(keys, vectors):
+                    if key in self._index:
+                        continue
+                    slot = int(self._head[0]) % self.capacity
+                    # 先清掉key再写向量, 读者不会读到key与向量不一致的槽位
+                    old_key = self._keys[slot].tobytes()
+                    if self._index.get(old_key) == slot:
+                        del self._index[old_key]
+                    self._keys[slot] = 0
+                    self._vectors[slot] = vector
+                    self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                    self._head[0] += 1
+                    self._seen = int(self._head[0])
+                    self._index[key] = slot
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _open_existing(self) -> bool:
+        """
+        Attach to a store created earlier, possibly by another process.
+        """
+        head_path = os.path.join(self.path, 'head.bin')
+        if not os.path.exists(head_path):
+            return False
+        head = np.fromfile(head_path, dtype=np.int64)
+        self._open(dim=int(head[1]), capacity=int(head[2]))
+        return True
+
+    def _open(self, dim: int, capacity: int):
+        with open(os.path.join(self.path, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            head_path = os.path.join(self.path, 'head.bin')
+            if not os.path.exists(head_path):
+                np.memmap(os.path.join(self.path, 'vectors.bin'), dtype=np.float32, mode='w+', shape=(capacity, dim))
+                np.memmap(os.path.join(self.path, 'keys.bin'), dtype=np.uint8, mode='w+', shape=(capacity, KEY_BYTES))
+                np.array([0, dim, capacity], dtype=np.int64).tofile(head_path)
+            else:
+                head = np.fromfile(head_path, dtype=np.int64)
+                dim, capacity = int(head[1]), int(head[2])
+        self.dim, self.capacity = dim, capacity
+        self._head = np.memmap(os.path.join(self.path, 'head.bin'), dtype=np.int64, mode='r+', shape=(3,))
+        self._vectors = np.memmap(os.path.join(self.path, 'vectors.bin'), dtype=np.float32, mode='r+',
+                                  shape=(capacity, dim))
+        self._keys = np.memmap(os.path.join(self.path, 'keys.bin'), dtype=np.uint8, mode='r+',
+                               shape=(capacity, KEY_BYTES))
+        self._index, self._seen = {}, 0
+        self._refresh()
+
+    def _refresh(self):
+        """
+        Index the slots written by any process since the last refresh.
+        """
+        written = int(self._head[0])
+        if written == self._seen:
+            return
+        if written - self._seen >= self.capacity:
+            self._index = {}
+            slots = range(min(written, self.capacity))
+        else:
+            slots = (n % self.capacity for n in range(self._seen, written))
+        empty = bytes(KEY_BYTES)
+        for slot in slots:
+            key = self._keys[slot].tobytes()
+            if key != empty:
+                self._index[key] = slot
+        self._seen = written
+
+
+class EmbeddingCache(object):
+    """
+    Content-addressed embedding cache: key = blake2b(model id + text).
+
+    Lookups go to an in-process LRU first, then to the memory-mapped store (if a disk path is configured);
+    disk hits are promoted to the LRU. New vectors are written to both tiers.
+    """
+
+    def __init__(self, model_id: str, max_entries: int = 100000, disk_path: str = None,
+                 disk_entries: int = 1000000):
+        """
+        :param model_id: 模型标识(例如模型路径), 不同模型的向量互不命中
+        :param max_entries: 进程内LRU的容量
+        :param disk_path: 持久化目录, 为空时只使用进程内缓存
+        :param disk_entries: 持久化存储的容量
+        """
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.store = None
+        if disk_path:
+            model_dir = hashlib.blake2b(model_id.encode('utf-8'), digest_size=8).hexdigest()
+            self.store = MmapVectorStore(os.path.join(disk_path, model_dir), capacity=disk_entries)
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b((self.model_id + '\0' + text).encode('utf-8'), digest_size=KEY_BYTES).digest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        vectors = []
+        for text in texts:
+            key = self.key(text)
+            with self._lock:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    self._memory_hits += 1
+                    vectors.append(vector)
+                    continue
+            vector = self.store.get(key) if self.store is not None else None
+            with self._lock:
+                if vector is None:
+                    self._misses += 1
+                else:
+                    self._disk_hits += 1
+                    self._remember(key, vector)
+            vectors.append(vector)
+        return vectors
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        keys = [self.key(text) for text in texts]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector.copy())
+        if self.store is not None:
+            self.store.put_many(keys, vectors)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._memory_hits + self._disk_hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'disk_entries': len(self.store) if self.store is not None else None,
+                'memory_hits': self._memory_hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'hit_rate': (self._memory_hits + self._disk_hits) / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+            }
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
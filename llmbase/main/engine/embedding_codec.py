@@ -0,0 +1,62 @@
+import base64
+from typing import Optional
+
+import numpy as np
+import orjson
+
+# float    JSON数组(float32精度)
+# base64   float32小端字节的base64, 与OpenAI encoding_format="base64"一致
+# 以下为OpenAI协议之外的扩展, 只有请求显式指定时才使用, float/base64的响应结构与OpenAI相同:
+# float16  float16小端字节的base64
+# int8     按向量缩放到[-127, 127]的int8字节的base64, 每个data项额外带scale字段(非标准), 原值 ≈ int8 * scale
+# binary   每维1 bit(>0为1, 高位在前)打包后的base64
+ENCODING_FORMATS = ('float', 'base64', 'float16', 'int8', 'binary')
+
+
+def truncate_dimensions(embeddings: np.ndarray, dimensions: Optional[int]) -> np.ndarray:
+    """
+    Keep the first `dimensions` components and L2-normalize again, like OpenAI's `dimensions` parameter.
+    """
+    if dimensions is None or dimensions >= embeddings.shape[1]:
+        return embeddings
+    truncated = embeddings[:, :dimensions]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return truncated / norms
+
+
+def encode_embedding_response(embeddings: np.ndarray, encoding_format: str, model: str, num_tokens: int) -> bytes:
+    """
+    Serialize an embeddings response straight from the numpy buffer, without going through Python float lists.
+    Only the int8 extension adds a field (scale) to the OpenAI data items.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if encoding_format == 'float':
+        data = [{'object': 'embedding', 'embedding': row, 'index': index} for index, row in enumerate(embeddings)]
+    elif encoding_format == 'int8':
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.rint(embeddings / scales[:, None]).astype(np.int8)
+        data = [{'object': 'embedding', 'embedding': _b64(row), 'scale': float(scale), 'index': index}
+                for index, (row, scale) in enumerate(zip(quantized, scales))]
+    else:
+        if encoding_format == 'base64':
+            packed = embeddings.astype('<f4', copy=False)
+        elif encoding_format == 'float16':
+            packed = embeddings.astype('<f2')
+        elif encoding_format == 'binary':
+            packed = np.packbits(embeddings > 0, axis=1)
+        else:
+            raise ValueError(f'unknown encoding_format {encoding_format}')
+        data = [{'object': 'embedding', 'embedding': _b64(row), 'index': index} for index, row in enumerate(packed)]
+
+    return orjson.dumps({
+        'data': data,
+        'model': model,
+        'object': 'list',
+        'usage': {'prompt_tokens': num_tokens, 'completion_tokens': 0, 'total_tokens': num_tokens},
+    }, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _b64(row: np.ndarray) -> str:
+    return base64.b64encode(row.tobytes()).decode('ascii')
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class IsolatedExecutor(object):
+    """
+    Dedicated thread pool with its own concurrency limit and bounded queue.
+
+    Work submitted here never competes with Starlette's default thread pool, so e.g. cheap embedding calls do not
+    wait behind long generations. At most `max_workers` calls run at once, at most `max_queue` more wait;
+    beyond that `run` raises QueueFullError right away instead of piling up.
+    """
+
+    def __init__(self, name: str, max_workers: int = 2, max_queue: int = 256):
+        """
+        :param max_workers: 同时执行的调用数
+        :param max_queue: 排队等待的调用数上限
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_run = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise QueueFullError(f'{self.name} queue is full')
+            self._pending += 1
+        arrival_time = time.time()
+        try:
+            # 带上调用方的contextvars(例如请求的分阶段计时)
+            future = self._pool.submit(contextvars.copy_context().run, self._call, arrival_time, fn, args)
+        except BaseException:
+            self._done(None)
+            raise
+        # 调用方被取消时工作线程可能仍在执行, 由线程结束时(或排队中被取消时)释放名额
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, arrival_time: float, fn: Callable[..., Any], args: tuple) -> Any:
+        start_time = time.time()
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            end_time = time.time()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._total_wait += start_time - arrival_time
+                self._max_wait = max(self._max_wait, start_time - arrival_time)
+                self._total_run += end_time - start_time
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'running': self._running,
+                'queued': self._pending - self._running,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_wait_ms': self._total_wait * 1000 / self._completed if self._completed else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+                'avg_run_ms': self._total_run * 1000 / self._completed if self._completed else 0.0,
+            }
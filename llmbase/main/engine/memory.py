@@ -0,0 +1,90 @@
+import gc
+import threading
+import time
+
+import torch
+
+from llmbase.main.common.tool.logger import logger
+
+
+class MemoryManager(object):
+    """
+    Decides when to run gc.collect() and torch.cuda.empty_cache() after a request.
+
+    policy:
+        'watermark' 仅当已分配显存占比超过high_watermark时回收, 两次回收至少间隔min_interval秒
+        'always'    每个请求结束后都回收(原有行为)
+        'never'     从不回收
+    """
+
+    def __init__(self, policy: str = 'watermark', high_watermark: float = 0.9, min_interval: float = 5.0,
+                 freeze_after_load: bool = True):
+        if policy not in ('watermark', 'always', 'never'):
+            raise ValueError(f'unknown memory policy {policy}')
+        self.policy = policy
+        self.high_watermark = high_watermark
+        self.min_interval = min_interval
+        self.freeze_after_load = freeze_after_load
+
+        self._lock = threading.Lock()
+        self._last_reclaim = 0.0
+        self._reclaims = 0
+        self._reclaim_seconds = 0.0
+        self._frozen = 0
+
+    def freeze(self):
+        """
+        Move everything alive after model load into the permanent generation, so later collections skip it.
+        """
+        if not self.freeze_after_load:
+            return
+        gc.collect()
+        gc.freeze()
+        self._frozen = gc.get_freeze_count()
+        logger.info(f'gc froze {self._frozen} objects after model load')
+
+    def after_request(self):
+        if self.policy == 'never':
+            return
+        if self.policy == 'watermark':
+            if time.time() - self._last_reclaim < self.min_interval:
+                return
+            if self.allocated_fraction() < self.high_watermark:
+                return
+        self.reclaim()
+
+    def reclaim(self):
+        start_time = time.time()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elapsed = time.time() - start_time
+        with self._lock:
+            self._last_reclaim = time.time()
+            self._reclaims += 1
+            self._reclaim_seconds += elapsed
+
+    @staticmethod
+    def allocated_fraction() -> float:
+        """
+        Highest ratio of allocated to total memory over all visible GPUs, 0 without CUDA.
+        """
+        if not torch.cuda.is_available():
+            return 0.0
+        fraction = 0.0
+        for device in range(torch.cuda.device_count()):
+            total = torch.cuda.get_device_properties(device).total_memory
+            fraction = max(fraction, torch.cuda.memory_allocated(device) / total)
+        return fraction
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'high_watermark': self.high_watermark,
+                'allocated_fraction': self.allocated_fraction(),
+                'reclaims': self._reclaims,
+                'reclaim_ms': self._reclaim_seconds * 1000,
+                'avg_reclaim_ms': self._reclaim_seconds * 1000 / self._reclaims if self._reclaims else 0.0,
+                'frozen_objects': self._frozen,
+            }
@@ -0,0 +1,167 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List, Optional
+
+from llmbase.main.common.tool.logger import logger
+
+
+class MicroBatcherStopped(RuntimeError):
+    """
+    Raised by submit() after stop(), and for the requests still queued when the batcher stopped.
+    """
+
+
+class _Pending(object):
+    __slots__ = ('key', 'item', 'future', 'arrival_time')
+
+    def __init__(self, key: Hashable, item: Any):
+        self.key = key
+        self.item = item
+        self.future = Future()
+        self.arrival_time = time.time()
+
+
+class MicroBatcher(object):
+    """
+    Coalescing queue for non-streaming requests.
+
+    The first request of a window waits at most `window_ms` for company, or less if `max_batch_size` requests
+    arrive earlier. Requests are grouped by `key` (requests with different sampling parameters cannot share
+    a model.generate call) and each group is handed to `run_batch(key, items)`, which must return one result per item.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], List[Any]], window_ms: float = 10,
+                 max_batch_size: int = 32):
+        """
+        :param run_batch: 批量执行函数, 按输入顺序返回结果
+        :param window_ms: 第一个请求最多等待的毫秒数
+        :param max_batch_size: 一个窗口最多合并的请求数
+        """
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+
+        self._queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._max_batch = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self._thread.start()
+        logger.info(f'micro batcher started, window_ms={self.window * 1000}, max_batch_size={self.max_batch_size}')
+
+    def stop(self):
+        """
+        Stop after the group being run, requests that have not started fail with MicroBatcherStopped.
+        """
+        with self._lock:
+            self._stopped = True
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=10)
+        self._drain()
+        if thread is not None and thread.is_alive():
+            # 仍在执行的批次结束后线程读到结束标记退出
+            self._queue.put(None)
+
+    def submit(self, key: Hashable, item: Any) -> Any:
+        """
+        Block the calling thread until the batch containing `item` has been run.
+        """
+        pending = _Pending(key, item)
+        # 与stop()互斥, 停止后不会再有请求进入队列
+        with self._lock:
+            if self._stopped:
+                raise MicroBatcherStopped('micro batcher is stopped')
+            self._queue.put(pending)
+        return pending.future.result()
+
+    def _drain(self):
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if pending is not None:
+                self._fail([pending])
+
+    @staticmethod
+    def _fail(group: List[_Pending]):
+        for pending in group:
+            pending.future.set_exception(MicroBatcherStopped('micro batcher stopped before the request ran'))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+                'queued': self._queue.qsize(),
+                'batches': self._batches,
+                'requests': self._requests,
+                'avg_batch_size': self._requests / self._batches if self._batches else 0.0,
+                'max_batch': self._max_batch,
+                'avg_wait_ms': self._total_wait * 1000 / self._requests if self._requests else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+            }
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            window = [first]
+            deadline = first.arrival_time + self.window
+            while len(window) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    # 结束标记留给下一次读取, 已收集的请求在停止后不再执行
+                    self._queue.put(None)
+                    break
+                window.append(pending)
+
+            groups = defaultdict(list)
+            for pending in window:
+                groups[pending.key].append(pending)
+            for key, group in groups.items():
+                if self._stopped:
+                    self._fail(group)
+                else:
+                    self._run_group(key, group)
+
+    def _run_group(self, key: Hashable, group: List[_Pending]):
+        start_time = time.time()
+        waits = [start_time - pending.arrival_time for pending in group]
+        with self._lock:
+            self._batches += 1
+            self._requests += len(group)
+            self._max_batch = max(self._max_batch, len(group))
+            self._total_wait += sum(waits)
+            self._max_wait = max(self._max_wait, max(waits))
+        try:
+            results = self.run_batch(key, [pending.item for pending in group])
+        except Exception as e:
+            logger.exception(e)
+            for pending in group:
+                pending.future.set_exception(e)
+            return
+        for pending, result in zip(group, results):
+            pending.future.set_result(result)
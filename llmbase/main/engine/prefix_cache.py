@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+
+class _Entry(object):
+    __slots__ = ('token_ids', 'past', 'nbytes', 'hashes')
+
+    def __init__(self, token_ids: Tuple[int, ...], past, nbytes: int, hashes: List[int]):
+        self.token_ids = token_ids
+        self.past = past
+        self.nbytes = nbytes
+        self.hashes = hashes
+
+
+class PrefixCache(object):
+    """
+    Cross-request cache of prefill KV states, keyed by block-aligned token-id prefixes.
+
+    A prompt is cut into blocks of `block_size` tokens and every block boundary gets a chained hash
+    (hash of the previous boundary and the block). An entry stores the KV cache of one prompt up to its last
+    full block and is reachable from every boundary it covers, so a later prompt sharing only the first few
+    blocks still reuses them. Entries are evicted least recently used first once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, seq_dim: int, block_size: int = 16, max_bytes: int = 2 * 1024 ** 3):
+        """
+        :param seq_dim: KV cache中序列所在的维度
+        :param block_size: 前缀按多少个token对齐
+        :param max_bytes: 缓存KV占用的显存上限
+        """
+        self.seq_dim = seq_dim
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._index = {}
+        self._bytes = 0
+        self._lookups = 0
+        self._hits = 0
+        self._prompt_tokens = 0
+        self._hit_tokens = 0
+        self._evictions = 0
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+        :return: (命中的前缀长度, 前缀的past_key_values), 未命中时返回(0, None)
+        至少保留一个token不命中, 以便prefill得到最后一个位置的logits
+        """
+        hashes = self._block_hashes(input_ids, (len(input_ids) - 1) // self.block_size)
+        with self._lock:
+            self._lookups += 1
+            self._prompt_tokens += len(input_ids)
+            for blocks in range(len(hashes), 0, -1):
+                entry_key = self._index.get(hashes[blocks - 1])
+                if entry_key is None:
+                    continue
+                entry = self._entries[entry_key]
+                prefix_len = blocks * self.block_size
+                if entry.token_ids[:prefix_len] != tuple(input_ids[:prefix_len]):
+                    continue
+                self._entries.move_to_end(entry_key)
+                self._hits += 1
+                self._hit_tokens += prefix_len
+                return prefix_len, _map_past(entry.past, lambda t: t.narrow(self.seq_dim, 0, prefix_len))
+        return 0, None
+
+    def insert(self, input_ids: List[int], past):
+        """
+        Cache the block-aligned prefix of a freshly prefilled prompt.
+
+        :param past: 整个prompt的past_key_values
+        """
+        blocks = len(input_ids) // self.block_size
+        if blocks == 0:
+            return
+        prefix_len = blocks * self.block_size
+        hashes = self._block_hashes(input_ids, blocks)
+        with self._lock:
+            entry_key = self._index.get(hashes[-1])
+            if entry_key is not None and self._entries[entry_key].token_ids == tuple(input_ids[:prefix_len]):
+                self._entries.move_to_end(entry_key)
+                return
+
+        # 复制一份, 避免引用整个prompt的KV
+        prefix_past = _map_past(past, lambda t: t.narrow(self.seq_dim, 0, prefix_len).clone())
+        nbytes = sum(t.numel() * t.element_size() for t in _flatten_past(prefix_past))
+        if nbytes > self.max_bytes:
+            return
+        entry = _Entry(tuple(input_ids[:prefix_len]), prefix_past, nbytes, hashes)
+        with self._lock:
+            while self._entries and self._bytes + nbytes > self.max_bytes:
+                self._evict()
+            self._entries[hashes[-1]] = entry
+            self._bytes += nbytes
+            for block_hash in hashes:
+                self._index[block_hash] = hashes[-1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'lookups': self._lookups,
+                'hits': self._hits,
+                'hit_rate': self._hits / self._lookups if self._lookups else 0.0,
+                'token_hit_rate': self._hit_tokens / self._prompt_tokens if self._prompt_tokens else 0.0,
+                'evictions': self._evictions,
+            }
+
+    def _evict(self):
+        entry_key, entry = self._entries.popitem(last=False)
+        self._bytes -= entry.nbytes
+        self._evictions += 1
+        for block_hash in entry.hashes:
+            if self._index.get(block_hash) == entry_key:
+                del self._index[block_hash]
+
+    def _block_hashes(self, input_ids: List[int], blocks: int) -> List[int]:
+        hashes, previous = [], None
+        for block in range(blocks):
+            previous = hash((previous, tuple(input_ids[block * self.block_size:(block + 1) * self.block_size])))
+            hashes.append(previous)
+        return hashes
+
+
+def _map_past(past, fn):
+    if isinstance(past, torch.Tensor):
+        return fn(past)
+    return tuple(_map_past(item, fn) for item in past)
+
+
+def _flatten_past(past):
+    if isinstance(past, torch.Tensor):
+        yield past
+        return
+    for item in past:
+        yield from _flatten_past(item)
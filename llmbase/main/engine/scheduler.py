@@ -0,0 +1,433 @@
+import itertools
+import queue
+import threading
+import time
+from typing import List, Optional
+
+import torch
+from transformers.generation.logits_process import (RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper,
+                                                    TopPLogitsWarper)
+
+from llmbase.main.common.tool import metrics
+from llmbase.main.common.tool.logger import logger
+from llmbase.main.engine.prefix_cache import PrefixCache
+
+
+class Sequence(object):
+    """
+    A single generation request tracked by the engine.
+    The consumer side only uses `stream()`, everything else is owned by the engine thread.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, input_ids: List[int], max_new_tokens: int, temperature: float, top_p: float,
+                 repetition_penalty: float, eos_token_id: List[int], deadline: Optional[float] = None):
+        """
+        :param deadline: time.monotonic()截止时间, 过期后以finish_reason='length'结束, 排队中过期则不做prefill
+        """
+        self.seq_id = next(Sequence._ids)
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.eos_token_id = set(eos_token_id)
+        self.deadline = deadline
+        self.output_ids: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.arrival_time = time.time()
+        self.cancelled = False
+        # 各阶段的time.monotonic()时间点, 由引擎线程记录, 结束后供请求分阶段计时
+        self.submitted = time.monotonic()
+        self.prefill_started: Optional[float] = None
+        self.prefill_finished: Optional[float] = None
+        self.finished: Optional[float] = None
+        # 以下字段仅由引擎线程读写
+        self.cache_len = 0
+        self.next_token: Optional[int] = None
+        self._seen = set(input_ids)
+        self._seen_tensor = None
+        self._events = queue.Queue()
+
+    def stream(self):
+        """
+        Yield lists of newly generated token ids until the sequence finishes.
+        Tokens produced between two reads are drained together.
+        """
+        while True:
+            item = self._events.get()
+            token_ids = []
+            while True:
+                if item is None:
+                    if token_ids:
+                        yield token_ids
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                token_ids.append(item)
+                try:
+                    item = self._events.get_nowait()
+                except queue.Empty:
+                    break
+            yield token_ids
+
+    def cancel(self):
+        """
+        Ask the engine to drop this sequence (before prefill or before the next decode step), thread safe.
+        """
+        self.cancelled = True
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+    def _emit(self, token_id: int):
+        self.output_ids.append(token_id)
+        self._events.put(token_id)
+
+    def _finish(self, finish_reason: str):
+        self.finish_reason = finish_reason
+        self.finished = time.monotonic()
+        self._events.put(None)
+
+
+class ContinuousBatchingEngine(object):
+    """
+    Iteration-level scheduler: every in-flight request shares one decode loop.
+
+    New sequences are prefilled one at a time and merged into the running batch between two decode
+    steps, finished sequences are retired right after the step that finished them.
+    KV caches of the running batch are left-padded to a common length, the attention mask hides the padding.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 32, max_prefill_per_step: int = 4,
+                 kv_layout: str = 'auto', prefix_cache: dict = None, **kwargs):
+        """
+        :param max_batch_size: 同时参与解码的最大序列数
+        :param max_prefill_per_step: 每个解码步之间最多接纳的新序列数, 避免长prompt的prefill饿死正在解码的序列
+        :param kv_layout: 'seq_first'(ChatGLM3), 'batch_first'(ChatGLM4/HF默认) 或 'auto'
+        :param prefix_cache: PrefixCache的参数, 为空或enable=False时不缓存前缀
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_prefill_per_step = max_prefill_per_step
+        self.kv_layout = kv_layout
+        self.prefix_cache_config = dict(prefix_cache or {})
+        self.prefix_cache: Optional[PrefixCache] = None
+        self.device = model.device
+        self.max_seq_length = getattr(model.config, 'seq_length', None) or getattr(
+            model.config, 'max_position_embeddings', None)
+
+        self._waiting = queue.Queue()
+        self._running: List[Sequence] = []
+        # 已从_waiting取出, 尚未合并进_running的序列
+        self._admitting: List[Sequence] = []
+        self._past = None
+        self._cache_len = 0
+        self._batch_dim = None
+        self._seq_dim = None
+
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._steps = 0
+        self._decoded_tokens = 0
+        self._finished = 0
+        self._cancelled = 0
+        self._expired = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._batch_dim, self._seq_dim = self._resolve_kv_layout()
+        prefix_cache_config = dict(self.prefix_cache_config)
+        if prefix_cache_config and prefix_cache_config.pop('enable', True) and self.prefix_cache is None:
+            self.prefix_cache = PrefixCache(seq_dim=self._seq_dim, **prefix_cache_config)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, name='continuous-batching-engine', daemon=True)
+        self._thread.start()
+        logger.info(f'continuous batching engine started, max_batch_size={self.max_batch_size}, '
+                    f'kv batch_dim={self._batch_dim} seq_dim={self._seq_dim}')
+
+    def stop(self):
+        """
+        Stop the engine thread, sequences that are still queued or running finish with 'abort'.
+        """
+        self._stopped.set()
+        self._waiting.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self._finish_all(self._abort)
+
+    def submit(self, input_ids: List[int], max_new_tokens: int = 256, temperature: float = 1.0, top_p: float = 1.0,
+               repetition_penalty: float = 1.0, eos_token_id: List[int] = None, deadline: float = None) -> Sequence:
+        seq = Sequence(input_ids=list(input_ids), max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+                       repetition_penalty=repetition_penalty, eos_token_id=eos_token_id or [], deadline=deadline)
+        self._waiting.put(seq)
+        return seq
+
+    def is_idle(self) -> bool:
+        return not self._running and self._waiting.empty()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'waiting': self._waiting.qsize(),
+                'steps': self._steps,
+                'decoded_tokens': self._decoded_tokens,
+                'finished': self._finished,
+                'cancelled': self._cancelled,
+                'expired': self._expired,
+                'avg_batch_size': self._decoded_tokens / self._steps if self._steps else 0.0,
+                'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            }
+
+    # ------------------------------------------------------------------ engine thread
+
+    @torch.inference_mode()
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                self._admit(block=not self._running)
+                self._drop_stopped()
+                if self._running:
+                    self._decode_step()
+            except Exception as e:
+                logger.exception(e)
+                self._fail_all(e)
+
+    def _admit(self, block: bool):
+        admitted = 0
+        try:
+            while len(self._running) < self.max_batch_size and admitted < self.max_prefill_per_step:
+                try:
+                    seq = self._waiting.get(timeout=0.1) if block and admitted == 0 else self._waiting.get_nowait()
+                except queue.Empty:
+                    return
+                if seq is None:
+                    return
+                if seq.cancelled:
+                    self._abort(seq)
+                    continue
+                if seq.expired(time.monotonic()):
+                    # 排队期间已超时, 不再做prefill
+                    self._expire(seq)
+                    continue
+                admitted += 1
+                seq.prefill_started = time.monotonic()
+                metrics.QUEUE_WAIT.observe(seq.prefill_started - seq.submitted)
+                self._admitting.append(seq)
+                try:
+                    past = self._prefill(seq)
+                except Exception as e:
+                    # 只影响这一个序列(prompt过长, OOM等), 正在解码的序列不受影响
+                    logger.exception(e)
+                    self._admitting.remove(seq)
+                    self._fail(seq, e)
+                    continue
+                if seq.finish_reason is None:
+                    self._merge(seq, past)
+                self._admitting.remove(seq)
+        finally:
+            if admitted:
+                metrics.PREFILL_BATCH_SIZE.observe(admitted)
+
+    def _prefill(self, seq: Sequence):
+        prefix_len, past = 0, None
+        if self.prefix_cache is not None:
+            prefix_len, past = self.prefix_cache.lookup(seq.input_ids)
+        # 命中时只对前缀之后的token做prefill
+        input_ids = torch.tensor([seq.input_ids[prefix_len:]], dtype=torch.long, device=self.device)
+        position_ids = torch.arange(prefix_len, len(seq.input_ids), dtype=torch.long, device=self.device).unsqueeze(0)
+        attention_mask = torch.ones((1, len(seq.input_ids)), dtype=torch.long, device=self.device)
+        outputs = self.model(input_ids=input_ids, position_ids=position_ids, attention_mask=attention_mask,
+                             past_key_values=past, use_cache=True, return_dict=True)
+        seq.cache_len = len(seq.input_ids)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.input_ids, outputs.past_key_values)
+        seq.prefill_finished = time.monotonic()
+        self._accept(seq, outputs.logits[0, -1, :])
+        return outputs.past_key_values
+
+    def _drop_stopped(self):
+        """
+        Retire cancelled and expired sequences before the next decode step.
+        """
+        now = time.monotonic()
+        stopped = False
+        for seq in self._running:
+            if seq.finish_reason is not None:
+                continue
+            if seq.cancelled:
+                self._abort(seq)
+                stopped = True
+            elif seq.expired(now):
+                self._expire(seq)
+                stopped = True
+        if stopped:
+            self._retire()
+
+    def _abort(self, seq: Sequence):
+        seq._finish('abort')
+        with self._lock:
+            self._cancelled += 1
+
+    def _expire(self, seq: Sequence):
+        seq._finish('length')
+        with self._lock:
+            self._expired += 1
+
+    def _decode_step(self):
+        batch_size = len(self._running)
+        metrics.DECODE_BATCH_SIZE.observe(batch_size)
+        input_ids = torch.tensor([[seq.next_token] for seq in self._running], dtype=torch.long, device=self.device)
+        position_ids = torch.tensor([[seq.cache_len] for seq in self._running], dtype=torch.long, device=self.device)
+        attention_mask = torch.zeros((batch_size, self._cache_len + 1), dtype=torch.long, device=self.device)
+        for row, seq in enumerate(self._running):
+            attention_mask[row, self._cache_len - seq.cache_len:] = 1
+
+        outputs = self.model(input_ids=input_ids, position_ids=position_ids, attention_mask=attention_mask,
+                             past_key_values=self._past, use_cache=True, return_dict=True)
+        self._past = outputs.past_key_values
+        self._cache_len += 1
+
+        logits = outputs.logits[:, -1, :]
+        for row, seq in enumerate(self._running):
+            seq.cache_len += 1
+            self._accept(seq, logits[row])
+
+        with self._lock:
+            self._steps += 1
+            self._decoded_tokens += batch_size
+        self._retire()
+
+    def _accept(self, seq: Sequence, logits: torch.Tensor):
+        """
+        Sample the next token of `seq` and decide whether the sequence is finished.
+        """
+        token_id = self._sample(seq, logits)
+        if token_id in seq.eos_token_id:
+            seq._finish('stop')
+            return
+        seq._emit(token_id)
+        seq.next_token = token_id
+        if token_id not in seq._seen:
+            seq._seen.add(token_id)
+            seq._seen_tensor = None
+        if len(seq.output_ids) >= seq.max_new_tokens:
+            seq._finish('length')
+        elif self.max_seq_length and seq.cache_len + 1 >= self.max_seq_length:
+            seq._finish('length')
+
+    def _sample(self, seq: Sequence, logits: torch.Tensor) -> int:
+        scores = logits.float().unsqueeze(0)
+        if torch.isnan(scores).any() or torch.isinf(scores).any():
+            scores.zero_()
+            scores[..., 5] = 5e4
+        if seq.repetition_penalty != 1.0:
+            if seq._seen_tensor is None:
+                seq._seen_tensor = torch.tensor([list(seq._seen)], dtype=torch.long, device=scores.device)
+            scores = RepetitionPenaltyLogitsProcessor(seq.repetition_penalty)(seq._seen_tensor, scores)
+        if seq.temperature <= 1e-5:
+            return int(torch.argmax(scores, dim=-1))
+        scores = TemperatureLogitsWarper(seq.temperature)(None, scores)
+        if seq.top_p < 1.0:
+            scores = TopPLogitsWarper(seq.top_p)(None, scores)
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1))
+
+    def _merge(self, seq: Sequence, past):
+        """
+        Append a freshly prefilled sequence to the running batch.
+        """
+        if not self._running:
+            self._past, self._cache_len = past, seq.cache_len
+        else:
+            new_len = max(self._cache_len, seq.cache_len)
+            running_past = _map_past(self._past, lambda t: _pad_left(t, new_len - self._cache_len, self._seq_dim))
+            seq_past = _map_past(past, lambda t: _pad_left(t, new_len - seq.cache_len, self._seq_dim))
+            self._past = _zip_past(running_past, seq_past, lambda a, b: torch.cat((a, b), dim=self._batch_dim))
+            self._cache_len = new_len
+        self._running.append(seq)
+
+    def _retire(self):
+        keep = [row for row, seq in enumerate(self._running) if seq.finish_reason is None]
+        if len(keep) == len(self._running):
+            return
+        with self._lock:
+            self._finished += len(self._running) - len(keep)
+        if not keep:
+            self._running, self._past, self._cache_len = [], None, 0
+            return
+        self._running = [self._running[row] for row in keep]
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        # 去掉所有序列共同的左侧padding
+        trim = self._cache_len - max(seq.cache_len for seq in self._running)
+        self._cache_len -= trim
+        self._past = _map_past(self._past, lambda t: t.index_select(self._batch_dim, index.to(t.device))
+                               .narrow(self._seq_dim, trim, self._cache_len))
+
+    def _fail(self, seq: Sequence, error: Exception):
+        seq.finish_reason = 'error'
+        seq.finished = time.monotonic()
+        seq._events.put(error)
+
+    def _fail_all(self, error: Exception):
+        """
+        Deliver `error` to every queued, admitting and running sequence, the shared KV cache is dropped.
+        """
+        self._finish_all(lambda seq: self._fail(seq, error))
+
+    def _finish_all(self, finish):
+        sequences = self._admitting + self._running
+        while True:
+            try:
+                seq = self._waiting.get_nowait()
+            except queue.Empty:
+                break
+            if seq is not None:
+                sequences.append(seq)
+        for seq in sequences:
+            if seq.finish_reason is None:
+                finish(seq)
+        self._admitting, self._running, self._past, self._cache_len = [], [], None, 0
+
+    def _resolve_kv_layout(self):
+        if self.kv_layout == 'seq_first':
+            return 1, 0
+        if self.kv_layout == 'batch_first':
+            return 0, 2
+        # 用一个batch=1, 长度为7的输入探测KV cache中batch维和序列维的位置
+        probe_len = 7
+        with torch.inference_mode():
+            input_ids = torch.full((1, probe_len), self.tokenizer.eos_token_id or 0, dtype=torch.long,
+                                   device=self.device)
+            position_ids = torch.arange(probe_len, dtype=torch.long, device=self.device).unsqueeze(0)
+            past = self.model(input_ids=input_ids, position_ids=position_ids, use_cache=True,
+                              return_dict=True).past_key_values
+        shape = list(past[0][0].shape)
+        seq_dim = shape.index(probe_len)
+        batch_dim = next(dim for dim, size in enumerate(shape) if size == 1 and dim != seq_dim)
+        return batch_dim, seq_dim
+
+
+def _map_past(past, fn):
+    if isinstance(past, torch.Tensor):
+        return fn(past)
+    return tuple(_map_past(item, fn) for item in past)
+
+
+def _zip_past(left, right, fn):
+    if isinstance(left, torch.Tensor):
+        return fn(left, right)
+    return tuple(_zip_past(a, b, fn) for a, b in zip(left, right))
+
+
+def _pad_left(tensor: torch.Tensor, pad: int, dim: int) -> torch.Tensor:
+    if pad <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad
+    return torch.cat((tensor.new_zeros(shape), tensor), dim=dim)
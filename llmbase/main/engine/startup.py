@@ -0,0 +1,199 @@
+import copy
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from llmbase.main.common.tool.logger import logger
+
+PENDING = 'pending'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class StartupCancelled(Exception):
+    pass
+
+
+class Phase(object):
+    __slots__ = ('name', 'required', 'state', 'started', 'seconds', 'error')
+
+    def __init__(self, name: str, required: bool = True):
+        self.name = name
+        self.required = required
+        self.state = PENDING
+        self.started = None
+        self.seconds = 0.0
+        self.error = None
+
+
+class StartupProgress(object):
+    """
+    State and duration of every startup phase (tokenizer, embedding, model, runtime, ...), reported by /v1/ready.
+
+    The server accepts connections while the phases run in a background thread, and is ready once every required
+    phase is. cancel() stops before the next phase starts; a from_pretrained call already running cannot be
+    interrupted, its thread is a daemon and its result is dropped.
+    """
+
+    def __init__(self):
+        self._phases: Dict[str, Phase] = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._prefix = ''
+        self.started = time.time()
+        self.finished = None
+        # 使启动失败的异常, 包括不属于任何阶段的
+        self.error = None
+        self._thread = None
+
+    def scoped(self, prefix: str) -> 'StartupProgress':
+        """
+        The same progress with phase names prefixed, e.g. one scope per replica device.
+        """
+        scope = copy.copy(self)
+        scope._prefix = f'{self._prefix}{prefix}/'
+        return scope
+
+    def declare(self, *names: str, required: bool = True):
+        """
+        List phases up front so that /v1/ready shows them as pending.
+        """
+        with self._lock:
+            for name in names:
+                self._phases.setdefault(self._prefix + name, Phase(self._prefix + name, required=required))
+
+    @contextmanager
+    def phase(self, name: str, required: bool = True):
+        self.check()
+        name = self._prefix + name
+        with self._lock:
+            phase = self._phases.setdefault(name, Phase(name, required=required))
+            phase.state = LOADING
+            phase.started = time.time()
+        try:
+            yield phase
+        except StartupCancelled:
+            phase.state = CANCELLED
+            raise
+        except BaseException as e:
+            phase.state = FAILED
+            phase.error = str(e)
+            raise
+        else:
+            # 取消后才结束的加载保持cancelled
+            if phase.state == LOADING:
+                phase.state = READY
+        finally:
+            phase.seconds = time.time() - phase.started
+            logger.info(f'startup phase {name} {phase.state} after {phase.seconds:.2f}s')
+
+    def run_parallel(self, loaders: Dict[str, Callable[[], object]]) -> dict:
+        """
+        Run independent loaders (e.g. tokenizer, embedding model, LLM) concurrently, each as one phase.
+        Raises the first error after all of them finished, StartupCancelled right away on cancel().
+        """
+        self.declare(*loaders)
+        results, errors = {}, []
+
+        def _run(name, load):
+            try:
+                with self.phase(name):
+                    results[name] = load()
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_run, args=(name, load), name=f'startup-{name}', daemon=True)
+                   for name, load in loaders.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+                if self.cancelled:
+                    # 不等待正在进行的加载
+                    with self._lock:
+                        for name in loaders:
+                            phase = self._phases[self._prefix + name]
+                            if phase.state in (PENDING, LOADING):
+                                phase.state = CANCELLED
+                                phase.seconds = time.time() - phase.started if phase.started else 0.0
+                    raise StartupCancelled()
+        if errors:
+            raise errors[0]
+        self.check()
+        return results
+
+    def start(self, target: Callable[['StartupProgress'], None]):
+        """
+        Run `target(self)` in a background thread, see get_asgi_app.
+        """
+        def _run():
+            try:
+                target(self)
+            except StartupCancelled:
+                logger.warning('startup cancelled')
+            except Exception as e:
+                self.error = str(e)
+                logger.exception(e)
+            finally:
+                self.finished = time.time()
+
+        self._thread = threading.Thread(target=_run, name='startup', daemon=True)
+        self._thread.start()
+
+    def run(self, target: Callable[['StartupProgress'], None]):
+        """
+        Run `target(self)` in the calling thread, errors are raised.
+        """
+        try:
+            target(self)
+        except Exception as e:
+            self.error = str(e)
+            raise
+        finally:
+            self.finished = time.time()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        """
+        Raise StartupCancelled once cancel() was called, between phases.
+        """
+        if self._cancelled.is_set():
+            raise StartupCancelled()
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self._ready()
+
+    def _ready(self) -> bool:
+        return self.finished is not None and not self.cancelled and self.error is None and all(
+            phase.state == READY for phase in self._phases.values() if phase.required)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                'ready': self._ready(),
+                'cancelled': self.cancelled,
+                'error': self.error,
+                'seconds': (self.finished or now) - self.started,
+                'components': {
+                    phase.name: {
+                        'state': phase.state,
+                        'required': phase.required,
+                        'seconds': now - phase.started if phase.state == LOADING else phase.seconds,
+                        'error': phase.error,
+                    }
+                    for phase in self._phases.values()
+                }
+            }
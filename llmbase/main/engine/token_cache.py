@@ -0,0 +1,105 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from transformers import PreTrainedTokenizer
+
+ROLES = ('system', 'user', 'assistant', 'observation')
+
+
+class ChatTemplateCache(object):
+    """
+    Build ChatGLM3 prompt ids at the id level instead of re-tokenizing the whole conversation.
+    Only the ChatGLM3 template is supported, ChatGLM4 and other tokenizers keep using the tokenizer itself.
+
+    Role markers and the [gMASK, sop] prefix are looked up once at startup. Text segments (message contents,
+    role metadata) are tokenized with the sentencepiece model and kept in an LRU keyed by a hash of the text,
+    so a multi-turn request only tokenizes the newest message and repeated system prompts cost nothing.
+    The result is identical to tokenizer.build_chat_input / tokenizer(build_chat_prompt(...)).
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, max_entries: int = 8192):
+        """
+        :param max_entries: 缓存的文本片段数上限
+        """
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.prefix_ids = list(tokenizer.get_prefix_tokens())
+        self.role_ids = {role: tokenizer.get_command(f'<|{role}|>') for role in ROLES}
+
+        self._lock = threading.Lock()
+        self._segments: OrderedDict = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def supports(tokenizer: PreTrainedTokenizer) -> bool:
+        """
+        Only the ChatGLM3 tokenizer (sentencepiece based) exposes the pieces needed to assemble prompts at the id
+        level. The ChatGLM4 tokenizer has helpers with the same names on top of tiktoken, with a different template,
+        so it is rejected here.
+        """
+        return all(hasattr(tokenizer, name) for name in ('get_command', 'get_prefix_tokens', 'build_single_message')) \
+            and hasattr(getattr(tokenizer, 'tokenizer', None), 'encode') \
+            and hasattr(tokenizer.tokenizer, 'sp_model')
+
+    def encode(self, text: str) -> Tuple[int, ...]:
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            token_ids = self._segments.get(key)
+            if token_ids is not None:
+                self._segments.move_to_end(key)
+                self._hits += 1
+                return token_ids
+            self._misses += 1
+        token_ids = tuple(self.tokenizer.tokenizer.encode(text))
+        with self._lock:
+            self._segments[key] = token_ids
+            while len(self._segments) > self.max_entries:
+                self._segments.popitem(last=False)
+        return token_ids
+
+    def build_single_message(self, role: str, metadata: str, message: str) -> List[int]:
+        """
+        Same ids as tokenizer.build_single_message.
+        """
+        return [self.role_ids[role], *self.encode(f"{metadata}\n"), *self.encode(message)]
+
+    def build_chat_input(self, query: str, history: List[dict] = None, role: str = 'user'):
+        """
+        Same output as tokenizer.build_chat_input.
+        """
+        input_ids = []
+        for item in history or []:
+            content = item['content']
+            if item['role'] == 'system' and 'tools' in item:
+                content = content + "\n" + json.dumps(item['tools'], indent=4, ensure_ascii=False)
+            input_ids.extend(self.build_single_message(item['role'], item.get('metadata', ''), content))
+        input_ids.extend(self.build_single_message(role, '', query))
+        input_ids.append(self.role_ids['assistant'])
+        return self.tokenizer.batch_encode_plus([input_ids], return_tensors="pt", is_split_into_words=True)
+
+    def build_chat_prompt_ids(self, messages: List[dict]) -> List[int]:
+        """
+        Same ids as tokenizer(build_chat_prompt(messages)) with encode_special_tokens.
+        """
+        input_ids = list(self.prefix_ids)
+        for message in messages:
+            role = 'observation' if message['role'] == 'function' else message['role']
+            input_ids.append(self.role_ids[role])
+            input_ids.extend(self.encode('\n' + message['content'] + '\n'))
+        input_ids.append(self.role_ids['assistant'])
+        return input_ids
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._segments),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+            }
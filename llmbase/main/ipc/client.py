@@ -0,0 +1,101 @@
+import asyncio
+from typing import AsyncIterator, Optional
+
+import orjson
+from fastapi import HTTPException
+
+from llmbase.main.ipc.protocol import REQUEST, RESULT, CHUNK, END, ERROR, read_frame, write_frame
+
+
+class EngineCall(object):
+    """
+    One request forwarded to the engine process. Either `result` (a complete JSON body) is set,
+    or the events are read with chunks(). close() cancels the request on the engine side.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self.result: Optional[bytes] = None
+        self._first_chunk: Optional[bytes] = None
+
+    @property
+    def streaming(self) -> bool:
+        return self.result is None
+
+    async def chunks(self) -> AsyncIterator[str]:
+        try:
+            chunk = self._first_chunk
+            while True:
+                yield chunk.decode()
+                kind, chunk = await read_frame(self._reader)
+                if kind == END:
+                    return
+                if kind == ERROR:
+                    raise _http_exception(chunk)
+        finally:
+            self.close()
+
+    def close(self):
+        self._writer.close()
+
+    async def _read_first(self):
+        kind, payload = await read_frame(self._reader)
+        if kind == ERROR:
+            raise _http_exception(payload)
+        if kind == RESULT:
+            self.result = payload
+        elif kind == CHUNK:
+            self._first_chunk = payload
+        else:
+            raise HTTPException(status_code=502, detail=f'unexpected frame {kind} from engine')
+
+
+class EngineClient(object):
+    """
+    Frontend side of the engine server, one Unix socket connection per request.
+    """
+
+    def __init__(self, socket_path: str, connect_timeout: float = 5.0):
+        self.socket_path = socket_path
+        self.connect_timeout = connect_timeout
+
+    async def open(self, method: str, body: bytes = b'') -> EngineCall:
+        """
+        Send a request and wait for the first frame, raises HTTPException for engine errors (e.g. 429).
+        Cancelling the awaiting task closes the connection, which cancels the request on the engine side.
+        """
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.socket_path),
+                                                    self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise HTTPException(status_code=503, detail=f'engine unavailable: {e}')
+        call = EngineCall(reader, writer)
+        try:
+            write_frame(writer, REQUEST, method.encode() + b'\n' + body)
+            await writer.drain()
+            await call._read_first()
+        except BaseException as e:
+            call.close()
+            if isinstance(e, (asyncio.IncompleteReadError, ConnectionError)):
+                raise HTTPException(status_code=502, detail='engine closed the connection')
+            raise
+        if not call.streaming:
+            call.close()
+        return call
+
+    async def call(self, method: str, body: bytes = b'') -> bytes:
+        """
+        Request with a complete JSON response.
+        """
+        call = await self.open(method, body)
+        if call.streaming:
+            call.close()
+            raise HTTPException(status_code=502, detail=f'unexpected stream from engine for {method}')
+        return call.result
+
+
+def _http_exception(payload: bytes) -> HTTPException:
+    error = orjson.loads(payload)
+    return HTTPException(status_code=error.get('status_code', 500), detail=error.get('detail'),
+                         headers=error.get('headers'))
@@ -0,0 +1,27 @@
+"""
+前端进程与引擎进程之间的帧格式: 1字节类型 + 4字节长度(大端) + 内容, 每个请求使用一条Unix socket连接
+
+前端 -> 引擎: REQUEST, 内容为 方法名 + '\n' + 请求体(JSON), 前端抽样计时的请求在方法名后加' timing'
+引擎 -> 前端: RESULT(完整的JSON响应) | CHUNK...END(SSE事件数据) | ERROR(JSON: status_code, detail, headers)
+前端关闭连接即取消请求
+"""
+import asyncio
+import struct
+from typing import Tuple
+
+REQUEST = 1
+RESULT = 2
+CHUNK = 3
+END = 4
+ERROR = 5
+
+_HEADER = struct.Struct('>BI')
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    kind, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return kind, (await reader.readexactly(length) if length else b'')
+
+
+def write_frame(writer: asyncio.StreamWriter, kind: int, payload: bytes = b''):
+    writer.writelines((_HEADER.pack(kind, len(payload)), payload))
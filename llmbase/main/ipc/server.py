@@ -0,0 +1,197 @@
+import asyncio
+import os
+from typing import Callable
+
+import orjson
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from sse_starlette.sse import EventSourceResponse
+from starlette.responses import Response
+
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import metrics, timing
+from llmbase.main.common.tool.logger import logger
+from llmbase.main.ipc.protocol import REQUEST, RESULT, CHUNK, END, ERROR, read_frame, write_frame
+from llmbase.main.llm.chatglm3.model import ChatCompletionRequest, EmbeddingRequest
+from llmbase.main.routers import openai
+from llmbase.main.services.chatglm4_service import ChatGLM4Service
+
+# 计入交互活动的方法, 后台批任务只在这些请求都结束后运行
+INTERACTIVE_METHODS = ('chat', 'embeddings')
+
+
+class _Connection(object):
+    """
+    Stands in for the starlette Request of the chat route: is_disconnected() turns true once the frontend
+    closed the connection.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self.closed = asyncio.Event()
+        self._watcher = asyncio.ensure_future(self._watch(reader))
+
+    async def _watch(self, reader: asyncio.StreamReader):
+        try:
+            # 请求之后前端不再发送数据, 读到EOF即断开
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        self.closed.set()
+
+    async def is_disconnected(self) -> bool:
+        return self.closed.is_set()
+
+    def close(self):
+        self._watcher.cancel()
+
+
+class EngineServer(object):
+    """
+    The single process that owns the model(s), serving the HTTP frontends over a Unix socket.
+
+    Requests go through the same routes as in the single process mode (admission, model routing, cancellation),
+    only the HTTP parsing and SSE encoding stay in the frontends. See llmbase.main.ipc.protocol.
+    """
+
+    def __init__(self, socket_path: str, startup: Callable[[], None] = None, shutdown: Callable[[], None] = None):
+        """
+        :param socket_path: Unix socket路径, 前端通过EngineClient连接
+        :param startup: 开始服务前调用, 例如设置线程池大小
+        :param shutdown: 停止服务后调用, 例如停止引擎线程
+        """
+        self.socket_path = socket_path
+        self._startup = startup
+        self._shutdown = shutdown
+        self._methods = {
+            'chat': self._chat,
+            'embeddings': self._embeddings,
+            'models': self._models,
+            'stats': self._stats,
+            'ready': self._ready,
+            'metrics': self._metrics,
+        }
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self._startup is not None:
+            self._startup()
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        logger.info(f'engine server listening on {self.socket_path}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self._shutdown is not None:
+                self._shutdown()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            kind, payload = await read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        method, _, body = payload.partition(b'\n')
+        method, _, flag = method.decode().partition(' ')
+        # 前端抽中的请求在引擎进程中分阶段计时, 结果写入引擎进程的日志
+        timer = timing.start(1.0, method) if flag == 'timing' else None
+        interactive = method in INTERACTIVE_METHODS and getattr(cosmos, 'activity_monitor', None) is not None
+        if interactive:
+            cosmos.activity_monitor.begin()
+        connection = _Connection(reader)
+        try:
+            handler = self._methods.get(method) if kind == REQUEST else None
+            if handler is None:
+                raise HTTPException(status_code=404, detail=f'unknown method {method}')
+            response = await handler(body, connection)
+            if isinstance(response, EventSourceResponse):
+                await self._stream(response, writer, connection)
+            else:
+                write_frame(writer, RESULT, _encode(response))
+        except HTTPException as e:
+            write_frame(writer, ERROR, orjson.dumps({'status_code': e.status_code, 'detail': e.detail,
+                                                     'headers': e.headers}))
+        except ValidationError as e:
+            write_frame(writer, ERROR, orjson.dumps({'status_code': 422, 'detail': e.errors(include_url=False)},
+                                                    default=str))
+        except Exception as e:
+            logger.exception(e)
+            write_frame(writer, ERROR, orjson.dumps({'status_code': 500, 'detail': str(e)}))
+        finally:
+            connection.close()
+            if interactive:
+                cosmos.activity_monitor.end()
+            if timer is not None:
+                record = timer.record()
+                logger.info(f'timing {orjson.dumps(record).decode()}', extra={'timing': record})
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    @staticmethod
+    async def _stream(response: EventSourceResponse, writer: asyncio.StreamWriter, connection: _Connection):
+        """
+        Forward the events of a streaming response, closing its iterator (which cancels the generation) when the
+        frontend goes away.
+        """
+        iterator = response.body_iterator
+
+        async def _forward():
+            async for item in iterator:
+                write_frame(writer, CHUNK, item.encode() if isinstance(item, str) else bytes(item))
+                await writer.drain()
+            write_frame(writer, END)
+
+        forward = asyncio.ensure_future(_forward())
+        closed = asyncio.ensure_future(connection.closed.wait())
+        try:
+            await asyncio.wait({forward, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if not forward.done():
+                forward.cancel()
+            try:
+                await forward
+            except (asyncio.CancelledError, ConnectionError):
+                pass
+        finally:
+            closed.cancel()
+            await iterator.aclose()
+
+    @staticmethod
+    async def _chat(body: bytes, connection: _Connection):
+        return await openai.create_chat_completion(ChatCompletionRequest.model_validate_json(body), connection)
+
+    @staticmethod
+    async def _embeddings(body: bytes, connection: _Connection):
+        return await openai.get_embeddings(EmbeddingRequest.model_validate_json(body))
+
+    @staticmethod
+    async def _models(body: bytes, connection: _Connection):
+        return openai.models()
+
+    @staticmethod
+    async def _stats(body: bytes, connection: _Connection):
+        return openai.stats()
+
+    @staticmethod
+    async def _ready(body: bytes, connection: _Connection):
+        # 状态码由前端按ready字段决定
+        return ChatGLM4Service.readiness()
+
+    @staticmethod
+    async def _metrics(body: bytes, connection: _Connection):
+        return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+def _encode(response) -> bytes:
+    if isinstance(response, Response):
+        return response.body
+    if isinstance(response, BaseModel):
+        return response.model_dump_json().encode()
+    return orjson.dumps(response, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
@@ -4,6 +4,25 @@ from llmbase.main import logger
 
 
 class LLM(object):
+    # 连续批处理引擎, 由get_asgi_app按ENGINE_CONFIG创建
+    engine = None
+    # 非流式请求的合并队列, 由get_asgi_app按MICRO_BATCH_CONFIG创建
+    micro_batcher = None
+    # 对话模板与文本片段的分词缓存, 见ChatTemplateCache
+    token_cache = None
+    # 批量编码embedding, 由get_asgi_app按EMBEDDING_CONFIG创建
+    embedding_encoder = None
+    # 创建该模型所用的LLM_CONFIG, 见ModelRegistry
+    llm_config: dict = None
+    # 数据并行的副本池(含本实例), 由LLM_CONFIG['replica_devices']创建, 见ReplicaPool
+    replicas = None
+
+    @property
+    def model_name(self) -> str:
+        """
+        LLM_CONFIG['name'], 未配置时为模型类的name; 用作指标的model标签
+        """
+        return (self.llm_config or {}).get('name') or self.name
 
     @staticmethod
     def get_pretrained_class(llm_config: dict):
@@ -14,6 +33,41 @@ class LLM(object):
         cls = getattr(module, llm_config.get('class'))
         return cls
 
+    @staticmethod
+    def load_components(loaders: dict, startup=None) -> dict:
+        """
+        Load independent components (tokenizer, embedding model, LLM) concurrently.
+        :param startup: StartupProgress, 记录每个组件的状态和耗时, 见/v1/ready
+        """
+        from llmbase.main.engine.startup import StartupProgress
+        return (startup or StartupProgress()).run_parallel(loaders)
+
+    @staticmethod
+    def from_config(llm_config: dict, token_cache_config: dict = None, device: str = None, startup=None):
+        """
+        :param device: 模型所在设备, 为None时由模型类决定
+        :param startup: StartupProgress, 启动时加载默认模型才传入
+        """
+        _llm_class = LLM.get_pretrained_class(llm_config=llm_config)
+        _kwargs = {}
+        if llm_config.get('shared_weights_path'):
+            # 仅ChatGLM3, ChatGLM4支持
+            _kwargs['shared_weights_path'] = llm_config.get('shared_weights_path')
+        llm = _llm_class(pretrained_model_name_or_path=llm_config.get('pretrained_model_path'),
+                         embedding_model_path=llm_config.get('embedding_model_path'),
+                         cuda_devices=llm_config.get('cuda_devices'),
+                         embedding_device=llm_config.get('embedding_device'),
+                         device=device, startup=startup, **_kwargs)
+        _token_cache_config = dict(token_cache_config or {})
+        if _token_cache_config.pop('enable', False):
+            from llmbase.main.engine.token_cache import ChatTemplateCache
+            if ChatTemplateCache.supports(llm.tokenizer):
+                llm.token_cache = ChatTemplateCache(llm.tokenizer, **_token_cache_config)
+            else:
+                logger.info(f'token cache only supports the ChatGLM3 tokenizer, '
+                            f'{type(llm.tokenizer).__name__} tokenizes the whole prompt')
+        return llm
+
 
 from llmbase.main.llm.chatglm3 import ChatGLM3
 from llmbase.main.llm.chatglm4 import ChatGLM4
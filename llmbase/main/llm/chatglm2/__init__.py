@@ -2,7 +2,7 @@ import os
 
 import torch
 from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoConfig
 
 from llmbase.main.llm import LLM
 
@@ -17,20 +17,34 @@ class ChatGLM2(LLM):
     model: AutoModel = None
     embedding: SentenceTransformer = None
 
-    def __init__(self, pretrained_model_name_or_path: str, embedding_model_path: str, cuda_devices: str = None):
+    def __init__(self, pretrained_model_name_or_path: str, embedding_model_path: str, cuda_devices: str = None,
+                 embedding_device: str = None, device: str = None, startup=None):
         """
         :param cuda_devices: 运行GPU编号, '0,1'
+        :param embedding_device: embedding模型所在设备(该模型未加载embedding模型)
+        :param device: 模型所在设备, 例如'cuda:1', 'cpu', 默认有GPU时用cuda
+        :param startup: StartupProgress, 记录tokenizer, model各自的加载状态和耗时
         """
         # 多GPU环境指定运行在哪个GPU
-        DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True)
-        if 'cuda' in DEVICE:  # AMD, NVIDIA GPU can use Half Precision
-            if cuda_devices:
-                # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
-                os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
-            model = AutoModel.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True).to(DEVICE).eval()
-        else:  # CPU, Intel GPU and other GPU can use Float16 Precision Only
-            model = AutoModel.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True).float().to(DEVICE).eval()
+        DEVICE = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        if 'cuda' in DEVICE and cuda_devices:
+            # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
+            os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
+        # 先解析一次远程代码, 避免并行加载时多个线程同时复制同一个动态模块文件
+        AutoConfig.from_pretrained(pretrained_model_name_or_path, trust_remote_code=True)
+
+        def _load_model():
+            if 'cuda' in DEVICE:  # AMD, NVIDIA GPU can use Half Precision
+                return AutoModel.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True).to(DEVICE)
+            # CPU, Intel GPU and other GPU can use Float16 Precision Only
+            return AutoModel.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True).float().to(DEVICE)
+
+        _components = LLM.load_components({
+            'tokenizer': lambda: AutoTokenizer.from_pretrained(pretrained_model_name_or_path=pretrained_model_name_or_path, trust_remote_code=True),
+            'model': _load_model,
+        }, startup=startup)
+        self.tokenizer = _components['tokenizer']
+        model = _components['model']
         # 多显卡支持，使用下面两行代替上面一行，将num_gpus改为你实际的显卡数量
         # from utils import load_model_on_gpus
         # model = load_model_on_gpus("THUDM/chatglm2-6b", num_gpus=2)
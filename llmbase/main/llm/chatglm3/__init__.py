@@ -1,11 +1,13 @@
+import json
 import os
 
 import torch
 from peft import AutoPeftModelForCausalLM
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoConfig
 from sentence_transformers import SentenceTransformer
 
 from llmbase.main.llm import LLM
+from llmbase.main.llm.shared_weights import load_shared_model
 
 
 class ChatGLM3(LLM):
@@ -18,40 +20,71 @@ class ChatGLM3(LLM):
     model: AutoModel = None
     embedding: SentenceTransformer = None
 
-    def __init__(self, pretrained_model_name_or_path: str, embedding_model_path: str, cuda_devices: str = None):
+    def __init__(self, pretrained_model_name_or_path: str, embedding_model_path: str, cuda_devices: str = None,
+                 embedding_device: str = None, device: str = None, shared_weights_path: str = None,
+                 startup=None):
         """
         :param cuda_devices: 运行GPU编号, '0,1'
+        :param embedding_device: embedding模型所在设备, 例如'cuda:1', 'cpu', 默认与模型相同
+        :param device: 模型所在设备, 例如'cuda:1', 'cpu', 默认有GPU时用cuda; 数据并行时每个副本一个设备
+        :param shared_weights_path: CPU推理时各工作进程以内存映射方式共享的权重目录, 见SharedWeights
+        :param startup: StartupProgress, 记录tokenizer, embedding, model各自的加载状态和耗时
         """
         # 多GPU环境指定运行在哪个GPU
-        DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-        if 'cuda' in DEVICE:  # AMD, NVIDIA GPU can use Half Precision
-            if cuda_devices:
-                # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
-                os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
-            if os.path.exists(os.path.join(pretrained_model_name_or_path, 'adapter_config.json')):
-                # 支持微调后模型
-                model = AutoPeftModelForCausalLM.from_pretrained(
-                    pretrained_model_name_or_path=pretrained_model_name_or_path,
-                    trust_remote_code=True).to(DEVICE).eval()
-                _tokenizer_dir = model.peft_config['default'].base_model_name_or_path
-            else:
+        DEVICE = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        if 'cuda' in DEVICE and cuda_devices:
+            # 须在加载线程初始化CUDA之前设置
+            # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
+            os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
+        _adapter_config = os.path.join(pretrained_model_name_or_path, 'adapter_config.json')
+        _peft = 'cuda' in DEVICE and os.path.exists(_adapter_config)
+        if _peft:
+            # 微调后模型的tokenizer在基础模型目录, 不必等模型加载完
+            with open(_adapter_config) as f:
+                _tokenizer_dir = json.load(f)['base_model_name_or_path']
+        else:
+            _tokenizer_dir = pretrained_model_name_or_path
+        # 先解析一次远程代码, 避免并行加载时多个线程同时复制同一个动态模块文件
+        AutoConfig.from_pretrained(_tokenizer_dir, trust_remote_code=True)
+
+        def _load_model():
+            if 'cuda' in DEVICE:  # AMD, NVIDIA GPU can use Half Precision
+                if _peft:
+                    # 支持微调后模型
+                    return AutoPeftModelForCausalLM.from_pretrained(
+                        pretrained_model_name_or_path=pretrained_model_name_or_path,
+                        trust_remote_code=True).to(DEVICE)
                 # 原始模型
-                model = AutoModel.from_pretrained(
+                return AutoModel.from_pretrained(
                     pretrained_model_name_or_path=pretrained_model_name_or_path,
-                    trust_remote_code=True).to(DEVICE).eval()
-                _tokenizer_dir = pretrained_model_name_or_path
-        else:  # CPU, Intel GPU and other GPU can use Float16 Precision Only
+                    trust_remote_code=True).to(DEVICE)
+            # CPU, Intel GPU and other GPU can use Float16 Precision Only
             # todo 支持微调后模型
-            model = AutoModel.from_pretrained(
+            if shared_weights_path:
+                # 权重只加载一次, 同机的工作进程共享同一份内存映射文件
+                return load_shared_model(
+                    shared_weights_path,
+                    load=lambda: AutoModel.from_pretrained(
+                        pretrained_model_name_or_path=pretrained_model_name_or_path,
+                        trust_remote_code=True).float(),
+                    build_empty=lambda: AutoModel.from_config(
+                        AutoConfig.from_pretrained(pretrained_model_name_or_path, trust_remote_code=True),
+                        trust_remote_code=True))
+            return AutoModel.from_pretrained(
                 pretrained_model_name_or_path=pretrained_model_name_or_path,
-                trust_remote_code=True).float().to(DEVICE).eval()
-            _tokenizer_dir = pretrained_model_name_or_path
-        # tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=_tokenizer_dir,
-                                                       trust_remote_code=True)
-        self.embedding = SentenceTransformer(embedding_model_path, device="cuda")
+                trust_remote_code=True).float().to(DEVICE)
+
+        # tokenizer, embedding模型和LLM互不依赖, 并行加载
+        _components = LLM.load_components({
+            'tokenizer': lambda: AutoTokenizer.from_pretrained(pretrained_model_name_or_path=_tokenizer_dir,
+                                                               trust_remote_code=True),
+            'embedding': lambda: SentenceTransformer(embedding_model_path, device=embedding_device or DEVICE),
+            'model': _load_model,
+        }, startup=startup)
+        self.tokenizer = _components['tokenizer']
+        self.embedding = _components['embedding']
         # 多显卡支持，使用下面两行代替上面一行，将num_gpus改为你实际的显卡数量
         # from utils import load_model_on_gpus
         # model = load_model_on_gpus("THUDM/chatglm3-6b", num_gpus=2)
         # 模型进入推理模式
-        self.model = model.eval()
+        self.model = _components['model'].eval()
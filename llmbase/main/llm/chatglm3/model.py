@@ -40,6 +40,10 @@ class DeltaMessage(BaseModel):
 class EmbeddingRequest(BaseModel):
     input: List[str]
     model: str
+    # float, base64与OpenAI相同; float16, int8(响应带scale字段), binary为扩展格式, 见embedding_codec
+    encoding_format: Optional[str] = "float"
+    # 截取前dimensions维并重新归一化
+    dimensions: Optional[int] = None
 
 
 class CompletionUsage(BaseModel):
@@ -76,6 +80,8 @@ class ChatCompletionRequest(BaseModel):
     tools: Optional[Union[dict, List[dict]]] = None
     repetition_penalty: Optional[float] = 1.1
     eos_token_ids: Optional[List[str]] = None
+    # 生成时间预算(秒), 超时后返回已生成的部分, finish_reason为length
+    timeout: Optional[float] = None
 
 
 class ChatCompletionResponseChoice(BaseModel):
@@ -0,0 +1,55 @@
+from json.encoder import encode_basestring
+from typing import Optional
+
+# 与pydantic的转义一致: 只转义引号、反斜杠和控制字符, 非ASCII字符原样输出
+_json_str = encode_basestring
+
+
+class ChatCompletionChunkEncoder(object):
+    """
+    Serialize chat.completion.chunk events of one stream without building pydantic models.
+
+    The envelope around the delta is rendered once per stream, each chunk only splices in the escaped text and
+    the finish_reason. The output is byte-for-byte what
+    ChatCompletionResponse(...).model_dump_json(exclude_unset=True) produces for the same chunk.
+    """
+
+    def __init__(self, model_id: str, chunk_id: str = ""):
+        self._prefix = '{"model":' + _json_str(model_id) + ',"id":' + _json_str(chunk_id) + \
+                       ',"object":"chat.completion.chunk","choices":[{"delta":'
+        self._suffixes = {}
+
+    def role(self, finish_reason: Optional[str] = None, created: int = None) -> str:
+        """
+        delta = DeltaMessage(role="assistant")
+        """
+        return self._prefix + '{"role":"assistant"}' + self._suffix(finish_reason, created)
+
+    def content(self, text: str, finish_reason: Optional[str] = None, created: int = None,
+                with_function_call: bool = True) -> str:
+        """
+        delta = DeltaMessage(content=text, role="assistant", function_call=None)
+
+        :param with_function_call: False时对应未设置function_call的DeltaMessage(role="assistant", content=text)
+        """
+        if with_function_call:
+            return self._prefix + '{"role":"assistant","content":' + _json_str(text) + ',"function_call":null}' + \
+                self._suffix(finish_reason, created)
+        return self._prefix + '{"role":"assistant","content":' + _json_str(text) + '}' + \
+            self._suffix(finish_reason, created)
+
+    def stop(self, finish_reason: str = "stop", created: int = None) -> str:
+        """
+        delta = DeltaMessage()
+        """
+        return self._prefix + '{}' + self._suffix(finish_reason, created)
+
+    def _suffix(self, finish_reason: Optional[str], created: Optional[int]) -> str:
+        suffix = self._suffixes.get(finish_reason)
+        if suffix is None:
+            suffix = ',"finish_reason":' + (_json_str(finish_reason) if finish_reason is not None else 'null') + \
+                     ',"index":0}]'
+            self._suffixes[finish_reason] = suffix
+        if created is None:
+            return suffix + '}'
+        return suffix + ',"created":' + str(created) + '}'
@@ -1,9 +1,18 @@
-import gc
 import json
+import time
+
 import torch
 from transformers import PreTrainedModel, PreTrainedTokenizer
-from transformers.generation.logits_process import LogitsProcessor
-from typing import Union, Tuple
+from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
+from transformers.generation.stopping_criteria import StoppingCriteriaList
+from typing import List, Union, Tuple
+
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import metrics, timing
+from llmbase.main.engine.control import GenerationControl, ControlStoppingCriteria
+from llmbase.main.engine.detokenizer import IncrementalDetokenizer
+from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+from llmbase.main.engine.token_cache import ChatTemplateCache
 
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
@@ -44,7 +53,12 @@ def process_response(output: str, use_tool: bool = False) -> Union[str, dict]:
 
 
 @torch.inference_mode()
-def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
+def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict,
+                             engine: ContinuousBatchingEngine = None, token_cache: ChatTemplateCache = None):
+    """
+    :param engine: 连续批处理引擎, 为None时在当前线程中单独调用model.stream_generate
+    :param token_cache: 按id拼接对话模板, 为None时由tokenizer.build_chat_input重新分词整个对话
+    """
     messages = params["messages"]
     tools = params["tools"]
     temperature = float(params.get("temperature", 1.0))
@@ -52,11 +66,16 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     top_p = float(params.get("top_p", 1.0))
     max_new_tokens = int(params.get("max_tokens", 256))
     echo = params.get("echo", True)
-    messages = process_chatglm_messages(messages, tools=tools)
-    query, role = messages[-1]["content"], messages[-1]["role"]
+    # 客户端断开时由路由取消, 超过截止时间时返回已生成的部分, 见GenerationControl
+    control: GenerationControl = params.get("control")
+    # 抽样请求的分阶段计时, 未抽中时为None
+    timer = timing.current()
+    with timing.phase("tokenize"):
+        messages = process_chatglm_messages(messages, tools=tools)
+        query, role = messages[-1]["content"], messages[-1]["role"]
 
-    inputs = tokenizer.build_chat_input(query, history=messages[:-1], role=role)
-    inputs = inputs.to(model.device)
+        inputs = (token_cache or tokenizer).build_chat_input(query, history=messages[:-1], role=role)
+        inputs = inputs.to(model.device)
     input_echo_len = len(inputs["input_ids"][0])
 
     if input_echo_len >= model.config.seq_length:
@@ -76,32 +95,55 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     }
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
+    control_criteria = None
+    if control is not None:
+        control_criteria = ControlStoppingCriteria(control)
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([control_criteria])
 
-    total_len = 0
-    for total_ids in model.stream_generate(**inputs, eos_token_id=eos_token_id, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        if echo:
-            output_ids = total_ids[:-1]
-        else:
-            output_ids = total_ids[input_echo_len:-1]
-
-        response = tokenizer.decode(output_ids)
-        if response and response[-1] != "�":
-            response, stop_found = apply_stopping_strings(response, ["<|observation|>"])
+    total_len = input_echo_len
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    response = ""
+    # 指标: 从请求到达(无control时从此处)开始计时
+    model_name = params.get("model_name") or "default"
+    started = control.created if control is not None else time.monotonic()
+    first_token = None
+    # 生成结束的原因, 由_stream_new_ids填写
+    outcome = {}
+    try:
+        for new_ids, total_len in _stream_new_ids(model, inputs, eos_token_id, gen_kwargs, echo, engine, control,
+                                                  timer, outcome):
+            if control is not None and control.cancelled:
+                break
+            if first_token is None and total_len > input_echo_len:
+                first_token = time.monotonic()
+            detokenize_start = time.monotonic() if timer is not None else None
+            delta = detokenizer.add_tokens(new_ids)
+            if delta:
+                # 只在新文本附近查找停止词
+                tail_start = max(0, len(detokenizer.text) - len(delta) - len("<|observation|>"))
+                tail, stop_found = apply_stopping_strings(detokenizer.text[tail_start:], ["<|observation|>"])
+                response = detokenizer.text[:tail_start] + tail
+                if timer is not None:
+                    timer.add("detokenize", time.monotonic() - detokenize_start)
 
-            yield {
-                "text": response,
-                "usage": {
-                    "prompt_tokens": input_echo_len,
-                    "completion_tokens": total_len - input_echo_len,
-                    "total_tokens": total_len,
-                },
-                "finish_reason": "function_call" if stop_found else None,
-            }
+                yield {
+                    "text": response,
+                    "usage": {
+                        "prompt_tokens": input_echo_len,
+                        "completion_tokens": total_len - input_echo_len,
+                        "total_tokens": total_len,
+                    },
+                    "finish_reason": "function_call" if stop_found else None,
+                }
 
-            if stop_found:
-                break
+                if stop_found:
+                    break
+    finally:
+        # 取消或被提前关闭时, 已生成的token不会再送达客户端
+        if control is not None and control.cancelled:
+            GenerationControl.record_wasted(max(0, total_len - input_echo_len))
+    if control_criteria is not None and control_criteria.deadline_reached:
+        outcome["finish_reason"] = "length"
 
     # Only last stream result contains finish_reason, we set finish_reason as stop
     ret = {
@@ -111,12 +153,98 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
             "completion_tokens": total_len - input_echo_len,
             "total_tokens": total_len,
         },
-        "finish_reason": "stop",
+        "finish_reason": "length" if outcome.get("finish_reason") == "length" else "stop",
     }
+    metrics.record_generation(model_name, started, first_token, time.monotonic(), total_len - input_echo_len)
+    metrics.record_tokens(model_name, "chat", input_echo_len, total_len - input_echo_len)
     yield ret
 
-    gc.collect()
-    torch.cuda.empty_cache()
+    _release_memory()
+
+
+def _stream_new_ids(model: PreTrainedModel, inputs, eos_token_id: list, gen_kwargs: dict, echo: bool,
+                    engine: ContinuousBatchingEngine = None, control: GenerationControl = None,
+                    timer: timing.PhaseTimer = None, outcome: dict = None):
+    """
+    Yield (new_ids, total_len) after every decoding step, either from the shared engine or from stream_generate.
+    With echo the prompt ids come first.
+    stream_generate stops through the stopping criteria in gen_kwargs; the engine sequence is cancelled by the
+    control directly, or when this generator is closed before the sequence finished.
+    :param timer: 记录queue, prefill, decode阶段; 不含调用方处理每批token的时间
+    :param outcome: 生成结束后写入finish_reason, 达到max_new_tokens或截止时间时为'length';
+                    stream_generate被截止时间截断时由调用方按ControlStoppingCriteria填写
+    """
+    input_ids = inputs["input_ids"][0].tolist()
+    input_echo_len = len(input_ids)
+    if echo:
+        yield input_ids, input_echo_len
+    if engine is None:
+        if control is not None and control.expired:
+            # 开始生成之前已超时, 与引擎中排队超时的序列相同
+            if outcome is not None:
+                outcome["finish_reason"] = "length"
+            return
+        # stream_generate每步返回全部id, 最后一个token在下一步才输出
+        emitted = total_len = input_echo_len
+        last_id = None
+        phase, mark = "prefill", time.monotonic()
+        for total_ids in model.stream_generate(**inputs, eos_token_id=eos_token_id, **gen_kwargs):
+            if timer is not None:
+                timer.add(phase, time.monotonic() - mark)
+                phase = "decode"
+            total_len = total_ids.shape[-1]
+            last_id = int(total_ids[0, -1])
+            yield total_ids[0, emitted:total_len - 1].tolist(), total_len
+            emitted = max(emitted, total_len - 1)
+            mark = time.monotonic()
+        # 用完max_new_tokens且最后一个token不是eos, 与引擎序列相同报告'length'
+        if (outcome is not None and last_id not in eos_token_id
+                and total_len - input_echo_len >= gen_kwargs["max_new_tokens"]):
+            outcome["finish_reason"] = "length"
+        return
+
+    seq = engine.submit(input_ids,
+                        max_new_tokens=gen_kwargs["max_new_tokens"],
+                        temperature=gen_kwargs.get("temperature", 0.0),
+                        top_p=gen_kwargs["top_p"],
+                        repetition_penalty=gen_kwargs["repetition_penalty"],
+                        eos_token_id=eos_token_id,
+                        deadline=control.deadline if control is not None else None)
+    if control is not None:
+        control.on_cancel(seq.cancel)
+    try:
+        for token_ids in seq.stream():
+            yield token_ids, input_echo_len + len(seq.output_ids)
+        if outcome is not None:
+            outcome["finish_reason"] = seq.finish_reason
+    finally:
+        if seq.finish_reason is None:
+            seq.cancel()
+        if timer is not None:
+            _record_phases(timer, seq)
+
+
+def _record_phases(timer: timing.PhaseTimer, seq):
+    """
+    Queue, prefill and decode time of an engine sequence from the times stamped by the engine thread.
+    """
+    end = seq.finished or time.monotonic()
+    if seq.prefill_started is None:
+        timer.add("queue", end - seq.submitted)
+        return
+    timer.add("queue", seq.prefill_started - seq.submitted)
+    if seq.prefill_finished is not None:
+        timer.add("prefill", seq.prefill_finished - seq.prefill_started)
+        timer.add("decode", end - seq.prefill_finished)
+
+
+def _release_memory():
+    """
+    Reclaim memory according to the configured policy, see MemoryManager.
+    """
+    memory_manager = getattr(cosmos, 'memory_manager', None)
+    if memory_manager is not None:
+        memory_manager.after_request()
 
 
 def process_chatglm_messages(messages, tools=None):
@@ -156,12 +284,155 @@ def process_chatglm_messages(messages, tools=None):
     return messages
 
 
-def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
-    for response in generate_stream_chatglm3(model, tokenizer, params):
+def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict,
+                      engine: ContinuousBatchingEngine = None, token_cache: ChatTemplateCache = None):
+    for response in generate_stream_chatglm3(model, tokenizer, params, engine=engine, token_cache=token_cache):
         pass
     return response
 
 
+def build_chat_prompt(messages: List[dict]) -> str:
+    """
+    Prompt of the batch paths, messages are dicts with role and content.
+    """
+    prompt = ''
+    for message in messages:
+        role = 'observation' if message['role'] == 'function' else message['role']
+        prompt += '<|' + role + '|>\n' + message['content'] + '\n'
+    return prompt + '<|assistant|>'
+
+
+def build_batch_input_ids(tokenizer: PreTrainedTokenizer, conversations: List[List[dict]],
+                          token_cache: ChatTemplateCache = None) -> List[List[int]]:
+    """
+    Prompt ids of the batch paths, one per conversation (see build_chat_prompt).
+    """
+    if token_cache is not None:
+        return [token_cache.build_chat_prompt_ids(messages) for messages in conversations]
+    tokenizer.encode_special_tokens = True
+    return tokenizer([build_chat_prompt(messages) for messages in conversations])["input_ids"]
+
+
+def batch_eos_token_id(tokenizer: PreTrainedTokenizer) -> List[int]:
+    return [
+        tokenizer.eos_token_id,
+        tokenizer.get_command('<|user|>'),
+        tokenizer.get_command('<|assistant|>')
+    ]
+
+
+def batch_gen_kwargs(tokenizer: PreTrainedTokenizer, temperature: float, top_p: float, repetition_penalty: float,
+                     max_tokens: int) -> dict:
+    """
+    model.generate parameters of a single-turn chat batch, sampling behaves like generate_stream_chatglm3.
+    """
+    gen_kwargs = {
+        "max_new_tokens": max_tokens,
+        "do_sample": temperature > 1e-5,
+        "top_p": top_p,
+        "repetition_penalty": repetition_penalty,
+        "logits_processor": LogitsProcessorList([InvalidScoreLogitsProcessor()]),
+        "eos_token_id": batch_eos_token_id(tokenizer),
+    }
+    if temperature > 1e-5:
+        gen_kwargs["temperature"] = temperature
+    return gen_kwargs
+
+
+def bucket_by_length(lengths: List[int], max_padding_ratio: float = None, max_bucket_size: int = None) \
+        -> List[List[int]]:
+    """
+    Split prompt indices into buckets of similar length.
+
+    Indices are sorted by length and a bucket is closed as soon as adding the next prompt would make the
+    padded positions exceed `max_padding_ratio` of the bucket, or the bucket holds `max_bucket_size` prompts.
+
+    :param lengths: 每个prompt的token数
+    :param max_padding_ratio: padding占比上限, None表示不限制
+    :param max_bucket_size: 每个桶最多的prompt数, None表示不限制
+    :return: 按长度升序排列的桶, 桶内是原始下标
+    """
+    buckets = []
+    bucket, bucket_tokens = [], 0
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if bucket:
+            padded = lengths[index] * (len(bucket) + 1)
+            waste = 1 - (bucket_tokens + lengths[index]) / padded if padded else 0.0
+            if (max_padding_ratio is not None and waste > max_padding_ratio) or \
+                    (max_bucket_size and len(bucket) >= max_bucket_size):
+                buckets.append(bucket)
+                bucket, bucket_tokens = [], 0
+        bucket.append(index)
+        bucket_tokens += lengths[index]
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+@torch.inference_mode()
+def generate_batch_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, encoded: List[List[int]],
+                            gen_kwargs: dict, max_padding_ratio: float = None, max_bucket_size: int = None,
+                            control: GenerationControl = None) -> List[dict]:
+    """
+    Run the prompts through padded model.generate calls, one per length bucket (see bucket_by_length).
+    Buckets run back to back, results come back in the order of `encoded`.
+
+    :param encoded: 已套用对话模板的prompt ids, 见build_batch_input_ids
+    :param gen_kwargs: 直接传给model.generate的参数
+    :param control: 取消或超时后不再处理剩余的桶, 这些prompt的结果为空文本, finish_reason为'length'
+    :return: 与encoded一一对应的结果, 格式同generate_chatglm3; 生成了eos的为'stop', 否则(达到长度上限或
+             被截止时间截断)为'length'
+    """
+    eos_token_id = gen_kwargs.get("eos_token_id")
+    eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple, set)) else [eos_token_id])
+    eos_token_ids.discard(None)
+    results = [None] * len(encoded)
+    for bucket in bucket_by_length([len(input_ids) for input_ids in encoded], max_padding_ratio, max_bucket_size):
+        if control is not None and (control.cancelled or control.expired):
+            for index in bucket:
+                results[index] = _empty_result(len(encoded[index]))
+            continue
+        batched_inputs = tokenizer.pad({"input_ids": [encoded[index] for index in bucket]}, padding="longest",
+                                       return_tensors="pt")
+        batched_inputs = batched_inputs.to(model.device)
+
+        batched_outputs = model.generate(**batched_inputs, **gen_kwargs)
+
+        for index, input_ids, attention_mask, output_ids in zip(bucket, batched_inputs.input_ids,
+                                                                batched_inputs.attention_mask, batched_outputs):
+            completion_ids = output_ids[len(input_ids):]
+            prompt_tokens = int(attention_mask.sum())
+            stop = next((position for position, token_id in enumerate(completion_ids.tolist())
+                         if token_id in eos_token_ids), None)
+            # 没有生成eos的行是被max_new_tokens/max_length或stopping criteria截断的
+            stopped = not eos_token_ids or stop is not None
+            if stop is not None:
+                completion_tokens = stop + 1
+                # eos之后是与同批较长的行对齐的padding, 与单条生成一样只解码eos之前的token
+                completion_ids = completion_ids[:stop]
+            else:
+                completion_tokens = int((completion_ids != tokenizer.pad_token_id).sum())
+            results[index] = {
+                "text": tokenizer.decode(completion_ids),
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "finish_reason": "stop" if stopped else "length",
+            }
+    _release_memory()
+    return results
+
+
+def _empty_result(prompt_tokens: int) -> dict:
+    return {
+        "text": "",
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 0, "total_tokens": prompt_tokens},
+        "finish_reason": "length",
+    }
+
+
 def apply_stopping_strings(reply, stop_strings) -> Tuple[str, bool]:
     stop_found = False
     for string in stop_strings:
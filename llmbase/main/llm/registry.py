@@ -0,0 +1,301 @@
+import gc
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+from llmbase.main import logger
+
+LOADED = 'loaded'
+OFFLOADED = 'offloaded'
+UNLOADED = 'unloaded'
+# 估算显存占用时计入的权重文件
+WEIGHT_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth')
+
+
+class ModelNotFound(KeyError):
+    """
+    The request names a model the registry does not know.
+    """
+
+
+class ModelEntry(object):
+    """
+    One model of the registry, its LLM is created on first use.
+    """
+
+    def __init__(self, name: str, llm_config: dict, llm=None, pinned: bool = False):
+        self.name = name
+        self.llm_config = llm_config
+        self.llm = llm
+        self.pinned = pinned
+        self.state = LOADED if llm is not None else UNLOADED
+        # 模型权重占用的显存(字节), 首次加载前按配置的memory_bytes或权重文件大小估算,
+        # 加载后为实际大小
+        self.nbytes = _model_bytes(llm) if llm is not None else int(
+            llm_config.get('memory_bytes') or _checkpoint_bytes(llm_config.get('pretrained_model_path')))
+        # 移到CPU前各副本所在的设备
+        self.devices = []
+        self.refs = 0
+        self.last_used = time.time()
+        # 加载/恢复/淘汰该模型时持有
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.last_load_seconds = 0.0
+        self.evictions = 0
+        self.evict_seconds = 0.0
+
+
+class Lease(object):
+    """
+    Use of one model by one request, the model is not evicted while leased. release() is idempotent.
+    """
+    __slots__ = ('registry', 'entry', 'released')
+
+    def __init__(self, registry: 'ModelRegistry', entry: ModelEntry):
+        self.registry = registry
+        self.entry = entry
+        self.released = False
+
+    @property
+    def llm(self):
+        return self.entry.llm
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.registry._release(self.entry)
+
+
+class ModelRegistry(object):
+    """
+    Several models in one process, routed by the `model` field of the request.
+
+    Models are loaded on first use. When the weights of the resident models would exceed `max_memory`, the least
+    recently used idle models are offloaded to CPU memory ('offload', restored with .to(device) on next use) or
+    released completely ('unload'). Pinned models (the default one) are never evicted. An unknown model name
+    raises ModelNotFound unless `fallback_to_default` is set, then it is served by the default model.
+    """
+
+    def __init__(self, load: Callable[[dict], object], attach: Callable[[object], None],
+                 detach: Callable[[object], None], max_memory: int = None, eviction: str = 'offload',
+                 fallback_to_default: bool = False):
+        """
+        :param load: 按模型配置创建LLM并初始化引擎等运行时组件
+        :param attach: 模型恢复到GPU后重新创建运行时组件
+        :param detach: 淘汰模型前停止运行时组件
+        :param max_memory: 常驻模型权重的显存上限(字节), None表示不限制
+        :param eviction: 'offload'移到CPU内存, 'unload'完全释放
+        :param fallback_to_default: 未知的模型名由默认模型处理, 否则抛出ModelNotFound
+        """
+        if eviction not in ('offload', 'unload'):
+            raise ValueError(f'unknown eviction {eviction}')
+        self._load = load
+        self._attach = attach
+        self._detach = detach
+        self.max_memory = max_memory
+        self.eviction = eviction
+        self.fallback_to_default = fallback_to_default
+        self.default: Optional[str] = None
+        self._entries: Dict[str, ModelEntry] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, llm_config: dict, llm=None, pinned: bool = False, default: bool = False):
+        """
+        :param llm: 已加载的LLM, 例如启动时加载的默认模型
+        """
+        with self._lock:
+            self._entries[name] = ModelEntry(name, llm_config, llm=llm, pinned=pinned)
+            if default or self.default is None:
+                self.default = name
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+
+    def resolve(self, name: Optional[str], fallback_to_default: bool = None) -> ModelEntry:
+        """
+        :param name: 模型名, 为空时使用默认模型
+        :param fallback_to_default: 覆盖构造时的同名参数
+        """
+        if fallback_to_default is None:
+            fallback_to_default = self.fallback_to_default
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                return entry
+            if name and not fallback_to_default:
+                raise ModelNotFound(name)
+            return self._entries[self.default]
+
+    def acquire(self, name: Optional[str], fallback_to_default: bool = None) -> Lease:
+        """
+        Make the model resident (loading or restoring it if needed) and lease it, blocks while loading.
+        """
+        entry = self.resolve(name, fallback_to_default)
+        with entry.lock:
+            with self._lock:
+                entry.refs += 1
+                entry.last_used = time.time()
+            if entry.state != LOADED:
+                try:
+                    self._make_resident(entry)
+                except BaseException:
+                    with self._lock:
+                        entry.refs -= 1
+                    raise
+        return Lease(self, entry)
+
+    def shutdown(self):
+        """
+        Stop the runtime of every resident model that is not pinned.
+        """
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if entry.state == LOADED and not entry.pinned]
+        for entry in entries:
+            for member in _members(entry.llm):
+                self._detach(member)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'default': self.default,
+                'max_memory': self.max_memory,
+                'resident_bytes': self._resident_bytes(),
+                'models': {
+                    entry.name: {
+                        'state': entry.state,
+                        'pinned': entry.pinned,
+                        'bytes': entry.nbytes,
+                        'inflight': entry.refs,
+                        'loads': entry.loads,
+                        'avg_load_seconds': entry.load_seconds / entry.loads if entry.loads else 0.0,
+                        'last_load_seconds': entry.last_load_seconds,
+                        'evictions': entry.evictions,
+                        'avg_evict_seconds': entry.evict_seconds / entry.evictions if entry.evictions else 0.0,
+                    }
+                    for entry in self._entries.values()
+                }
+            }
+
+    def _release(self, entry: ModelEntry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.time()
+
+    def _resident_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values() if entry.state == LOADED)
+
+    def _make_resident(self, entry: ModelEntry):
+        """
+        Called with entry.lock held.
+        """
+        self._reserve(entry, entry.nbytes)
+        start = time.time()
+        if entry.state == OFFLOADED:
+            logger.info(f'restoring model {entry.name} to {entry.devices}')
+            for member, device in zip(_members(entry.llm), entry.devices):
+                member.model.to(device)
+                self._attach(member)
+        else:
+            logger.info(f'loading model {entry.name}')
+            entry.llm = self._load(entry.llm_config)
+            entry.nbytes = _model_bytes(entry.llm)
+        seconds = time.time() - start
+        with self._lock:
+            entry.state = LOADED
+            entry.loads += 1
+            entry.load_seconds += seconds
+            entry.last_load_seconds = seconds
+        logger.info(f'model {entry.name} resident after {seconds:.2f}s, {entry.nbytes / 1024 ** 3:.2f}GiB')
+        # 首次加载前的大小是估算的, 加载后再按实际大小检查一次
+        self._reserve(entry, 0)
+
+    def _reserve(self, entry: ModelEntry, nbytes: int):
+        """
+        Evict idle models, least recently used first, until `nbytes` more fit into max_memory.
+        """
+        if self.max_memory is None:
+            return
+        while True:
+            with self._lock:
+                if self._resident_bytes() + nbytes <= self.max_memory:
+                    return
+                victims = sorted((other for other in self._entries.values()
+                                  if other is not entry and other.state == LOADED and not other.pinned
+                                  and other.refs == 0), key=lambda other: other.last_used)
+            if not any(self._try_evict(victim) for victim in victims):
+                logger.warning(f'model memory budget exceeded, no idle model to evict for {entry.name}')
+                return
+
+    def _try_evict(self, entry: ModelEntry) -> bool:
+        # 正在被加载或获取的模型跳过
+        if not entry.lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                if entry.refs or entry.state != LOADED:
+                    return False
+            start = time.time()
+            members = _members(entry.llm)
+            for member in members:
+                self._detach(member)
+            if self.eviction == 'offload' and not any(_is_dispatched(member.model) for member in members):
+                entry.devices = [next(member.model.parameters()).device for member in members]
+                for member in members:
+                    member.model.to('cpu')
+                state = OFFLOADED
+            else:
+                # 多卡切分(device_map)的模型无法整体移动, 直接释放
+                entry.llm = None
+                state = UNLOADED
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            seconds = time.time() - start
+            with self._lock:
+                entry.state = state
+                entry.evictions += 1
+                entry.evict_seconds += seconds
+            logger.info(f'model {entry.name} {state} after {seconds:.2f}s')
+            return True
+        finally:
+            entry.lock.release()
+
+
+def _members(llm) -> list:
+    """
+    The LLM and its data parallel replicas, see ReplicaPool.
+    """
+    return llm.replicas.llms if getattr(llm, 'replicas', None) is not None else [llm]
+
+
+def _model_bytes(llm) -> int:
+    return sum(tensor.numel() * tensor.element_size()
+               for member in _members(llm)
+               for tensor in list(member.model.parameters()) + list(member.model.buffers()))
+
+
+def _checkpoint_bytes(path: Optional[str]) -> int:
+    """
+    Size of the weight files of a local checkpoint, with the base model of a PEFT adapter, 0 when unknown.
+    """
+    if not path or not os.path.isdir(path):
+        return 0
+    nbytes = sum(entry.stat().st_size for entry in os.scandir(path)
+                 if entry.is_file() and entry.name.endswith(WEIGHT_SUFFIXES))
+    adapter_config = os.path.join(path, 'adapter_config.json')
+    if os.path.exists(adapter_config):
+        with open(adapter_config, encoding='utf-8') as f:
+            base_path = json.load(f).get('base_model_name_or_path')
+        if base_path and os.path.abspath(base_path) != os.path.abspath(path):
+            nbytes += _checkpoint_bytes(base_path)
+    return nbytes
+
+
+def _is_dispatched(model) -> bool:
+    return len(set((getattr(model, 'hf_device_map', None) or {}).values())) > 1
@@ -0,0 +1,141 @@
+import threading
+import time
+from typing import List, Tuple
+
+BALANCE_POLICIES = ('tokens', 'requests')
+
+
+class Replica(object):
+    """
+    One copy of the model on one device, counters are guarded by the pool lock.
+    """
+
+    def __init__(self, index: int, llm, device: str):
+        self.index = index
+        self.llm = llm
+        self.device = device
+        self.inflight_requests = 0
+        self.inflight_tokens = 0
+        self.served = 0
+        self.served_tokens = 0
+        self.busy_seconds = 0.0
+        self._busy_since = None
+
+
+class ReplicaLease(object):
+    """
+    Work of `cost` tokens dispatched to one replica, release() is idempotent.
+    """
+    __slots__ = ('pool', 'replica', 'cost', 'released')
+
+    def __init__(self, pool: 'ReplicaPool', replica: Replica, cost: int):
+        self.pool = pool
+        self.replica = replica
+        self.cost = cost
+        self.released = False
+
+    @property
+    def llm(self):
+        return self.replica.llm
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._release(self)
+
+
+class ReplicaPool(object):
+    """
+    Data parallel copies of one model, one per device, each with its own engine and micro batcher.
+
+    Every request goes to the least-loaded replica, measured by in-flight estimated tokens ('tokens') or by
+    in-flight requests ('requests'). Multi-prompt requests are split across replicas with split().
+    """
+
+    def __init__(self, llms: list, devices: List[str], balance: str = 'tokens'):
+        """
+        :param llms: 各副本的LLM, 第一个为对外的主实例
+        :param devices: 各副本所在设备
+        :param balance: 'tokens'按在途token估计量, 'requests'按在途请求数(队列深度)选择副本
+        """
+        if balance not in BALANCE_POLICIES:
+            raise ValueError(f'unknown balance policy {balance}')
+        self.replicas = [Replica(index, llm, device) for index, (llm, device) in enumerate(zip(llms, devices))]
+        self.balance = balance
+        self._lock = threading.Lock()
+        self._created = time.time()
+
+    @property
+    def llms(self) -> list:
+        return [replica.llm for replica in self.replicas]
+
+    def acquire(self, cost: int) -> ReplicaLease:
+        with self._lock:
+            replica = min(self.replicas, key=self._load)
+            return self._lease(replica, cost)
+
+    def split(self, costs: List[int]) -> List[Tuple[ReplicaLease, List[int]]]:
+        """
+        Assign items to replicas, largest first to the replica with the least projected load.
+
+        :param costs: 每个条目的token估计量
+        :return: [(副本租约, 分配到该副本的条目下标)], 不含未分配到条目的副本
+        """
+        with self._lock:
+            projected = [self._load(replica) for replica in self.replicas]
+            assigned = [[] for _ in self.replicas]
+            for index in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+                target = min(range(len(self.replicas)), key=lambda r: projected[r])
+                assigned[target].append(index)
+                if self.balance == 'tokens':
+                    projected[target] = (projected[target][0] + costs[index], projected[target][1] + 1)
+                else:
+                    projected[target] = (projected[target][0] + 1, projected[target][1] + costs[index])
+            return [(self._lease(self.replicas[r], sum(costs[i] for i in indices)), sorted(indices))
+                    for r, indices in enumerate(assigned) if indices]
+
+    def stats(self) -> dict:
+        now = time.time()
+        uptime = max(now - self._created, 1e-9)
+        with self._lock:
+            return {
+                'balance': self.balance,
+                'replicas': [{
+                    'device': replica.device,
+                    'inflight_requests': replica.inflight_requests,
+                    'inflight_tokens': replica.inflight_tokens,
+                    'served': replica.served,
+                    'served_tokens': replica.served_tokens,
+                    'utilization': self._busy_seconds(replica, now) / uptime,
+                } for replica in self.replicas]
+            }
+
+    def _load(self, replica: Replica) -> tuple:
+        if self.balance == 'tokens':
+            return replica.inflight_tokens, replica.inflight_requests
+        return replica.inflight_requests, replica.inflight_tokens
+
+    def _lease(self, replica: Replica, cost: int) -> ReplicaLease:
+        if replica.inflight_requests == 0:
+            replica._busy_since = time.time()
+        replica.inflight_requests += 1
+        replica.inflight_tokens += cost
+        return ReplicaLease(self, replica, cost)
+
+    def _release(self, lease: ReplicaLease):
+        with self._lock:
+            replica = lease.replica
+            replica.inflight_requests -= 1
+            replica.inflight_tokens -= lease.cost
+            replica.served += 1
+            replica.served_tokens += lease.cost
+            if replica.inflight_requests == 0 and replica._busy_since is not None:
+                replica.busy_seconds += time.time() - replica._busy_since
+                replica._busy_since = None
+
+    @staticmethod
+    def _busy_seconds(replica: Replica, now: float) -> float:
+        busy = replica.busy_seconds
+        if replica._busy_since is not None:
+            busy += now - replica._busy_since
+        return busy
@@ -0,0 +1,124 @@
+import fcntl
+import gc
+import json
+import os
+from contextlib import contextmanager
+from typing import Callable
+
+import torch
+
+from llmbase.main import logger
+
+# 每个张量的起始偏移按64字节对齐, 保证可以按任意dtype视图访问
+_ALIGNMENT = 64
+
+
+class SharedWeights(object):
+    """
+    Model weights materialized once into one flat file, mapped copy-on-write (MAP_PRIVATE) by every worker.
+
+    Pages of the file live in the page cache only once, so the resident memory of N workers stays roughly that of
+    one copy. Layout: weights.bin holds every parameter and buffer at an aligned offset, index.json lists
+    (name, kind, dtype, shape, offset, nbytes); tied tensors share one offset.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: 存放权重文件的目录, 建议使用/dev/shm下的目录
+        """
+        self.path = path
+        self.data_path = os.path.join(path, 'weights.bin')
+        self.index_path = os.path.join(path, 'index.json')
+        self._lock_path = os.path.join(path, 'lock')
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive across processes, the first worker materializes while the others wait.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def materialize(self, model: torch.nn.Module):
+        entries, offsets, total = [], {}, 0
+        tensors = [('parameter', name, tensor) for name, tensor in model.named_parameters(remove_duplicate=False)]
+        tensors += [('buffer', name, tensor) for name, tensor in model.named_buffers(remove_duplicate=False)]
+        with open(self.data_path, 'wb') as f:
+            for kind, name, tensor in tensors:
+                if tensor is None:
+                    continue
+                tensor = tensor.detach()
+                nbytes = tensor.numel() * tensor.element_size()
+                key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+                offset = offsets.get(key) if nbytes else 0
+                if offset is None:
+                    # 共享的张量(例如绑定的词嵌入)只写一次
+                    offset = offsets[key] = total
+                    f.seek(offset)
+                    f.write(tensor.cpu().contiguous().view(-1).view(torch.uint8).numpy().data)
+                    total = (offset + nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+                entries.append({'name': name, 'kind': kind, 'dtype': str(tensor.dtype).split('.')[-1],
+                                'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes})
+            f.truncate(max(total, 1))
+        # 索引最后写入, 存在即表示权重文件完整
+        _tmp_path = self.index_path + '.tmp'
+        with open(_tmp_path, 'w') as f:
+            json.dump({'total': max(total, 1), 'tensors': entries}, f)
+        os.replace(_tmp_path, self.index_path)
+        logger.info(f'materialized {len(offsets)} tensors, {total / 1024 ** 3:.2f}GiB into {self.data_path}')
+
+    def attach(self, model: torch.nn.Module) -> torch.nn.Module:
+        """
+        Point every parameter and buffer of `model` (usually built on the meta device) at the mapped file.
+        """
+        with open(self.index_path) as f:
+            index = json.load(f)
+        flat = torch.from_file(self.data_path, shared=False, size=index['total'], dtype=torch.uint8)
+        for entry in index['tensors']:
+            dtype = getattr(torch, entry['dtype'])
+            if entry['nbytes']:
+                tensor = flat[entry['offset']:entry['offset'] + entry['nbytes']].view(dtype).view(entry['shape'])
+            else:
+                tensor = torch.empty(entry['shape'], dtype=dtype)
+            module_name, _, attr = entry['name'].rpartition('.')
+            module = model.get_submodule(module_name)
+            if entry['kind'] == 'parameter':
+                module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[attr] = tensor
+        missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+                   if tensor.is_meta]
+        if missing:
+            raise RuntimeError(f'tensors missing from {self.index_path}: {missing[:5]}')
+        return model
+
+
+def load_shared_model(path: str, load: Callable[[], torch.nn.Module],
+                      build_empty: Callable[[], torch.nn.Module]) -> torch.nn.Module:
+    """
+    Load a model whose weights are shared by all worker processes of this host, see SharedWeights.
+
+    :param path: 权重文件目录
+    :param load: 正常加载模型, 只有第一个工作进程调用一次
+    :param build_empty: 按配置创建模型结构, 在meta设备上执行, 不分配权重内存
+    """
+    store = SharedWeights(path)
+    with store.lock():
+        if not store.exists():
+            model = load()
+            store.materialize(model)
+            del model
+            gc.collect()
+    from accelerate import init_empty_weights
+    with init_empty_weights():
+        model = build_empty()
+    logger.info(f'attaching shared weights from {path}')
+    return store.attach(model)
@@ -0,0 +1,43 @@
+from fastapi import APIRouter, File, Form, UploadFile
+from fastapi.responses import FileResponse
+
+from llmbase.main.common.dto.req.batch import BatchCreateRequest
+from llmbase.main.common.dto.res.batch import BatchList, BatchObject, FileObject
+from llmbase.main.services.batch_api_service import BatchApiService
+
+router = APIRouter(prefix="/v1")
+
+
+@router.post("/files", response_model=FileObject)
+def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+    return BatchApiService.create_file(file, purpose)
+
+
+@router.get("/files/{file_id}", response_model=FileObject)
+def retrieve_file(file_id: str):
+    return BatchApiService.retrieve_file(file_id)
+
+
+@router.get("/files/{file_id}/content")
+def retrieve_file_content(file_id: str):
+    return FileResponse(BatchApiService.file_content_path(file_id), media_type="application/jsonl")
+
+
+@router.post("/batches", response_model=BatchObject)
+def create_batch(request: BatchCreateRequest):
+    return BatchApiService.create_batch(request)
+
+
+@router.get("/batches", response_model=BatchList)
+def list_batches(after: str = None, limit: int = 20):
+    return BatchApiService.list_batches(after=after, limit=limit)
+
+
+@router.get("/batches/{batch_id}", response_model=BatchObject)
+def retrieve_batch(batch_id: str):
+    return BatchApiService.retrieve_batch(batch_id)
+
+
+@router.post("/batches/{batch_id}/cancel", response_model=BatchObject)
+def cancel_batch(batch_id: str):
+    return BatchApiService.cancel_batch(batch_id)
@@ -0,0 +1,81 @@
+import asyncio
+
+import orjson
+from fastapi import APIRouter, HTTPException, Request, Response
+from sse_starlette.sse import EventSourceResponse
+
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import metrics, timing
+from llmbase.main.ipc.client import EngineCall
+from llmbase.main.llm.chatglm3.model import (EmbeddingResponse, EmbeddingRequest, ModelList,
+                                             ChatCompletionResponse, ChatCompletionRequest)
+
+# 前后端分离模式下的路由: 在前端进程中完成HTTP解析、校验和SSE编码, 生成和embedding请求转发给引擎进程(EngineServer)
+router = APIRouter(prefix="/v1")
+metrics_router = APIRouter()
+
+
+@router.get("/health")
+async def health() -> Response:
+    """Health check."""
+    return Response(status_code=200)
+
+
+@router.get("/ready")
+async def ready() -> Response:
+    """Readiness of the engine process, 503 while it is loading or unreachable."""
+    try:
+        body = await cosmos.engine_client.call('ready')
+    except HTTPException as e:
+        body = orjson.dumps({'ready': False, 'components': {'engine': {'state': 'unavailable', 'error': e.detail}}})
+    return Response(content=body, status_code=200 if orjson.loads(body).get('ready') else 503,
+                    media_type="application/json")
+
+
+@router.post("/embeddings", response_model=EmbeddingResponse)
+async def get_embeddings(request: EmbeddingRequest, raw_request: Request):
+    # 校验通过后原样转发请求体, 引擎进程不再经过HTTP解析
+    with timing.phase('engine'):
+        return _json(await cosmos.engine_client.call(_method('embeddings'), await raw_request.body()))
+
+
+@router.get("/models", response_model=ModelList)
+async def models():
+    return _json(await cosmos.engine_client.call('models'))
+
+
+@router.get("/stats")
+async def stats():
+    return _json(await cosmos.engine_client.call('stats'))
+
+
+@router.post("/chat/completions", response_model=ChatCompletionResponse)
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    opening = asyncio.ensure_future(cosmos.engine_client.open(_method('chat'), await raw_request.body()))
+    # 非流式请求生成期间客户端断开时关闭到引擎的连接, 引擎随之取消生成; 流式请求的engine阶段到第一个事件为止
+    with timing.phase('engine'):
+        while not opening.done():
+            await asyncio.wait({opening}, timeout=0.5)
+            if not opening.done() and await raw_request.is_disconnected():
+                opening.cancel()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    call: EngineCall = opening.result()
+    if not call.streaming:
+        return _json(call.result)
+    return EventSourceResponse(call.chunks(), media_type="text/event-stream")
+
+
+@metrics_router.get("/metrics")
+async def render_metrics() -> Response:
+    return Response(content=await cosmos.engine_client.call('metrics'), media_type=metrics.CONTENT_TYPE)
+
+
+def _method(method: str) -> str:
+    """
+    Ask the engine to time the phases of a request sampled by the middleware of this frontend.
+    """
+    return f'{method} timing' if timing.current() is not None else method
+
+
+def _json(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
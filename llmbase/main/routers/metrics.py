@@ -0,0 +1,11 @@
+from fastapi import APIRouter, Response
+
+from llmbase.main.common.tool import metrics
+
+# Prometheus抓取的指标, 不在/v1下
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def render_metrics() -> Response:
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
@@ -1,7 +1,17 @@
-from fastapi import APIRouter, Response
+import asyncio
+import time
+
+import orjson
+from fastapi import APIRouter, HTTPException, Request, Response
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
 
 from llmbase.main.llm.chatglm3.model import (EmbeddingResponse, EmbeddingRequest, ModelList,
                                              ChatCompletionResponse, ChatCompletionRequest)
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import metrics, timing
+from llmbase.main.engine.control import GenerationControl
+from llmbase.main.engine.executor import QueueFullError
 from llmbase.main.services.chatglm4_service import ChatGLM4Service
 
 router = APIRouter(prefix="/v1")
@@ -13,18 +23,130 @@ async def health() -> Response:
     return Response(status_code=200)
 
 
+@router.get("/ready")
+def ready() -> Response:
+    """Readiness: 200 once every component is loaded, 503 before that, with the state of each component."""
+    readiness = ChatGLM4Service.readiness()
+    return Response(content=orjson.dumps(readiness), status_code=200 if readiness['ready'] else 503,
+                    media_type="application/json")
+
+
 @router.post("/embeddings", response_model=EmbeddingResponse)
-def get_embeddings(request: EmbeddingRequest):
-    return ChatGLM4Service.get_embeddings(request)
+async def get_embeddings(request: EmbeddingRequest):
+    started = time.monotonic()
+    status = 500
+    holds = []
+    try:
+        ChatGLM4Service.require_ready()
+        holds.append(ChatGLM4Service.admit(request))
+        llm, _holds = await run_in_threadpool(ChatGLM4Service.route, request)
+        holds.extend(_holds)
+        # 在独立线程池中执行, 不占用生成请求所在的默认线程池
+        response = await cosmos.embedding_executor.run(ChatGLM4Service.get_embeddings, request, llm)
+        status = 200
+        return response
+    except QueueFullError as e:
+        status = 503
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        _release(*holds)
+        _observe('embeddings', started, status)
 
 
 @router.get("/models", response_model=ModelList)
 def models():
+    ChatGLM4Service.require_ready()
     return ChatGLM4Service.models()
 
 
+@router.get("/stats")
+def stats():
+    return ChatGLM4Service.stats()
+
+
 @router.post("/chat/completions", response_model=ChatCompletionResponse)
-def create_chat_completion(request: ChatCompletionRequest):
-    if len(request.messages) > 1:
-        return ChatGLM4Service.create_batch_completion(request)
-    return ChatGLM4Service.create_chat_completion(request)
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    started = time.monotonic()
+    try:
+        ChatGLM4Service.require_ready()
+        # 客户端断开后停止生成, 释放引擎中的位置; 截止时间从请求到达时开始计算
+        control = GenerationControl(timeout=ChatGLM4Service.timeout(request))
+        ticket = ChatGLM4Service.admit(request)
+    except HTTPException as e:
+        _observe('chat', started, e.status_code)
+        raise
+    holds = []
+    watcher = asyncio.ensure_future(_cancel_on_disconnect(raw_request, control))
+    try:
+        # 按model路由到模型及其负载最低的副本, 未加载的模型在此加载
+        llm, holds = await run_in_threadpool(ChatGLM4Service.route, request)
+        if len(request.messages) > 1:
+            response = await run_in_threadpool(ChatGLM4Service.create_batch_completion, request, control, llm)
+        else:
+            response = await run_in_threadpool(ChatGLM4Service.create_chat_completion, request, control, llm)
+    except BaseException as e:
+        _release(ticket, *holds)
+        _observe('chat', started, e.status_code if isinstance(e, HTTPException) else 500)
+        raise
+    finally:
+        watcher.cancel()
+    return _finish_when_done(response, control, ticket, *holds)
+
+
+async def _cancel_on_disconnect(raw_request: Request, control: GenerationControl, interval: float = 0.5):
+    """
+    Poll the connection while a non-streaming completion is being generated.
+    """
+    while not control.cancelled:
+        if await raw_request.is_disconnected():
+            control.cancel()
+            return
+        await asyncio.sleep(interval)
+
+
+def _observe(endpoint: str, started: float, status: int):
+    metrics.REQUEST_DURATION.labels(endpoint, status).observe(time.monotonic() - started)
+
+
+def _release(*holds):
+    """
+    Release admission tickets, model leases and replica leases, None is skipped.
+    """
+    for hold in holds:
+        if hold is not None:
+            hold.release()
+
+
+def _finish_when_done(response, control: GenerationControl, *holds):
+    """
+    Streaming responses keep their admission ticket and leases until the last event has been sent,
+    and cancel the generation when the client goes away before that.
+    """
+    if not isinstance(response, EventSourceResponse):
+        _release(*holds)
+        # 在此序列化, 计入serialize阶段, FastAPI不再按response_model重新校验
+        with timing.phase('serialize'):
+            response = Response(content=response.model_dump_json(), media_type="application/json")
+        _observe('chat', control.created, 200)
+        return response
+
+    body_iterator = response.body_iterator
+
+    async def _iterate():
+        completed = False
+        try:
+            async for item in body_iterator:
+                yield item
+            completed = True
+        finally:
+            # sse_starlette检测到断开后不再读取事件
+            if not completed:
+                control.cancel()
+            _release(*holds)
+            _observe('chat', control.created, 200 if completed else 499)
+
+    response.body_iterator = _iterate()
+    return response
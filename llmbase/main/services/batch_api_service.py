@@ -0,0 +1,284 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+from fastapi import HTTPException, UploadFile
+
+from llmbase.main.common.dto.req.batch import BatchCreateRequest
+from llmbase.main.common.dto.res.batch import BatchList, BatchObject, BatchRequestCounts, FileObject
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool.logger import logger
+from llmbase.main.services.offline_batch_service import OfflineBatchRunner
+
+
+class BatchStore(object):
+    """
+    Local disk storage of uploaded files and batch jobs.
+
+    {storage_path}/files/{file_id}.json    文件元数据
+    {storage_path}/files/{file_id}.jsonl   文件内容
+    {storage_path}/batches/{batch_id}.json 批任务状态
+    """
+
+    def __init__(self, storage_path: str):
+        self.files_path = os.path.join(storage_path, 'files')
+        self.batches_path = os.path.join(storage_path, 'batches')
+        os.makedirs(self.files_path, exist_ok=True)
+        os.makedirs(self.batches_path, exist_ok=True)
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------ files
+
+    def save_file(self, source, filename: str, purpose: str, file_id: str = None) -> FileObject:
+        file_id = file_id or 'file-' + uuid.uuid4().hex
+        with open(self.file_content_path(file_id), 'wb') as f:
+            shutil.copyfileobj(source, f, 1 << 20)
+        return self.register_file(file_id, filename, purpose)
+
+    def register_file(self, file_id: str, filename: str, purpose: str) -> FileObject:
+        file_object = FileObject(id=file_id, bytes=os.path.getsize(self.file_content_path(file_id)),
+                                 filename=filename, purpose=purpose)
+        self._write_json(os.path.join(self.files_path, file_id + '.json'), file_object.model_dump())
+        return file_object
+
+    def get_file(self, file_id: str) -> Optional[FileObject]:
+        data = self._read_json(os.path.join(self.files_path, os.path.basename(file_id) + '.json'))
+        return FileObject.model_validate(data) if data else None
+
+    def file_content_path(self, file_id: str) -> str:
+        return os.path.join(self.files_path, os.path.basename(file_id) + '.jsonl')
+
+    # ------------------------------------------------------------------ batches
+
+    def save_batch(self, batch: BatchObject):
+        self._write_json(os.path.join(self.batches_path, batch.id + '.json'), batch.model_dump())
+
+    def get_batch(self, batch_id: str) -> Optional[BatchObject]:
+        data = self._read_json(os.path.join(self.batches_path, os.path.basename(batch_id) + '.json'))
+        return BatchObject.model_validate(data) if data else None
+
+    def update_batch(self, batch_id: str, only_if_status: tuple = None, **fields) -> Optional[BatchObject]:
+        """
+        :param only_if_status: 仅当当前状态属于其中之一时才更新, 否则返回None
+        :return: 更新后的批任务, 不存在时返回None
+        """
+        with self._lock:
+            batch = self.get_batch(batch_id)
+            if batch is None:
+                return None
+            if only_if_status is not None and batch.status not in only_if_status:
+                return None
+            batch = batch.model_copy(update=fields)
+            self.save_batch(batch)
+            return batch
+
+    def list_batches(self) -> List[BatchObject]:
+        batches = []
+        for filename in os.listdir(self.batches_path):
+            if filename.endswith('.json'):
+                batch = self.get_batch(filename[:-len('.json')])
+                if batch is not None:
+                    batches.append(batch)
+        return sorted(batches, key=lambda batch: batch.created_at)
+
+    def _write_json(self, path: str, data: dict):
+        with self._lock:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[dict]:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+class BatchWorker(object):
+    """
+    Background thread draining batch jobs through OfflineBatchRunner.
+
+    A job only runs while no interactive request is in flight (see ActivityMonitor) and the engine is empty.
+    As soon as interactive traffic shows up the runner stops after the current batch, the job stays in_progress
+    and resumes from its checkpoint once the server is idle again.
+    """
+
+    def __init__(self, store: BatchStore, llm, is_idle: Callable[[], bool], token_budget: int = 131072,
+                 max_batch_rows: int = 512, poll_interval: float = 1.0, max_padding_ratio: float = None,
+                 max_bucket_size: int = None):
+        """
+        :param is_idle: 返回True时才处理批任务
+        :param token_budget: 见OfflineBatchRunner
+        :param poll_interval: 没有任务或服务繁忙时的轮询间隔(秒)
+        """
+        self.store = store
+        self.llm = llm
+        self.is_idle = is_idle
+        self.token_budget = token_budget
+        self.max_batch_rows = max_batch_rows
+        self.poll_interval = poll_interval
+        self.max_padding_ratio = max_padding_ratio
+        self.max_bucket_size = max_bucket_size
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, name='batch-worker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if batch is None or not self.is_idle():
+                self._stopped.wait(self.poll_interval)
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.exception(e)
+                self.store.update_batch(batch.id, status='failed', failed_at=int(time.time()),
+                                        errors={'object': 'list', 'data': [{'message': str(e)}]})
+
+    def _next_batch(self) -> Optional[BatchObject]:
+        for batch in self.store.list_batches():
+            if batch.status == 'cancelling':
+                self._cancel(batch)
+            elif batch.status in ('validating', 'in_progress'):
+                return batch
+        return None
+
+    def _process(self, batch: BatchObject):
+        input_path = self.store.file_content_path(batch.input_file_id)
+        if batch.status == 'validating':
+            total = self._count_rows(input_path)
+            batch = self.store.update_batch(batch.id, only_if_status=('validating',), status='in_progress',
+                                            in_progress_at=int(time.time()),
+                                            request_counts=BatchRequestCounts(total=total))
+            if batch is None:
+                return
+
+        output_file_id = batch.id.replace('batch_', 'file-', 1)
+        runner = OfflineBatchRunner(self.llm, input_path=input_path,
+                                    output_path=self.store.file_content_path(output_file_id),
+                                    checkpoint_path=os.path.join(self.store.batches_path, batch.id + '.ckpt'),
+                                    token_budget=self.token_budget, max_batch_rows=self.max_batch_rows,
+                                    max_padding_ratio=self.max_padding_ratio, max_bucket_size=self.max_bucket_size)
+        stats = runner.run(should_stop=lambda: self._should_pause(batch.id))
+        if not stats['finished']:
+            current = self.store.get_batch(batch.id)
+            if current is not None and current.status == 'cancelling':
+                self._cancel(current)
+            return
+
+        self.store.update_batch(batch.id, status='finalizing', finalizing_at=int(time.time()))
+        completed, failed = self._count_results(self.store.file_content_path(output_file_id))
+        self.store.register_file(output_file_id, filename=batch.id + '_output.jsonl', purpose='batch_output')
+        self.store.update_batch(batch.id, status='completed', completed_at=int(time.time()),
+                                output_file_id=output_file_id,
+                                request_counts=BatchRequestCounts(total=completed + failed, completed=completed,
+                                                                  failed=failed))
+        logger.info(f"batch {batch.id} completed: {completed} completed, {failed} failed, "
+                    f"{stats['tokens_per_second']:.1f} tokens/s")
+
+    def _should_pause(self, batch_id: str) -> bool:
+        if self._stopped.is_set() or not self.is_idle():
+            return True
+        current = self.store.get_batch(batch_id)
+        return current is None or current.status == 'cancelling'
+
+    def _cancel(self, batch: BatchObject):
+        self.store.update_batch(batch.id, status='cancelled', cancelled_at=int(time.time()))
+
+    @staticmethod
+    def _count_rows(path: str) -> int:
+        with open(path, 'rb') as f:
+            return sum(1 for line in f if line.strip())
+
+    @staticmethod
+    def _count_results(path: str):
+        completed, failed = 0, 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if json.loads(line).get('error') is None:
+                    completed += 1
+                else:
+                    failed += 1
+        return completed, failed
+
+
+class BatchApiService:
+    """
+    OpenAI compatible /v1/files and /v1/batches
+    """
+
+    @staticmethod
+    def create_file(file: UploadFile, purpose: str) -> FileObject:
+        if purpose != 'batch':
+            raise HTTPException(status_code=400, detail="Only purpose 'batch' is supported")
+        return cosmos.batch_store.save_file(file.file, filename=file.filename, purpose=purpose)
+
+    @staticmethod
+    def retrieve_file(file_id: str) -> FileObject:
+        file_object = cosmos.batch_store.get_file(file_id)
+        if file_object is None:
+            raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+        return file_object
+
+    @staticmethod
+    def file_content_path(file_id: str) -> str:
+        BatchApiService.retrieve_file(file_id)
+        return cosmos.batch_store.file_content_path(file_id)
+
+    @staticmethod
+    def create_batch(request: BatchCreateRequest) -> BatchObject:
+        BatchApiService.retrieve_file(request.input_file_id)
+        created_at = int(time.time())
+        batch = BatchObject(id='batch_' + uuid.uuid4().hex, endpoint=request.endpoint,
+                            input_file_id=request.input_file_id, completion_window=request.completion_window,
+                            status='validating', created_at=created_at, expires_at=created_at + 24 * 3600,
+                            metadata=request.metadata)
+        cosmos.batch_store.save_batch(batch)
+        return batch
+
+    @staticmethod
+    def retrieve_batch(batch_id: str) -> BatchObject:
+        batch = cosmos.batch_store.get_batch(batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+        return batch
+
+    @staticmethod
+    def cancel_batch(batch_id: str) -> BatchObject:
+        batch = BatchApiService.retrieve_batch(batch_id)
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            raise HTTPException(status_code=400, detail=f"Cannot cancel a batch with status {batch.status}")
+        # 尚未开始的任务直接取消, 正在执行的任务由BatchWorker在当前批次结束后取消
+        cancelled = cosmos.batch_store.update_batch(batch_id, only_if_status=('validating',), status='cancelled',
+                                                    cancelled_at=int(time.time()))
+        return cancelled or cosmos.batch_store.update_batch(batch_id, status='cancelling',
+                                                            cancelling_at=int(time.time()))
+
+    @staticmethod
+    def list_batches(after: str = None, limit: int = 20) -> BatchList:
+        batches = list(reversed(cosmos.batch_store.list_batches()))
+        if after:
+            ids = [batch.id for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return BatchList(data=page, first_id=page[0].id if page else None, last_id=page[-1].id if page else None,
+                         has_more=len(batches) > limit)
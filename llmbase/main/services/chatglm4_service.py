@@ -1,19 +1,31 @@
 import time
-from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
 
-import tiktoken
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sse_starlette.sse import EventSourceResponse
-from transformers import LogitsProcessorList
+from transformers import LogitsProcessorList, StoppingCriteriaList
 
 from llmbase.main.common.dto.req.prompt_batch import PromptBatchDTO
 from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import metrics, timing
 from llmbase.main.common.tool.logger import logger
-from llmbase.main.llm.chatglm3.model import (EmbeddingRequest, CompletionUsage, ModelCard, ModelList,
+from llmbase.main.engine.admission import Ticket
+from llmbase.main.engine.control import GenerationControl, ControlStoppingCriteria
+from llmbase.main.engine.memory import MemoryManager
+from llmbase.main.engine.micro_batch import MicroBatcherStopped
+from llmbase.main.engine.embedding_codec import ENCODING_FORMATS, encode_embedding_response, truncate_dimensions
+from llmbase.main.llm import LLM
+from llmbase.main.llm.registry import ModelNotFound
+from llmbase.main.llm.replicas import ReplicaPool
+from llmbase.main.llm.chatglm3.model import (EmbeddingRequest, ModelCard, ModelList,
                                              ChatCompletionRequest, FunctionCallResponse, ChatMessage,
                                              ChatCompletionResponseChoice, UsageInfo, ChatCompletionResponse,
                                              ChatCompletionResponseStreamChoice, DeltaMessage)
-from llmbase.main.llm.chatglm3.utils import process_response, generate_chatglm3, generate_stream_chatglm3
+from llmbase.main.llm.chatglm3.stream_encoder import ChatCompletionChunkEncoder
+from llmbase.main.llm.chatglm3.utils import (process_response, generate_chatglm3, generate_stream_chatglm3,
+                                             generate_batch_chatglm3, build_batch_input_ids, batch_eos_token_id,
+                                             batch_gen_kwargs)
 
 router = APIRouter(prefix="/v1")
 
@@ -21,45 +33,130 @@ router = APIRouter(prefix="/v1")
 class ChatGLM4Service:
 
     @staticmethod
-    def get_embeddings(request: EmbeddingRequest):
-        embeddings = [cosmos.llm.embedding.encode(text) for text in request.input]
-        embeddings = [embedding.tolist() for embedding in embeddings]
-
-        def num_tokens_from_string(string: str) -> int:
-            """
-            Returns the number of tokens in a text string.
-            use cl100k_base tokenizer
-            """
-            encoding = tiktoken.get_encoding('cl100k_base')
-            num_tokens = len(encoding.encode(string))
-            return num_tokens
-
-        response = {
-            "data": [
-                {
-                    "object": "embedding",
-                    "embedding": embedding,
-                    "index": index
-                }
-                for index, embedding in enumerate(embeddings)
-            ],
-            "model": request.model,
-            "object": "list",
-            "usage": CompletionUsage(
-                prompt_tokens=sum(len(text.split()) for text in request.input),
-                completion_tokens=0,
-                total_tokens=sum(num_tokens_from_string(text) for text in request.input),
-            )
-        }
-        return response
+    def get_embeddings(request: EmbeddingRequest, llm: LLM = None) -> Response:
+        """
+        :param llm: 按request.model路由到的模型, 默认cosmos.llm
+        """
+        if request.encoding_format not in ENCODING_FORMATS:
+            raise HTTPException(status_code=400, detail=f"encoding_format must be one of {', '.join(ENCODING_FORMATS)}")
+        if request.dimensions is not None and request.dimensions < 1:
+            raise HTTPException(status_code=400, detail="dimensions must be a positive integer")
+
+        llm = llm or cosmos.llm
+        encoder = llm.embedding_encoder
+        if encoder is None:
+            raise HTTPException(status_code=501, detail=f"model {llm.model_name} does not serve embeddings")
+        with timing.phase("encode"):
+            embeddings = truncate_dimensions(encoder.encode(request.input), request.dimensions)
+        num_tokens = encoder.count_tokens(request.input)
+        metrics.record_tokens(llm.model_name, 'embeddings', num_tokens)
+        with timing.phase("serialize"):
+            content = encode_embedding_response(embeddings, request.encoding_format, request.model, num_tokens)
+        return Response(content=content, media_type="application/json")
+
+    @staticmethod
+    def readiness() -> dict:
+        """
+        State and load duration of every startup component, see StartupProgress.
+        """
+        startup = getattr(cosmos, 'startup', None)
+        return startup.stats() if startup is not None else {'ready': True, 'components': {}}
+
+    @staticmethod
+    def require_ready():
+        """
+        Raises 503 with Retry-After while the models are still loading (or failed to load).
+        """
+        startup = getattr(cosmos, 'startup', None)
+        if startup is not None and not startup.ready:
+            raise HTTPException(status_code=503, headers={'Retry-After': '5'},
+                                detail='model is loading' if startup.finished is None else 'model failed to load')
+
+    @staticmethod
+    def admit(request: Union[ChatCompletionRequest, EmbeddingRequest]) -> Optional[Ticket]:
+        """
+        Admit a request by its estimated token cost, raises 429 with Retry-After when the endpoint is full.
+        See Config.ADMISSION_CONFIG, returns None when admission control is off.
+        """
+        admission = getattr(cosmos, 'admission', None)
+        if admission is None:
+            return None
+        endpoint = 'embeddings' if isinstance(request, EmbeddingRequest) else 'chat'
+        return admission.admit(endpoint, ChatGLM4Service.cost(request))
+
+    @staticmethod
+    def cost(request: Union[ChatCompletionRequest, EmbeddingRequest]) -> int:
+        """
+        Estimated tokens of a request: prompt tokens + max_tokens.
+        """
+        if isinstance(request, EmbeddingRequest):
+            return sum(ChatGLM4Service.estimate_tokens(text) for text in request.input)
+        if len(request.messages) > 1:
+            # 多条消息按批量单轮请求处理, max_length包含prompt
+            return len(request.messages) * (request.max_length or 2048)
+        prompt_tokens = ChatGLM4Service.estimate_tokens(request.messages[0].content) if request.messages else 0
+        return prompt_tokens + (request.max_tokens or 1024)
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        admission = getattr(cosmos, 'admission', None)
+        return admission.estimate_tokens(text) if admission is not None else len(text or '')
+
+    @staticmethod
+    def route(request: Union[ChatCompletionRequest, EmbeddingRequest]) -> Tuple[LLM, list]:
+        """
+        Pick the model named by the request (see ModelRegistry, loads it on first use, blocks) and its least-loaded
+        replica (see ReplicaPool). Multi-prompt chat requests get the primary replica and are split later.
+
+        :return: (llm, holds), holds为模型租约和副本租约, 请求结束后release
+        """
+        holds = []
+        llm = cosmos.llm
+        registry = getattr(cosmos, 'model_registry', None)
+        if registry is not None:
+            # embeddings请求的model通常是向量模型名, 不在注册表中时由默认模型处理
+            fallback_to_default = True if isinstance(request, EmbeddingRequest) else None
+            try:
+                lease = registry.acquire(request.model, fallback_to_default)
+            except ModelNotFound:
+                raise HTTPException(status_code=404,
+                                    detail=f"model_not_found: The model '{request.model}' does not exist")
+            holds.append(lease)
+            llm = lease.llm
+        if llm.replicas is not None and (isinstance(request, EmbeddingRequest) or len(request.messages) <= 1):
+            replica = llm.replicas.acquire(ChatGLM4Service.cost(request))
+            holds.append(replica)
+            llm = replica.llm
+        return llm, holds
+
+    @staticmethod
+    def timeout(request: ChatCompletionRequest) -> Optional[float]:
+        """
+        Generation time budget of a chat request, see Config.DEADLINE_CONFIG
+        """
+        _deadline_config = getattr(cosmos.config, 'DEADLINE_CONFIG', None) or {}
+        if request.timeout is not None and request.timeout <= 0:
+            raise HTTPException(status_code=400, detail="timeout must be positive")
+        timeout = request.timeout if request.timeout is not None else _deadline_config.get('default_timeout')
+        max_timeout = _deadline_config.get('max_timeout')
+        if timeout is None or max_timeout is None:
+            return timeout if timeout is not None else max_timeout
+        return min(timeout, max_timeout)
 
     @staticmethod
     def models():
-        model_card = ModelCard(id=cosmos.llm.name)
-        return ModelList(data=[model_card])
+        registry = getattr(cosmos, 'model_registry', None)
+        if registry is None:
+            return ModelList(data=[ModelCard(id=cosmos.llm.name)])
+        return ModelList(data=[ModelCard(id=name) for name in registry.names()])
 
     @staticmethod
-    def create_chat_completion(request: ChatCompletionRequest):
+    def create_chat_completion(request: ChatCompletionRequest, control: GenerationControl = None, llm: LLM = None):
+        """
+        :param llm: 按request.model路由到的模型, 默认cosmos.llm
+        :param control: 客户端断开时取消生成, 超过截止时间时返回已生成的部分;
+                        合并到微批次中的请求不能单独取消, 也不受默认时间预算约束, 因此指定了timeout的请求不参与合并
+        """
         if len(request.messages) < 1 or request.messages[-1].role == "assistant":
             raise HTTPException(status_code=400, detail="Invalid request")
 
@@ -72,13 +169,16 @@ class ChatGLM4Service:
             stream=request.stream,
             repetition_penalty=request.repetition_penalty,
             tools=request.tools,
+            control=control,
         )
         logger.debug(f"==== request ====\n{gen_params}")
+        llm = llm or cosmos.llm
+        gen_params["model_name"] = llm.model_name
 
         if request.stream:
 
             # Use the stream mode to read the first few characters, if it is not a function call, direct stram output
-            predict_stream_generator = ChatGLM4Service.predict_stream(request.model, gen_params)
+            predict_stream_generator = ChatGLM4Service.predict_stream(request.model, gen_params, llm)
             output = next(predict_stream_generator)
             if not ChatGLM4Service.contains_custom_function(output):
                 return EventSourceResponse(predict_stream_generator, media_type="text/event-stream")
@@ -120,7 +220,7 @@ class ChatGLM4Service:
                 ))
 
                 # Streaming output of results after function calls
-                generate = ChatGLM4Service.predict(request.model, gen_params)
+                generate = ChatGLM4Service.predict(request.model, gen_params, llm)
                 return EventSourceResponse(generate, media_type="text/event-stream")
 
             else:
@@ -129,7 +229,20 @@ class ChatGLM4Service:
                 return EventSourceResponse(generate, media_type="text/event-stream")
 
         # Here is the handling of stream = False
-        response = generate_chatglm3(cosmos.llm.model, cosmos.llm.tokenizer, gen_params)
+        if llm.micro_batcher is not None and len(request.messages) == 1 and not request.tools \
+                and request.messages[0].role == "user" and request.timeout is None:
+            # 与同一时间窗口内的其他单轮请求合并为一次model.generate
+            micro_batch_key = (gen_params["temperature"], gen_params["top_p"], gen_params["repetition_penalty"],
+                               gen_params["max_tokens"])
+            try:
+                with timing.phase("micro_batch"):
+                    response = llm.micro_batcher.submit(micro_batch_key, request.messages[0].content)
+            except MicroBatcherStopped as e:
+                # 模型被逐出或服务关闭
+                raise HTTPException(status_code=503, headers={'Retry-After': '5'}, detail=str(e))
+        else:
+            response = generate_chatglm3(llm.model, llm.tokenizer, gen_params,
+                                         engine=llm.engine, token_cache=llm.token_cache)
 
         # Remove the first newline character
         if response["text"].startswith("\n"):
@@ -137,7 +250,7 @@ class ChatGLM4Service:
         response["text"] = response["text"].strip()
 
         usage = UsageInfo()
-        function_call, finish_reason = None, "stop"
+        function_call, finish_reason = None, "length" if response.get("finish_reason") == "length" else "stop"
         if request.tools:
             try:
                 function_call = process_response(response["text"], use_tool=True)
@@ -175,17 +288,138 @@ class ChatGLM4Service:
         )
 
     @staticmethod
-    def predict(model_id: str, params: dict):
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=DeltaMessage(role="assistant"),
-            finish_reason=None
-        )
-        chunk = ChatCompletionResponse(model=model_id, id="", choices=[choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+    def run_micro_batch(key: tuple, contents: list, llm: LLM = None) -> list:
+        """
+        Batch runner of the micro batcher: one padded model.generate call for requests sharing the same key.
+
+        :param key: (temperature, top_p, repetition_penalty, max_tokens)
+        :param contents: 各请求的用户消息
+        :param llm: 该微批次所属的模型, 默认cosmos.llm
+        :return:
+        """
+        llm = llm or cosmos.llm
+        encoded = build_batch_input_ids(llm.tokenizer, [[{'role': 'user', 'content': content}]
+                                                        for content in contents], llm.token_cache)
+        gen_kwargs = batch_gen_kwargs(llm.tokenizer, *key)
+        results = generate_batch_chatglm3(llm.model, llm.tokenizer, encoded, gen_kwargs,
+                                          **ChatGLM4Service.batch_config())
+        ChatGLM4Service.record_tokens(llm, 'chat', results)
+        return results
+
+    @staticmethod
+    def generate_on_replicas(pool: ReplicaPool, encoded: List[List[int]], gen_kwargs: dict,
+                             control: GenerationControl, max_length: int) -> List[dict]:
+        """
+        Split prompts across replicas (see ReplicaPool.split) and run generate_batch_chatglm3 on each in parallel.
+        The cost of a prompt is max_length, the same estimate used for admission.
+        """
+        assignments = pool.split([max_length] * len(encoded))
+        results = [None] * len(encoded)
+
+        def _run(replica_lease, indices):
+            try:
+                replica = replica_lease.llm
+                return indices, generate_batch_chatglm3(replica.model, replica.tokenizer,
+                                                        [encoded[index] for index in indices], gen_kwargs,
+                                                        control=control, **ChatGLM4Service.batch_config())
+            finally:
+                replica_lease.release()
+
+        with ThreadPoolExecutor(max_workers=len(assignments)) as executor:
+            for indices, replica_results in executor.map(lambda assignment: _run(*assignment), assignments):
+                for index, result in zip(indices, replica_results):
+                    results[index] = result
+        return results
+
+    @staticmethod
+    def record_tokens(llm: LLM, endpoint: str, results: List[dict]):
+        """
+        Count prompt and completion tokens of generate_batch_chatglm3 results, see metrics.
+        """
+        metrics.record_tokens(llm.model_name, endpoint, sum(result["usage"]["prompt_tokens"] for result in results),
+                              sum(result["usage"]["completion_tokens"] for result in results))
+
+    @staticmethod
+    def batch_config() -> dict:
+        """
+        Length bucketing options of generate_batch_chatglm3, see Config.BATCH_CONFIG
+        """
+        _batch_config = getattr(cosmos.config, 'BATCH_CONFIG', None) or {}
+        return {
+            'max_padding_ratio': _batch_config.get('max_padding_ratio'),
+            'max_bucket_size': _batch_config.get('max_bucket_size'),
+        }
+
+    @staticmethod
+    def stats() -> dict:
+        # 加载完成前cosmos.llm为None, 用LLM的类属性(均为None)代替
+        llm = getattr(cosmos, 'llm', None) or LLM
+        return {
+            'startup': ChatGLM4Service.readiness(),
+            'engine': llm.engine.stats() if llm.engine is not None else None,
+            'micro_batch': llm.micro_batcher.stats() if llm.micro_batcher is not None else None,
+            'memory': cosmos.memory_manager.stats() if getattr(cosmos, 'memory_manager', None) else None,
+            'token_cache': llm.token_cache.stats() if llm.token_cache is not None else None,
+            'embedding': llm.embedding_encoder.stats() if llm.embedding_encoder is not None else None,
+            'embedding_queue': cosmos.embedding_executor.stats() if getattr(cosmos, 'embedding_executor', None)
+            else None,
+            'admission': cosmos.admission.stats() if getattr(cosmos, 'admission', None) else None,
+            'cancellation': GenerationControl.stats(),
+            'models': cosmos.model_registry.stats() if getattr(cosmos, 'model_registry', None) else None,
+            'replicas': llm.replicas.stats() if llm.replicas is not None else None,
+            'nacos': cosmos.nacos_reporter.stats() if getattr(cosmos, 'nacos_reporter', None) else None,
+        }
+
+    @staticmethod
+    def load() -> dict:
+        """
+        Live load of this instance, reported to the service registry (see NacosReporter).
+        pressure is the highest of: admitted tokens/requests over their limits, engine queue over max_batch_size,
+        allocated GPU memory; 1.0 means full.
+        """
+        llm = getattr(cosmos, 'llm', None) or LLM
+        members = llm.replicas.llms if llm.replicas is not None else [llm]
+        engines = [member.engine for member in members if member.engine is not None]
+        engine_stats = [engine.stats() for engine in engines]
+        queue_depth = sum(stats['waiting'] for stats in engine_stats)
+        running = sum(stats['running'] for stats in engine_stats)
+        pressures = [min(queue_depth / sum(engine.max_batch_size for engine in engines), 1.0)] if engines else []
+        inflight_requests, inflight_tokens, tokens_per_second = 0, 0, 0.0
+        admission = getattr(cosmos, 'admission', None)
+        if admission is not None:
+            for controller in admission.controllers.values():
+                stats = controller.stats()
+                inflight_requests += stats['inflight_requests']
+                inflight_tokens += stats['inflight_tokens']
+                tokens_per_second += stats['tokens_per_second']
+                pressures.append(stats['inflight_tokens'] / stats['max_tokens'])
+                pressures.append(stats['inflight_requests'] / stats['max_requests'])
+        memory = MemoryManager.allocated_fraction()
+        pressures.append(memory)
+        return {
+            'queue_depth': queue_depth,
+            'running': running,
+            'inflight_requests': inflight_requests,
+            'inflight_tokens': inflight_tokens,
+            'memory': memory,
+            # 按admission统计的完成token估计量, 没有引擎时的吞吐
+            'admitted_tokens_per_second': tokens_per_second,
+            # 累计解码token数, 由调用方按时间差计算最近的tokens/s
+            'decoded_tokens': sum(stats['decoded_tokens'] for stats in engine_stats),
+            'pressure': max(pressures),
+        }
+
+    @staticmethod
+    def predict(model_id: str, params: dict, llm: LLM = None):
+        llm = llm or cosmos.llm
+        encoder = ChatCompletionChunkEncoder(model_id)
+        yield encoder.role()
 
         previous_text = ""
-        for new_response in generate_stream_chatglm3(cosmos.llm.model, cosmos.llm.tokenizer, params):
+        finish_reason = None
+        for new_response in generate_stream_chatglm3(llm.model, llm.tokenizer, params,
+                                                     engine=llm.engine,
+                                                     token_cache=llm.token_cache):
             decoded_unicode = new_response["text"]
             delta_text = decoded_unicode[len(previous_text):]
             previous_text = decoded_unicode
@@ -202,13 +436,17 @@ class ChatGLM4Service:
                     logger.warning(
                         "Failed to parse tool call, maybe the response is not a tool call or have been answered.")
 
-            if isinstance(function_call, dict):
-                function_call = FunctionCallResponse(**function_call)
+            if not isinstance(function_call, dict):
+                # 普通文本块走预序列化的快速路径
+                with timing.phase("serialize"):
+                    chunk = encoder.content(delta_text, finish_reason)
+                yield chunk
+                continue
 
             delta = DeltaMessage(
                 content=delta_text,
                 role="assistant",
-                function_call=function_call if isinstance(function_call, FunctionCallResponse) else None,
+                function_call=FunctionCallResponse(**function_call),
             )
 
             choice_data = ChatCompletionResponseStreamChoice(
@@ -222,24 +460,15 @@ class ChatGLM4Service:
                 choices=[choice_data],
                 object="chat.completion.chunk"
             )
-            yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+            with timing.phase("serialize"):
+                chunk = chunk.model_dump_json(exclude_unset=True)
+            yield chunk
 
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=DeltaMessage(),
-            finish_reason="stop"
-        )
-        chunk = ChatCompletionResponse(
-            model=model_id,
-            id="",
-            choices=[choice_data],
-            object="chat.completion.chunk"
-        )
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+        yield encoder.stop("length" if finish_reason == "length" else "stop")
         yield '[DONE]'
 
     @staticmethod
-    def predict_stream(model_id, gen_params):
+    def predict_stream(model_id, gen_params, llm: LLM = None):
         """
         The function call is compatible with stream mode output.
 
@@ -249,12 +478,17 @@ class ChatGLM4Service:
 
         :param model_id:
         :param gen_params:
+        :param llm: 默认cosmos.llm
         :return:
         """
+        llm = llm or cosmos.llm
         output = ""
         is_function_call = False
         has_send_first_chunk = False
-        for new_response in generate_stream_chatglm3(cosmos.llm.model, cosmos.llm.tokenizer, gen_params):
+        encoder = ChatCompletionChunkEncoder(model_id)
+        for new_response in generate_stream_chatglm3(llm.model, llm.tokenizer, gen_params,
+                                                     engine=llm.engine,
+                                                     token_cache=llm.token_cache):
             decoded_unicode = new_response["text"]
             delta_text = decoded_unicode[len(output):]
             output = decoded_unicode
@@ -273,45 +507,13 @@ class ChatGLM4Service:
 
                 # Send an empty string first to avoid truncation by subsequent next() operations.
                 if not has_send_first_chunk:
-                    message = DeltaMessage(
-                        content="",
-                        role="assistant",
-                        function_call=None,
-                    )
-                    choice_data = ChatCompletionResponseStreamChoice(
-                        index=0,
-                        delta=message,
-                        finish_reason=finish_reason
-                    )
-                    chunk = ChatCompletionResponse(
-                        model=model_id,
-                        id="",
-                        choices=[choice_data],
-                        created=int(time.time()),
-                        object="chat.completion.chunk"
-                    )
-                    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+                    yield encoder.content("", finish_reason, created=int(time.time()))
 
                 send_msg = delta_text if has_send_first_chunk else output
                 has_send_first_chunk = True
-                message = DeltaMessage(
-                    content=send_msg,
-                    role="assistant",
-                    function_call=None,
-                )
-                choice_data = ChatCompletionResponseStreamChoice(
-                    index=0,
-                    delta=message,
-                    finish_reason=finish_reason
-                )
-                chunk = ChatCompletionResponse(
-                    model=model_id,
-                    id="",
-                    choices=[choice_data],
-                    created=int(time.time()),
-                    object="chat.completion.chunk"
-                )
-                yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+                with timing.phase("serialize"):
+                    chunk = encoder.content(send_msg, finish_reason, created=int(time.time()))
+                yield chunk
 
         if is_function_call:
             yield output
@@ -327,21 +529,9 @@ class ChatGLM4Service:
         :param value:
         :return:
         """
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=DeltaMessage(role="assistant", content=value),
-            finish_reason=None
-        )
-        chunk = ChatCompletionResponse(model=model_id, id="", choices=[choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
-
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=DeltaMessage(),
-            finish_reason="stop"
-        )
-        chunk = ChatCompletionResponse(model=model_id, id="", choices=[choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+        encoder = ChatCompletionChunkEncoder(model_id)
+        yield encoder.content(value, with_function_call=False)
+        yield encoder.stop()
         yield '[DONE]'
 
     @staticmethod
@@ -359,22 +549,20 @@ class ChatGLM4Service:
         return value and 'get_' in value
 
     @staticmethod
-    def create_batch_completion(request: ChatCompletionRequest):
-        model = cosmos.llm.model
-        tokenizer = cosmos.llm.tokenizer
-        tokenizer.encode_special_tokens = True
-
-        eos_start = '<|user|>'
-        eos_end = '<|assistant|>'
-        eos_token_id = [
-            tokenizer.eos_token_id,
-            tokenizer.get_command(eos_start),
-            tokenizer.get_command(eos_end)
-        ]
+    def create_batch_completion(request: ChatCompletionRequest, control: GenerationControl = None,
+                                llm: LLM = None):
+        """
+        :param control: 客户端断开或超过截止时间时在下一个解码步停止, 并跳过剩余的桶
+        :param llm: 按request.model路由到的模型, 默认cosmos.llm
+        """
+        llm = llm or cosmos.llm
+        model = llm.model
+        tokenizer = llm.tokenizer
+
+        eos_token_id = batch_eos_token_id(tokenizer)
         logger.debug(f"==== messages ====\n{request.messages}")
-        prompts = []
-        for msg in request.messages:
-            prompts.append(eos_start + '\n' + msg.content + '\n' + eos_end)
+        encoded = build_batch_input_ids(tokenizer, [[{'role': 'user', 'content': msg.content}]
+                                                    for msg in request.messages], llm.token_cache)
 
         gen_kwargs = {
             "max_length": request.max_length or 2048,
@@ -387,25 +575,34 @@ class ChatGLM4Service:
             "repetition_penalty": request.repetition_penalty,
             "tools": request.tools,
         }
+        if control is not None:
+            gen_kwargs["stopping_criteria"] = StoppingCriteriaList([ControlStoppingCriteria(control)])
 
-        batched_inputs = tokenizer(prompts, return_tensors="pt", padding="longest")
-        batched_inputs = batched_inputs.to(model.device)
-
-        batched_outputs = model.generate(**batched_inputs, **gen_kwargs)
+        if llm.replicas is not None and len(encoded) > 1:
+            # 数据并行: 按各副本负载拆分后同时生成
+            results = ChatGLM4Service.generate_on_replicas(llm.replicas, encoded, gen_kwargs, control,
+                                                           request.max_length or 2048)
+        else:
+            results = generate_batch_chatglm3(model, tokenizer, encoded, gen_kwargs, control=control,
+                                              **ChatGLM4Service.batch_config())
+        ChatGLM4Service.record_tokens(llm, 'chat', results)
+        if control is not None and control.cancelled:
+            GenerationControl.record_wasted(sum(result["usage"]["completion_tokens"] for result in results))
+            # 客户端已断开, 响应不会被接收
+            raise HTTPException(status_code=499, detail="Client closed request")
 
         _choices = []
-        for input_ids, output_ids in zip(batched_inputs.input_ids, batched_outputs):
-            decoded_text = tokenizer.decode(output_ids[len(input_ids):])
+        for index, result in enumerate(results):
             message = ChatMessage(
                 role="assistant",
-                content=decoded_text.strip(),
+                content=result["text"].strip(),
                 function_call=None
             )
 
             choice_data = ChatCompletionResponseChoice(
-                index=0,
+                index=index,
                 message=message,
-                finish_reason='stop',
+                finish_reason=result["finish_reason"],
             )
             _choices.append(choice_data)
 
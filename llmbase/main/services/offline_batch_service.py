@@ -0,0 +1,197 @@
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Callable, List, Optional
+
+from pydantic import ValidationError
+
+from llmbase.main.common.tool import metrics
+from llmbase.main.common.tool.logger import logger
+from llmbase.main.llm.chatglm3.model import (ChatCompletionRequest, ChatCompletionResponse,
+                                             ChatCompletionResponseChoice, ChatMessage, UsageInfo)
+from llmbase.main.llm.chatglm3.utils import batch_gen_kwargs, build_batch_input_ids, generate_batch_chatglm3
+
+
+class OfflineBatchRunner(object):
+    """
+    Stream a JSONL file of chat requests through the batch generation path and write one JSONL result per row.
+
+    Input rows are either a plain chat request or an OpenAI batch line {"custom_id", "method", "url", "body"}.
+    Output rows follow the OpenAI batch output format {"id", "custom_id", "response", "error"}.
+
+    Rows are gathered until the token budget (prompt tokens + max_tokens) is used up, then generated as one
+    batch (grouped by sampling parameters and bucketed by length). After every batch the output is flushed and
+    a checkpoint with the input/output offsets is written, so a rerun with the same paths resumes after the
+    last finished batch.
+    """
+
+    def __init__(self, llm, input_path: str, output_path: str, checkpoint_path: str = None, token_budget: int = 65536,
+                 max_batch_rows: int = 256, default_max_tokens: int = 1024, max_padding_ratio: float = None,
+                 max_bucket_size: int = None):
+        """
+        :param llm: 已加载的LLM, 例如cosmos.llm
+        :param checkpoint_path: 默认为output_path + '.ckpt'
+        :param token_budget: 每批prompt tokens与max_tokens之和的上限
+        :param max_batch_rows: 每批最多的行数
+        :param default_max_tokens: 请求未指定max_tokens时使用
+        """
+        self.llm = llm
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + '.ckpt'
+        self.token_budget = token_budget
+        self.max_batch_rows = max_batch_rows
+        self.default_max_tokens = default_max_tokens
+        self.max_padding_ratio = max_padding_ratio
+        self.max_bucket_size = max_bucket_size
+
+    def run(self, should_stop: Callable[[], bool] = None) -> dict:
+        """
+        :param should_stop: 每批开始前调用, 返回True时在写完检查点后停止
+        :return: 本次运行的统计
+        """
+        checkpoint = self._load_checkpoint()
+        stats = {'rows': 0, 'failed': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'resumed_rows': checkpoint['rows'],
+                 'finished': False}
+        start_time = time.time()
+
+        with open(self.input_path, 'rb') as input_file, self._open_output(checkpoint['output_size']) as output_file:
+            input_file.seek(checkpoint['input_offset'])
+            while should_stop is None or not should_stop():
+                rows = self._read_batch(input_file)
+                if not rows:
+                    stats['finished'] = True
+                    break
+                for line in self._run_batch(rows, stats):
+                    output_file.write(line)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+                checkpoint['input_offset'] = input_file.tell()
+                checkpoint['output_size'] = output_file.tell()
+                checkpoint['rows'] += len(rows)
+                self._save_checkpoint(checkpoint)
+                logger.info(f"offline batch: {checkpoint['rows']} rows done")
+
+        elapsed = time.time() - start_time
+        stats['elapsed'] = elapsed
+        stats['rows_per_second'] = stats['rows'] / elapsed if elapsed else 0.0
+        stats['tokens_per_second'] = stats['completion_tokens'] / elapsed if elapsed else 0.0
+        return stats
+
+    def _read_batch(self, input_file) -> List[dict]:
+        rows, tokens = [], 0
+        while len(rows) < self.max_batch_rows:
+            offset = input_file.tell()
+            line = input_file.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            row = self._parse_row(line)
+            if row.get('request') is not None:
+                cost = len(row['input_ids']) + row['request'].max_tokens
+                if rows and tokens + cost > self.token_budget:
+                    # 超出预算的行留给下一批
+                    input_file.seek(offset)
+                    break
+                tokens += cost
+            rows.append(row)
+        return rows
+
+    def _parse_row(self, line: bytes) -> dict:
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            return {'custom_id': None, 'request': None, 'error': str(e)}
+        custom_id = data.get('custom_id') if isinstance(data, dict) else None
+        try:
+            request = ChatCompletionRequest.model_validate(data.get('body', data))
+            if request.max_tokens is None:
+                request.max_tokens = self.default_max_tokens
+            input_ids = build_batch_input_ids(self.llm.tokenizer,
+                                              [[{'role': m.role, 'content': m.content} for m in request.messages]],
+                                              self.llm.token_cache)[0]
+            return {'custom_id': custom_id, 'request': request, 'input_ids': input_ids}
+        except (ValueError, ValidationError) as e:
+            return {'custom_id': custom_id, 'request': None, 'error': str(e)}
+
+    def _run_batch(self, rows: List[dict], stats: dict) -> List[bytes]:
+        groups = defaultdict(list)
+        for index, row in enumerate(rows):
+            if row['request'] is not None:
+                request = row['request']
+                groups[(request.temperature, request.top_p, request.repetition_penalty, request.max_tokens)] \
+                    .append(index)
+
+        results: List[Optional[dict]] = [None] * len(rows)
+        for key, indexes in groups.items():
+            try:
+                group_results = generate_batch_chatglm3(self.llm.model, self.llm.tokenizer,
+                                                        [rows[index]['input_ids'] for index in indexes],
+                                                        batch_gen_kwargs(self.llm.tokenizer, *key),
+                                                        max_padding_ratio=self.max_padding_ratio,
+                                                        max_bucket_size=self.max_bucket_size)
+            except Exception as e:
+                logger.exception(e)
+                for index in indexes:
+                    rows[index]['error'] = str(e)
+                continue
+            metrics.record_tokens(self.llm.model_name, 'batches',
+                                  sum(result['usage']['prompt_tokens'] for result in group_results),
+                                  sum(result['usage']['completion_tokens'] for result in group_results))
+            for index, result in zip(indexes, group_results):
+                results[index] = result
+
+        lines = []
+        for row, result in zip(rows, results):
+            lines.append(self._output_line(row, result, stats))
+        stats['rows'] += len(rows)
+        return lines
+
+    @staticmethod
+    def _output_line(row: dict, result: Optional[dict], stats: dict) -> bytes:
+        output = {'id': 'batch_req_' + uuid.uuid4().hex, 'custom_id': row['custom_id'], 'response': None,
+                  'error': None}
+        if result is None:
+            stats['failed'] += 1
+            output['error'] = {'message': row.get('error')}
+        else:
+            stats['prompt_tokens'] += result['usage']['prompt_tokens']
+            stats['completion_tokens'] += result['usage']['completion_tokens']
+            choice = ChatCompletionResponseChoice(
+                index=0,
+                message=ChatMessage(role="assistant", content=result["text"].strip()),
+                finish_reason=result["finish_reason"],
+            )
+            body = ChatCompletionResponse(model=row['request'].model, id="", choices=[choice],
+                                          object="chat.completion", usage=UsageInfo(**result["usage"]))
+            output['response'] = {'status_code': 200, 'body': body.model_dump()}
+        return (json.dumps(output, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def _open_output(self, output_size: int):
+        if not os.path.exists(self.output_path):
+            return open(self.output_path, 'wb')
+        output_file = open(self.output_path, 'r+b')
+        # 丢弃上次崩溃时写了一半的批次
+        output_file.truncate(output_size)
+        output_file.seek(output_size)
+        return output_file
+
+    def _load_checkpoint(self) -> dict:
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            logger.info(f"resume offline batch from row {checkpoint['rows']}")
+            return checkpoint
+        return {'input_offset': 0, 'output_size': 0, 'rows': 0}
+
+    def _save_checkpoint(self, checkpoint: dict):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
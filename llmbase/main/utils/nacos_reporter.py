@@ -0,0 +1,113 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from llmbase.main.common.tool.logger import logger
+
+
+class NacosReporter(object):
+    """
+    Periodically pushes the live load of this instance to Nacos (modify_naming_instance), so callers balance by
+    actual load instead of the static weight registered at startup.
+
+    weight = base weight * (1 - pressure), never below min_weight * base weight. When pressure reaches
+    `disable_pressure` the instance disables itself (enable=False, callers stop picking it) and enables itself
+    again once pressure fell below `enable_pressure`, before requests start timing out. The load is also
+    written into the instance metadata (queue_depth, inflight_tokens, memory, tokens_per_second, ...).
+    """
+
+    def __init__(self, client, service: dict, sample: Callable[[], dict], interval: float = 5.0,
+                 min_weight: float = 0.1, disable_pressure: float = 0.95, enable_pressure: float = 0.8):
+        """
+        :param client: nacos.NacosClient
+        :param service: NACOS_CONFIG['service'], 注册时的服务名, ip, port, weight, metadata等
+        :param sample: 返回当前负载, 见ChatGLM4Service.load
+        :param interval: 上报间隔(秒)
+        :param min_weight: 权重下限, 相对注册时的weight
+        :param disable_pressure: 负载达到该值时下线(enable=False)
+        :param enable_pressure: 下线后负载低于该值时重新上线
+        """
+        if not enable_pressure <= disable_pressure:
+            raise ValueError('enable_pressure must not exceed disable_pressure')
+        self.client = client
+        self.service = service
+        self.sample = sample
+        self.interval = interval
+        self.min_weight = min_weight
+        self.disable_pressure = disable_pressure
+        self.enable_pressure = enable_pressure
+        self.base_weight = service.get('weight') or 1.0
+
+        self.enabled = service.get('enable', True) is not False
+        self.weight = self.base_weight
+        self._last_decoded = None
+        self._last_time = None
+        self._reports = 0
+        self._errors = 0
+        self._last_report: Optional[dict] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='nacos-reporter', daemon=True)
+        self._thread.start()
+        logger.info(f'nacos reporter started, interval={self.interval}s')
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                # 注册中心暂时不可用时下个间隔重试
+                self._errors += 1
+                logger.warning(f'nacos report failed: {e}')
+
+    def report(self) -> dict:
+        """
+        Sample the load and push it, returns the pushed parameters.
+        """
+        load = self.sample()
+        now = time.time()
+        # 最近一个间隔的解码速度
+        decoded = load.pop('decoded_tokens', None)
+        tokens_per_second = load.pop('admitted_tokens_per_second', 0.0)
+        if decoded is not None and self._last_decoded is not None and now > self._last_time:
+            tokens_per_second = (decoded - self._last_decoded) / (now - self._last_time)
+        self._last_decoded, self._last_time = decoded, now
+
+        pressure = load['pressure']
+        enabled = self.enabled
+        if enabled and pressure >= self.disable_pressure:
+            enabled = False
+            logger.warning(f'instance under pressure {pressure:.2f}, disabling it in nacos')
+        elif not enabled and pressure < self.enable_pressure:
+            enabled = True
+            logger.info(f'instance pressure back to {pressure:.2f}, enabling it in nacos')
+        weight = self.base_weight * max(self.min_weight, 1.0 - pressure)
+
+        metadata = dict(self.service.get('metadata') or {})
+        metadata.update({key: round(value, 4) if isinstance(value, float) else value for key, value in load.items()})
+        metadata['tokens_per_second'] = round(tokens_per_second, 2)
+        params = dict(service_name=self.service.get('name'), ip=self.service.get('ip'),
+                      port=self.service.get('port'), cluster_name=self.service.get('cluster_name'),
+                      weight=round(weight, 4), metadata=metadata, enable=enabled,
+                      ephemeral=self.service.get('ephemeral'), group_name=self.service.get('group_name'))
+        self.client.modify_naming_instance(**params)
+        self.enabled, self.weight = enabled, weight
+        self._reports += 1
+        self._last_report = params
+        return params
+
+    def stats(self) -> dict:
+        return {
+            'weight': self.weight,
+            'enabled': self.enabled,
+            'reports': self._reports,
+            'errors': self._errors,
+            'metadata': self._last_report['metadata'] if self._last_report is not None else None,
+        }
@@ -0,0 +1,36 @@
+import timeit
+
+from llmbase.main.llm.chatglm3.model import (ChatCompletionResponse, ChatCompletionResponseStreamChoice,
+                                             DeltaMessage)
+from llmbase.main.llm.chatglm3.stream_encoder import ChatCompletionChunkEncoder
+
+MODEL_ID = 'chatglm3-6b'
+DELTAS = ['你好', ',', ' world', '"quoted"', 'back\\slash', 'line\nbreak', 'tab\t', '\x01', 'emoji 😀', '']
+
+
+def pydantic_chunk(text, finish_reason=None, created=None):
+    choice_data = ChatCompletionResponseStreamChoice(
+        index=0,
+        delta=DeltaMessage(content=text, role="assistant", function_call=None),
+        finish_reason=finish_reason
+    )
+    if created is None:
+        chunk = ChatCompletionResponse(model=MODEL_ID, id="", choices=[choice_data], object="chat.completion.chunk")
+    else:
+        chunk = ChatCompletionResponse(model=MODEL_ID, id="", choices=[choice_data], created=created,
+                                       object="chat.completion.chunk")
+    return "{}".format(chunk.model_dump_json(exclude_unset=True))
+
+
+if __name__ == '__main__':
+    # 流式输出每个token的序列化开销: pydantic vs 预序列化
+    # 输出逐字节一致由test_stream_encoder.py检查
+    encoder = ChatCompletionChunkEncoder(MODEL_ID)
+
+    number = 20000
+    pydantic_seconds = timeit.timeit(lambda: [pydantic_chunk(text) for text in DELTAS], number=number)
+    encoder_seconds = timeit.timeit(lambda: [encoder.content(text) for text in DELTAS], number=number)
+    chunks = number * len(DELTAS)
+    print(f'pydantic: {pydantic_seconds / chunks * 1e6:.2f} us/chunk')
+    print(f'encoder:  {encoder_seconds / chunks * 1e6:.2f} us/chunk')
+    print(f'speedup:  {pydantic_seconds / encoder_seconds:.1f}x')
@@ -0,0 +1,157 @@
+import math
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+# 从仓库根目录导入llmbase
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+
+class TinyCausalLM(torch.nn.Module):
+    """
+    一层单头注意力的因果语言模型, 接口与ChatGLM的forward相同(position_ids, attention_mask, past_key_values),
+    KV cache按layout排列: 'batch_first'为[batch, heads, seq, dim], 'seq_first'为[seq, batch, heads, dim].
+    stream_generate不使用KV cache, 每步重新计算整个序列, 作为引擎输出的参照.
+    """
+
+    def __init__(self, layout: str = 'batch_first', vocab_size: int = 48, dim: int = 16, seed: int = 0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.layout = layout
+        self.embed = torch.nn.Parameter(torch.randn(vocab_size, dim, generator=generator, dtype=torch.float64))
+        self.positions = torch.nn.Parameter(torch.randn(256, dim, generator=generator, dtype=torch.float64))
+        self.wq = torch.nn.Parameter(torch.randn(dim, dim, generator=generator, dtype=torch.float64) / math.sqrt(dim))
+        self.wk = torch.nn.Parameter(torch.randn(dim, dim, generator=generator, dtype=torch.float64) / math.sqrt(dim))
+        self.wv = torch.nn.Parameter(torch.randn(dim, dim, generator=generator, dtype=torch.float64) / math.sqrt(dim))
+        self.head = torch.nn.Parameter(torch.randn(dim, vocab_size, generator=generator, dtype=torch.float64))
+        self.config = SimpleNamespace(seq_length=256)
+
+    @property
+    def device(self) -> torch.device:
+        return self.embed.device
+
+    def forward(self, input_ids, position_ids=None, attention_mask=None, past_key_values=None, use_cache=True,
+                return_dict=True):
+        batch_size, length = input_ids.shape
+        past_len = 0
+        if past_key_values is not None:
+            past_k, past_v = (self._from_layout(t) for t in past_key_values[0])
+            past_len = past_k.shape[1]
+        if position_ids is None:
+            position_ids = torch.arange(past_len, past_len + length).unsqueeze(0).expand(batch_size, -1)
+        x = self.embed[input_ids] + self.positions[position_ids]
+        q, k, v = x @ self.wq, x @ self.wk, x @ self.wv
+        if past_key_values is not None:
+            k, v = torch.cat((past_k, k), dim=1), torch.cat((past_v, v), dim=1)
+        total = k.shape[1]
+        scores = q @ k.transpose(1, 2) / math.sqrt(k.shape[-1])
+        visible = torch.ones((length, total), dtype=torch.bool).tril(total - length)
+        visible = visible.unsqueeze(0).expand(batch_size, -1, -1)
+        if attention_mask is not None:
+            visible = visible & attention_mask[:, None, -total:].bool()
+        scores = scores.masked_fill(~visible, float('-inf'))
+        hidden = torch.softmax(scores, dim=-1) @ v + x
+        logits = hidden @ self.head
+        # 0..2是特殊token(见ByteTokenizer), 只在测试指定为eos时才会用到
+        logits[..., :3] = -1e4
+        return SimpleNamespace(logits=logits,
+                               past_key_values=((self._to_layout(k), self._to_layout(v)),))
+
+    def _to_layout(self, tensor):
+        # [batch, seq, dim] -> 缓存布局
+        if self.layout == 'seq_first':
+            return tensor.permute(1, 0, 2).unsqueeze(2).contiguous()
+        return tensor.unsqueeze(1).contiguous()
+
+    def _from_layout(self, tensor):
+        if self.layout == 'seq_first':
+            return tensor.squeeze(2).permute(1, 0, 2)
+        return tensor.squeeze(1)
+
+    @torch.inference_mode()
+    def stream_generate(self, input_ids, eos_token_id=(), max_new_tokens=16, stopping_criteria=None, **kwargs):
+        ids = input_ids
+        for _ in range(max_new_tokens):
+            next_id = int(torch.argmax(self(ids).logits[0, -1]))
+            ids = torch.cat((ids, torch.tensor([[next_id]])), dim=1)
+            yield ids
+            if next_id in eos_token_id or (stopping_criteria is not None and stopping_criteria(ids, None)):
+                return
+
+
+class ByteTokenizer(object):
+    """
+    每个普通token是一个字节: id = 字节值 - offset, 0为eos, 1, 2为<|user|>, <|assistant|>等命令.
+    offset=0时可以解码任意UTF-8字节序列, 用于检查增量解码; 与TinyCausalLM一起使用时offset为61, 解码为ASCII字符.
+    """
+    eos_token_id = 0
+    pad_token_id = 0
+
+    def __init__(self, offset: int = 61):
+        self.offset = offset
+
+    def get_command(self, token: str) -> int:
+        return 1 if token == '<|user|>' else 2
+
+    def build_chat_input(self, query: str, history: list = None, role: str = 'user'):
+        from transformers import BatchEncoding
+        text = ''.join(message['content'] for message in history or []) + query
+        return BatchEncoding({'input_ids': torch.tensor([[3 + byte % 45 for byte in text.encode()]])})
+
+    def __call__(self, texts: list) -> dict:
+        return {'input_ids': [self.build_chat_input(text)['input_ids'][0].tolist() for text in texts]}
+
+    def pad(self, encoded_inputs: dict, padding: str = 'longest', return_tensors: str = 'pt'):
+        from transformers import BatchEncoding
+        input_ids = encoded_inputs['input_ids']
+        width = max(len(ids) for ids in input_ids)
+        return BatchEncoding({
+            'input_ids': torch.tensor([[self.pad_token_id] * (width - len(ids)) + ids for ids in input_ids]),
+            'attention_mask': torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in input_ids]),
+        })
+
+    def decode(self, token_ids, skip_special_tokens: bool = False) -> str:
+        return bytes(int(token_id) + self.offset for token_id in token_ids if int(token_id) >= 3
+                     ).decode('utf-8', errors='replace')
+
+
+class EchoModel(object):
+    """
+    model.generate completing every prompt with its own last token followed by eos, counts the prompts it has seen.
+    on_generate is called after every call, e.g. to cancel a batch job between two batches.
+    """
+    device = torch.device('cpu')
+
+    def __init__(self, on_generate=None):
+        self.prompts = 0
+        self.on_generate = on_generate
+
+    def generate(self, input_ids, attention_mask=None, **kwargs):
+        self.prompts += len(input_ids)
+        if self.on_generate is not None:
+            self.on_generate()
+        return torch.cat((input_ids, input_ids[:, -1:], torch.zeros_like(input_ids[:, -1:])), dim=1)
+
+
+def echo_llm(on_generate=None):
+    """
+    Stand-in for a loaded LLM on the batch paths.
+    """
+    return SimpleNamespace(model=EchoModel(on_generate), tokenizer=ByteTokenizer(), token_cache=None,
+                           model_name='tiny', replicas=None)
+
+
+@pytest.fixture
+def tiny_model():
+    """
+    Factory of TinyCausalLM, see its docstring.
+    """
+    return TinyCausalLM
+
+
+@pytest.fixture
+def tiny_tokenizer():
+    return ByteTokenizer()
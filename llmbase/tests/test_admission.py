@@ -0,0 +1,87 @@
+import pytest
+from fastapi import HTTPException
+
+from llmbase.main.engine.admission import Admission, AdmissionController
+
+
+def _rejection(controller: AdmissionController, cost: int) -> HTTPException:
+    with pytest.raises(HTTPException) as excinfo:
+        controller.admit(cost)
+    return excinfo.value
+
+
+def test_rejects_over_budget_with_retry_after_from_throughput():
+    controller = AdmissionController('chat', max_tokens=100, max_requests=8, window=30.0, max_retry_after=60)
+    # 窗口内完成300个token, 吞吐量为10 token/s
+    for _ in range(3):
+        controller.admit(100).release()
+    held = controller.admit(60)
+
+    error = _rejection(controller, 135)
+    assert error.status_code == 429
+    # 超出95个token, 按10 token/s需要10秒
+    assert error.headers['Retry-After'] == '10'
+    assert controller.stats()['rejected'] == 1 and controller.stats()['inflight_tokens'] == 60
+
+    # 上限为max_retry_after
+    assert _rejection(controller, 10000).headers['Retry-After'] == '60'
+    held.release()
+    assert controller.admit(135) is not None
+
+
+def test_retry_after_without_throughput_is_one_second():
+    controller = AdmissionController('chat', max_tokens=100)
+    controller.admit(80)
+    assert _rejection(controller, 30).headers['Retry-After'] == '1'
+
+
+def test_max_requests_and_oversized_request():
+    controller = AdmissionController('chat', max_tokens=100, max_requests=2)
+    # 空闲时超过整个预算的请求仍被接纳
+    big = controller.admit(1000)
+    assert _rejection(controller, 1).status_code == 429
+    big.release()
+    big.release()
+    assert controller.stats()['inflight_requests'] == 0
+
+    tickets = [controller.admit(1), controller.admit(1)]
+    assert _rejection(controller, 1).status_code == 429
+    tickets[0].release()
+    controller.admit(1)
+
+
+def test_admission_per_endpoint():
+    admission = Admission({'chat': {'max_tokens': 10}}, chars_per_token=2.0)
+    assert admission.admit('embeddings', 10 ** 6) is None
+    admission.admit('chat', 8)
+    with pytest.raises(HTTPException):
+        admission.admit('chat', 8)
+    assert admission.estimate_tokens('hello') == 3 and admission.estimate_tokens(None) == 0
+    assert admission.stats()['chat']['inflight_tokens'] == 8
+
+
+def test_http_429_carries_retry_after():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from llmbase.main.common.god import cosmos
+    from llmbase.main.llm.chatglm3.model import EmbeddingRequest
+    from llmbase.main.services.chatglm4_service import ChatGLM4Service
+
+    app = FastAPI()
+
+    @app.post('/v1/embeddings')
+    def embeddings(request: EmbeddingRequest):
+        ChatGLM4Service.admit(request)
+        return {}
+
+    cosmos.admission = Admission({'embeddings': {'max_tokens': 10}})
+    try:
+        client = TestClient(app)
+        cosmos.admission.admit('embeddings', 6)
+        response = client.post('/v1/embeddings', json={'input': ['hello world'], 'model': 'bge'})
+    finally:
+        cosmos.admission = None
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert 'overloaded' in response.json()['detail']
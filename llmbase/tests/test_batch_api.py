@@ -0,0 +1,102 @@
+import io
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from conftest import echo_llm
+from llmbase.main.common.god import cosmos
+from llmbase.main.routers import batches
+from llmbase.main.services.batch_api_service import BatchStore, BatchWorker
+
+
+@pytest.fixture
+def client(tmp_path):
+    cosmos.batch_store = BatchStore(storage_path=str(tmp_path))
+    app = FastAPI()
+    app.include_router(batches.router)
+    yield TestClient(app)
+    cosmos.batch_store = None
+
+
+def _upload(client, rows: int) -> str:
+    lines = [json.dumps({'custom_id': f'row-{index}', 'method': 'POST', 'url': '/v1/chat/completions',
+                         'body': {'model': 'tiny', 'max_tokens': 4,
+                                  'messages': [{'role': 'user', 'content': f'question {index}'}]}})
+             for index in range(rows)]
+    response = client.post('/v1/files', data={'purpose': 'batch'},
+                           files={'file': ('input.jsonl', io.BytesIO('\n'.join(lines).encode()))})
+    assert response.status_code == 200
+    return response.json()['id']
+
+
+def _create_batch(client, file_id: str) -> str:
+    response = client.post('/v1/batches', json={'input_file_id': file_id, 'endpoint': '/v1/chat/completions'})
+    assert response.status_code == 200 and response.json()['status'] == 'validating'
+    return response.json()['id']
+
+
+def _worker(llm, is_idle=lambda: True) -> BatchWorker:
+    return BatchWorker(cosmos.batch_store, llm, is_idle=is_idle, max_batch_rows=2)
+
+
+def _output_custom_ids(client, batch: dict) -> list:
+    response = client.get(f"/v1/files/{batch['output_file_id']}/content")
+    assert response.status_code == 200
+    return [json.loads(line)['custom_id'] for line in response.text.splitlines()]
+
+
+def test_upload_batch_output(client):
+    batch_id = _create_batch(client, _upload(client, 5))
+    worker = _worker(echo_llm())
+    worker._process(worker._next_batch())
+
+    batch = client.get(f'/v1/batches/{batch_id}').json()
+    assert batch['status'] == 'completed'
+    assert batch['request_counts'] == {'total': 5, 'completed': 5, 'failed': 0}
+    assert _output_custom_ids(client, batch) == [f'row-{index}' for index in range(5)]
+    assert client.get(f"/v1/files/{batch['output_file_id']}").json()['purpose'] == 'batch_output'
+    assert client.get('/v1/batches').json()['data'][0]['id'] == batch_id
+
+
+def test_resume_after_interactive_traffic(client):
+    batch_id = _create_batch(client, _upload(client, 5))
+    # 第一批之后服务变忙, 任务暂停; 空闲后从检查点继续
+    idle = iter([True, False])
+    llm = echo_llm()
+    worker = _worker(llm, is_idle=lambda: next(idle, True))
+    worker._process(worker._next_batch())
+    batch = client.get(f'/v1/batches/{batch_id}').json()
+    assert batch['status'] == 'in_progress' and llm.model.prompts == 2
+
+    worker._process(worker._next_batch())
+    batch = client.get(f'/v1/batches/{batch_id}').json()
+    assert batch['status'] == 'completed' and llm.model.prompts == 5
+    assert _output_custom_ids(client, batch) == [f'row-{index}' for index in range(5)]
+
+
+def test_cancel(client):
+    # 尚未开始的任务直接取消
+    batch_id = _create_batch(client, _upload(client, 2))
+    assert client.post(f'/v1/batches/{batch_id}/cancel').json()['status'] == 'cancelled'
+    assert client.post(f'/v1/batches/{batch_id}/cancel').status_code == 400
+
+    # 执行中的任务在当前批次结束后取消
+    batch_id = _create_batch(client, _upload(client, 6))
+    llm = echo_llm(on_generate=lambda: client.post(f'/v1/batches/{batch_id}/cancel'))
+    worker = _worker(llm)
+    worker._process(worker._next_batch())
+    batch = client.get(f'/v1/batches/{batch_id}').json()
+    assert batch['status'] == 'cancelled' and batch['cancelled_at'] is not None
+    assert llm.model.prompts == 2
+    assert worker._next_batch() is None
+
+
+def test_unknown_ids(client):
+    assert client.get('/v1/batches/batch_missing').status_code == 404
+    assert client.post('/v1/batches/batch_missing/cancel').status_code == 404
+    assert client.get('/v1/files/file-missing').status_code == 404
+    assert client.post('/v1/batches', json={'input_file_id': 'file-missing',
+                                            'endpoint': '/v1/chat/completions'}).status_code == 404
+    assert cosmos.batch_store.update_batch('batch_missing', status='cancelled') is None
@@ -0,0 +1,150 @@
+import torch
+
+from conftest import ByteTokenizer, TinyCausalLM
+from llmbase.main.engine.control import GenerationControl
+from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+from llmbase.main.llm.chatglm3.model import ChatMessage
+from llmbase.main.llm.chatglm3.utils import (batch_gen_kwargs, bucket_by_length, generate_batch_chatglm3,
+                                             generate_chatglm3)
+
+
+def _params(max_tokens: int, **kwargs) -> dict:
+    params = dict(messages=[ChatMessage(role='user', content='hello')], tools=None, temperature=0.0, top_p=1.0,
+                  repetition_penalty=1.0, max_tokens=max_tokens, echo=False)
+    params.update(kwargs)
+    return params
+
+
+def test_engine_length_finish_reason(tiny_model, tiny_tokenizer):
+    model = tiny_model()
+    engine = ContinuousBatchingEngine(model, tiny_tokenizer)
+    engine.start()
+    try:
+        # 达到max_tokens时引擎以'length'结束序列
+        response = generate_chatglm3(model, tiny_tokenizer, _params(4), engine=engine)
+        assert response['finish_reason'] == 'length'
+        assert response['usage']['completion_tokens'] == 4
+    finally:
+        engine.stop()
+
+
+def test_stream_generate_length_finish_reason(tiny_model, tiny_tokenizer):
+    # 不经过引擎时同样以'length'报告用完max_tokens
+    response = generate_chatglm3(tiny_model(), tiny_tokenizer, _params(4))
+    assert response['finish_reason'] == 'length'
+    assert response['usage']['completion_tokens'] == 4
+
+
+def test_bucket_by_length_caps_padding_waste():
+    lengths = [10, 100, 12, 95, 11, 50]
+    buckets = bucket_by_length(lengths, max_padding_ratio=0.2)
+    assert buckets == [[0, 4, 2], [5], [3, 1]]
+    for bucket in buckets:
+        padded = max(lengths[index] for index in bucket) * len(bucket)
+        assert 1 - sum(lengths[index] for index in bucket) / padded <= 0.2
+    # 不限制时只有一个桶
+    assert bucket_by_length(lengths) == [[0, 4, 2, 5, 3, 1]]
+
+
+def test_bucket_by_length_single_items_and_size_cap():
+    assert bucket_by_length([5, 500, 50], max_padding_ratio=0.0) == [[0], [2], [1]]
+    assert bucket_by_length([7, 7, 7, 7, 7], max_bucket_size=2) == [[0, 1], [2, 3], [4]]
+    assert bucket_by_length([]) == []
+
+
+class _ScriptedModel(object):
+    """
+    model.generate returning a fixed completion per prompt (keyed by its first token), padded like HF generate.
+    """
+    device = torch.device('cpu')
+
+    def __init__(self, completions: dict, on_generate=None):
+        self.completions = completions
+        self.on_generate = on_generate
+        self.calls = 0
+
+    def generate(self, input_ids, attention_mask=None, stopping_criteria=None, **kwargs):
+        self.calls += 1
+        rows = []
+        for ids, mask in zip(input_ids, attention_mask):
+            first = int(ids[mask.bool()][0])
+            rows.append(self.completions[first])
+        width = max(len(row) for row in rows)
+        outputs = torch.cat((input_ids, torch.tensor([row + [0] * (width - len(row)) for row in rows])), dim=1)
+        if self.on_generate is not None:
+            self.on_generate()
+        return outputs
+
+
+def test_generate_batch_restores_order_and_labels_rows():
+    tokenizer = ByteTokenizer()
+    # 10和20在同一个桶, 30单独一个桶; eos为0和1
+    encoded = [[30] * 9, [10, 11], [20, 21, 22]]
+    control = GenerationControl()
+    model = _ScriptedModel({10: [5, 6, 1], 20: [7, 8, 9], 30: [4, 0]},
+                           # 第一个桶生成完成后截止时间已到
+                           on_generate=lambda: setattr(control, 'deadline', 0.0))
+    gen_kwargs = {'eos_token_id': [0, 1], 'max_new_tokens': 3}
+    results = generate_batch_chatglm3(model, tokenizer, encoded, gen_kwargs, max_padding_ratio=0.4, control=control)
+
+    assert model.calls == 1
+    # 第二个桶因截止时间未执行
+    assert results[0] == {'text': '', 'usage': {'prompt_tokens': 9, 'completion_tokens': 0, 'total_tokens': 9},
+                          'finish_reason': 'length'}
+    # 已生成eos的行仍为'stop', 只有达到上限的行为'length'
+    assert results[1]['finish_reason'] == 'stop' and results[1]['text'] == tokenizer.decode([5, 6])
+    assert results[2]['finish_reason'] == 'length' and results[2]['text'] == tokenizer.decode([7, 8, 9])
+    assert results[2]['usage'] == {'prompt_tokens': 3, 'completion_tokens': 3, 'total_tokens': 6}
+
+
+class _SpecialsTokenizer(ByteTokenizer):
+    """
+    ByteTokenizer whose eos is an ordinary TinyCausalLM token, decoded like ChatGLM3 special tokens
+    ('<|user|>', '<unk>' for padding) unless skip_special_tokens.
+    """
+    eos_token_id = 12
+
+    def decode(self, token_ids, skip_special_tokens: bool = False) -> str:
+        specials = {self.eos_token_id: '<|user|>', self.pad_token_id: '<unk>'}
+        text = ''
+        for token_id in map(int, token_ids):
+            if token_id not in specials:
+                text += super().decode([token_id])
+            elif not skip_special_tokens:
+                text += specials[token_id]
+        return text
+
+
+class _GreedyBatchLM(TinyCausalLM):
+    """
+    TinyCausalLM with a greedy model.generate over left-padded rows; like HF generate, rows that reached eos are
+    filled with padding until the longest row finishes.
+    """
+
+    def generate(self, input_ids, attention_mask=None, eos_token_id=(), max_new_tokens=16, **kwargs):
+        rows = []
+        for ids, mask in zip(input_ids, attention_mask):
+            prompt = ids[mask.bool()].unsqueeze(0)
+            *_, total_ids = self.stream_generate(prompt, eos_token_id=eos_token_id, max_new_tokens=max_new_tokens)
+            rows.append(total_ids[0, prompt.shape[1]:].tolist())
+        width = max(len(row) for row in rows)
+        return torch.cat((input_ids, torch.tensor([row + [0] * (width - len(row)) for row in rows])), dim=1)
+
+
+def test_generate_batch_matches_single_requests():
+    model, tokenizer = _GreedyBatchLM(), _SpecialsTokenizer()
+    # 'hello'和'ok'在不同位置生成eos, 其余两条达到max_tokens
+    queries = ['hello', 'hi', 'what is the weather like today', 'ok']
+    encoded = [tokenizer.build_chat_input(query)['input_ids'][0].tolist() for query in queries]
+    results = generate_batch_chatglm3(model, tokenizer, encoded, batch_gen_kwargs(tokenizer, 0.0, 1.0, 1.0, 12))
+
+    engine = ContinuousBatchingEngine(model, tokenizer)
+    engine.start()
+    try:
+        singles = [generate_chatglm3(model, tokenizer, _params(12, messages=[ChatMessage(role='user', content=query)]),
+                                     engine=engine) for query in queries]
+    finally:
+        engine.stop()
+    assert [result['finish_reason'] for result in results] == ['stop', 'length', 'length', 'stop']
+    assert [result['text'] for result in results] == [single['text'] for single in singles]
+    assert [result['finish_reason'] for result in results] == [single['finish_reason'] for single in singles]
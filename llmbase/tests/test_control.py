@@ -0,0 +1,185 @@
+import time
+
+import torch
+from transformers import StoppingCriteriaList
+
+from conftest import ByteTokenizer, TinyCausalLM
+from llmbase.main.engine.control import ControlStoppingCriteria, GenerationControl
+from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+from llmbase.main.llm.chatglm3.model import ChatMessage
+from llmbase.main.llm.chatglm3.utils import generate_batch_chatglm3, generate_stream_chatglm3
+
+
+class SlowLM(TinyCausalLM):
+    """
+    TinyCausalLM taking a few milliseconds per forward, so that a request is still running when it is stopped.
+    """
+
+    def __init__(self, layout: str = 'batch_first', delay: float = 0.005):
+        super().__init__(layout)
+        self.delay = delay
+        self.forwards = 0
+
+    def forward(self, *args, **kwargs):
+        self.forwards += 1
+        time.sleep(self.delay)
+        return super().forward(*args, **kwargs)
+
+
+def _params(control: GenerationControl, max_tokens: int = 200) -> dict:
+    return dict(messages=[ChatMessage(role='user', content='hello')], tools=None, temperature=0.0, top_p=1.0,
+                repetition_penalty=1.0, max_tokens=max_tokens, echo=False, control=control)
+
+
+def _wait(predicate, timeout: float = 5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end
+        time.sleep(0.005)
+
+
+def test_cancel_runs_callbacks_once():
+    before = GenerationControl.stats()['cancellations']
+    control = GenerationControl()
+    calls = []
+    control.on_cancel(lambda: calls.append('registered'))
+    control.cancel('timeout')
+    control.cancel()
+    # 取消之后注册的回调立即执行
+    control.on_cancel(lambda: calls.append('late'))
+    assert calls == ['registered', 'late']
+    assert control.cancelled and control.reason == 'timeout' and not control.expired
+    assert GenerationControl.stats()['cancellations'] == before + 1
+
+
+def test_stopping_criteria_stops_stream_generate_on_cancel():
+    model = TinyCausalLM()
+    control = GenerationControl()
+    criteria = StoppingCriteriaList([ControlStoppingCriteria(control)])
+    steps = 0
+    for _ in model.stream_generate(torch.tensor([[5, 6, 7]]), max_new_tokens=20, stopping_criteria=criteria):
+        steps += 1
+        if steps == 3:
+            control.cancel()
+    # 取消后不再计算下一个token
+    assert steps == 3
+
+
+def test_cancel_retires_engine_sequence_without_reader():
+    model = SlowLM()
+    engine = ContinuousBatchingEngine(model, ByteTokenizer())
+    engine.start()
+    try:
+        control = GenerationControl()
+        stream = generate_stream_chatglm3(model, ByteTokenizer(), _params(control), engine=engine)
+        next(stream)
+        # 不再读取输出, 引擎仍在下一步之前退出该序列
+        control.cancel()
+        _wait(engine.is_idle)
+        assert engine.stats()['cancelled'] == 1
+        assert model.forwards < 100
+        stream.close()
+    finally:
+        engine.stop()
+
+
+def test_cancel_stops_stream_generate_path():
+    model = SlowLM()
+    control = GenerationControl()
+    wasted = GenerationControl.stats()['wasted_tokens']
+    stream = generate_stream_chatglm3(model, ByteTokenizer(), _params(control))
+    next(stream)
+    control.cancel()
+    *_, last = stream
+    assert model.forwards < 10
+    assert 0 < last['usage']['completion_tokens'] < 10
+    assert GenerationControl.stats()['wasted_tokens'] == wasted + last['usage']['completion_tokens']
+
+
+class _RecordingModel(object):
+    """
+    model.generate completing every prompt with two tokens, after_generate runs after each call.
+    """
+    device = torch.device('cpu')
+
+    def __init__(self, after_generate=None):
+        self.after_generate = after_generate
+        self.calls = 0
+
+    def generate(self, input_ids, attention_mask=None, stopping_criteria=None, **kwargs):
+        self.calls += 1
+        if self.after_generate is not None:
+            self.after_generate()
+        return torch.cat((input_ids, torch.full((len(input_ids), 2), 7)), dim=1)
+
+
+def test_cancel_skips_remaining_buckets():
+    control = GenerationControl()
+    model = _RecordingModel(after_generate=control.cancel)
+    # 长度相差很大, 每个prompt一个桶
+    encoded = [[5] * 2, [5] * 20, [5] * 60]
+    results = generate_batch_chatglm3(model, ByteTokenizer(), encoded, {'eos_token_id': [0], 'max_new_tokens': 2},
+                                      max_padding_ratio=0.1, control=control)
+    assert model.calls == 1
+    assert [result['usage']['completion_tokens'] for result in results] == [2, 0, 0]
+
+
+class ExpiringLM(TinyCausalLM):
+    """
+    stream_generate ending with eos, whose request deadline passes right after generation finished on its own.
+    """
+    control: GenerationControl = None
+
+    def stream_generate(self, input_ids, eos_token_id=(), max_new_tokens=16, **kwargs):
+        ids = input_ids
+        for ids in super().stream_generate(input_ids, eos_token_id, max_new_tokens - 1, **kwargs):
+            yield ids
+        yield torch.cat((ids, torch.tensor([[eos_token_id[0]]])), dim=1)
+        self.control.deadline = 0.0
+
+
+def test_deadline_finishes_engine_sequence_with_length():
+    model = SlowLM()
+    engine = ContinuousBatchingEngine(model, ByteTokenizer())
+    engine.start()
+    try:
+        *_, last = generate_stream_chatglm3(model, ByteTokenizer(), _params(GenerationControl(timeout=0.05)),
+                                            engine=engine)
+    finally:
+        engine.stop()
+    assert last['finish_reason'] == 'length'
+    assert 0 < last['usage']['completion_tokens'] < 200
+    assert engine.stats()['expired'] == 1
+
+
+def test_deadline_stops_stream_generate_with_length():
+    model = SlowLM()
+    *_, last = generate_stream_chatglm3(model, ByteTokenizer(), _params(GenerationControl(timeout=0.05)))
+    assert last['finish_reason'] == 'length'
+    assert model.forwards < 100
+
+    # 开始之前已超时
+    model = SlowLM()
+    *_, last = generate_stream_chatglm3(model, ByteTokenizer(), _params(GenerationControl(timeout=0.0)))
+    assert last['finish_reason'] == 'length' and last['usage']['completion_tokens'] == 0
+    assert model.forwards == 0
+
+
+def test_deadline_passing_after_natural_finish_is_stop():
+    model = ExpiringLM()
+    model.control = GenerationControl(timeout=60.0)
+    *_, last = generate_stream_chatglm3(model, ByteTokenizer(), _params(model.control, max_tokens=4))
+    assert model.control.expired
+    assert last['finish_reason'] == 'stop'
+
+
+def test_deadline_skips_remaining_buckets():
+    control = GenerationControl(timeout=60.0)
+    model = _RecordingModel(after_generate=lambda: setattr(control, 'deadline', 0.0))
+    encoded = [[5] * 2, [5] * 20, [5] * 60]
+    results = generate_batch_chatglm3(model, ByteTokenizer(), encoded, {'eos_token_id': [7], 'max_new_tokens': 2},
+                                      max_padding_ratio=0.1, control=control)
+    assert model.calls == 1
+    # 第一个桶生成了eos(只计到第一个eos), 其余的桶因截止时间未执行
+    assert [result['finish_reason'] for result in results] == ['stop', 'length', 'length']
+    assert [result['usage']['completion_tokens'] for result in results] == [1, 0, 0]
@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import ByteTokenizer
+from llmbase.main.engine.detokenizer import IncrementalDetokenizer
+
+TEXT = 'Hello, 世界! naïve café 🙂 done'
+
+
+@pytest.mark.parametrize('step', [1, 2, 3, 5])
+def test_split_multibyte_characters_match_full_decode(step):
+    tokenizer = ByteTokenizer(offset=0)
+    token_ids = list(TEXT.encode())
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add_tokens(token_ids[start:start + step]) for start in range(0, len(token_ids), step)]
+
+    # 多字节字符被拆到几步时, 不完整的部分不输出
+    assert all('�' not in delta for delta in deltas)
+    assert ''.join(deltas) == detokenizer.text == tokenizer.decode(token_ids) == TEXT
+
+
+def test_incomplete_character_is_held_back():
+    detokenizer = IncrementalDetokenizer(ByteTokenizer(offset=0))
+    emoji = list('🙂'.encode())
+    assert detokenizer.add_tokens(list(b'ok')) == 'ok'
+    assert [detokenizer.add_tokens([byte]) for byte in emoji] == ['', '', '', '🙂']
@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from llmbase.main.engine.embedding import EmbeddingEncoder
+
+
+class _WordTokenizer(object):
+    """
+    One token per whitespace separated word plus [CLS] and [SEP], like a BERT tokenizer on plain words.
+    """
+
+    def __call__(self, texts, truncation=False, max_length=None):
+        input_ids = []
+        for text in texts:
+            ids = [101] + [len(word) for word in text.split()] + [102]
+            input_ids.append(ids[:max_length] if truncation and max_length else ids)
+        return {'input_ids': input_ids}
+
+
+class _FakeSentenceTransformer(object):
+    """
+    SentenceTransformer.encode stand-in: the vector of a text is (number of characters, first character code),
+    every call is recorded.
+    """
+    max_seq_length = 4
+
+    def __init__(self):
+        self.tokenizer = _WordTokenizer()
+        self.calls = []
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, show_progress_bar=False):
+        self.calls.append((list(texts), batch_size))
+        return np.array([[len(text), ord(text[0])] for text in texts], dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+
+def _vectors(texts):
+    return np.array([[len(text), ord(text[0])] for text in texts], dtype=np.float32)
+
+
+def test_encode_in_one_call_in_input_order():
+    model = _FakeSentenceTransformer()
+    encoder = EmbeddingEncoder(model, batch_size=8)
+    texts = ['a long sentence here', 'b', 'cc cc']
+    embeddings = encoder.encode(texts)
+    assert embeddings.dtype == np.float32
+    assert np.array_equal(embeddings, _vectors(texts))
+    # 整个请求一次encode, 由SentenceTransformer按batch_size分批
+    assert model.calls == [(texts, 8)]
+    assert encoder.stats()['requests'] == 1 and encoder.stats()['texts'] == 3
+
+
+def test_count_tokens_truncates_at_max_seq_length():
+    encoder = EmbeddingEncoder(_FakeSentenceTransformer())
+    # 'one two'为4个token, 'one two three four'截断为max_seq_length=4
+    assert encoder.count_tokens(['one two', 'one two three four']) == 8
+    assert encoder.stats()['tokens'] == 8
+
+
+def test_cache_encodes_only_new_texts_once():
+    model = _FakeSentenceTransformer()
+    encoder = EmbeddingEncoder(model, model_id='bge', cache={'enable': True, 'max_entries': 16})
+    first = ['x', 'yy', 'x', 'zzz']
+    assert np.array_equal(encoder.encode(first), _vectors(first))
+    # 请求内重复的文本只编码一次
+    assert model.calls[-1][0] == ['x', 'yy', 'zzz']
+
+    second = ['zzz', 'new', 'x']
+    assert np.array_equal(encoder.encode(second), _vectors(second))
+    assert model.calls[-1][0] == ['new']
+
+    # 全部命中时不调用模型
+    calls = len(model.calls)
+    assert np.array_equal(encoder.encode(['yy', 'new']), _vectors(['yy', 'new']))
+    assert len(model.calls) == calls
+    assert encoder.stats()['cache']['misses'] == 5
+
+
+def test_cache_disabled():
+    model = _FakeSentenceTransformer()
+    encoder = EmbeddingEncoder(model, cache={'enable': False, 'max_entries': 16})
+    encoder.encode(['x'])
+    encoder.encode(['x'])
+    assert encoder.cache is None and len(model.calls) == 2
+
+
+@pytest.mark.parametrize('cache', [None, {'enable': True, 'max_entries': 16}])
+def test_empty_input(cache):
+    model = _FakeSentenceTransformer()
+    encoder = EmbeddingEncoder(model, cache=cache)
+    assert encoder.encode([]).shape == (0, 2)
+    assert encoder.count_tokens([]) == 0
+    assert model.calls == []
+
+
+def test_cache_without_model_id(tmp_path):
+    # model_id为None时(未配置embedding_model_path)仍可缓存, 包括持久化存储
+    encoder = EmbeddingEncoder(_FakeSentenceTransformer(), model_id=None,
+                               cache={'enable': True, 'disk_path': str(tmp_path), 'disk_entries': 8})
+    assert np.array_equal(encoder.encode(['x', 'x']), _vectors(['x', 'x']))
+
+
+def test_attach_runtime_falls_back_to_model_name():
+    from llmbase.main import attach_runtime
+    llm = SimpleNamespace(embedding=_FakeSentenceTransformer(), embedding_encoder=None, engine=None,
+                          micro_batcher=None, model_name='glm-4-9b-chat')
+    attach_runtime(SimpleNamespace(EMBEDDING_CONFIG={'cache': {'enable': True}}), llm, {})
+    assert llm.embedding_encoder.cache.model_id == 'glm-4-9b-chat'
+    assert np.array_equal(llm.embedding_encoder.encode(['hello']), _vectors(['hello']))
+
+
+def test_no_encoder_without_embedding_model():
+    from llmbase.main import attach_runtime
+    llm = SimpleNamespace(embedding=None, embedding_encoder=None, engine=None, micro_batcher=None)
+    attach_runtime(SimpleNamespace(EMBEDDING_CONFIG={'batch_size': 8, 'cache': {'enable': True}}), llm, {})
+    assert llm.embedding_encoder is None
+
+
+def test_embeddings_without_encoder_is_501():
+    from fastapi import HTTPException
+
+    from llmbase.main.llm.chatglm3.model import EmbeddingRequest
+    from llmbase.main.services.chatglm4_service import ChatGLM4Service
+    llm = SimpleNamespace(embedding_encoder=None, model_name='InternLMChat20B')
+    with pytest.raises(HTTPException) as error:
+        ChatGLM4Service.get_embeddings(EmbeddingRequest(input=['hello'], model='bge'), llm=llm)
+    assert error.value.status_code == 501
@@ -0,0 +1,69 @@
+import numpy as np
+
+from llmbase.main.engine.embedding_cache import KEY_BYTES, EmbeddingCache, MmapVectorStore
+
+
+def _key(n: int) -> bytes:
+    return n.to_bytes(KEY_BYTES, 'big')
+
+
+def _vectors(*values) -> np.ndarray:
+    return np.array([[value] * 4 for value in values], dtype=np.float32)
+
+
+def test_ring_wraps_around_and_evicts_oldest(tmp_path):
+    store = MmapVectorStore(str(tmp_path), capacity=3)
+    store.put_many([_key(1), _key(2), _key(3)], _vectors(1, 2, 3))
+    assert len(store) == 3
+
+    # 第4, 5次写入覆盖最早的两个槽位
+    store.put_many([_key(4), _key(5)], _vectors(4, 5))
+    assert store.get(_key(1)) is None and store.get(_key(2)) is None
+    assert [store.get(_key(n))[0] for n in (3, 4, 5)] == [3, 4, 5]
+    assert len(store) == 3
+
+    # 已有的key不重复写入, 不占用槽位
+    store.put_many([_key(5), _key(6)], _vectors(50, 6))
+    assert store.get(_key(5))[0] == 5 and store.get(_key(3)) is None
+
+
+def test_second_store_sees_vectors_of_the_first(tmp_path):
+    writer = MmapVectorStore(str(tmp_path), capacity=4)
+    writer.put_many([_key(1), _key(2)], _vectors(1, 2))
+
+    # 另一个进程打开同一目录, 容量与维度以已有文件为准
+    reader = MmapVectorStore(str(tmp_path), capacity=100)
+    assert (reader.capacity, reader.dim) == (4, 4)
+    assert np.array_equal(reader.get(_key(2)), _vectors(2)[0])
+
+    # 打开之后的写入(包括环绕覆盖)在下次读取时可见
+    writer.put_many([_key(3), _key(4), _key(5)], _vectors(3, 4, 5))
+    assert reader.get(_key(5))[0] == 5
+    assert reader.get(_key(1)) is None
+    assert len(reader) == 4
+
+    # 读者写入的向量写到共享的下一个槽位
+    reader.put_many([_key(6)], _vectors(6))
+    assert writer.get(_key(6))[0] == 6 and writer.get(_key(2)) is None
+
+
+def test_store_created_lazily_by_another_process(tmp_path):
+    reader = MmapVectorStore(str(tmp_path))
+    assert reader.get(_key(1)) is None and reader.dim is None
+    MmapVectorStore(str(tmp_path), capacity=2).put_many([_key(1)], _vectors(1))
+    assert reader.get(_key(1))[0] == 1
+
+
+def test_embedding_cache_disk_hits_across_instances(tmp_path):
+    first = EmbeddingCache('model-a', max_entries=1, disk_path=str(tmp_path), disk_entries=8)
+    first.put_many(['a', 'b'], _vectors(1, 2))
+    # 进程内LRU只保留'b', 'a'从磁盘读出
+    assert first.get_many(['a'])[0][0] == 1
+    assert first.stats()['disk_hits'] == 1 and first.stats()['evictions'] == 2
+
+    second = EmbeddingCache('model-a', disk_path=str(tmp_path))
+    assert [vector[0] for vector in second.get_many(['a', 'b'])] == [1, 2]
+    assert second.stats()['disk_hits'] == 2
+    # 不同模型的向量互不命中
+    other = EmbeddingCache('model-b', disk_path=str(tmp_path))
+    assert other.get_many(['a']) == [None]
@@ -0,0 +1,73 @@
+import base64
+
+import numpy as np
+import orjson
+import pytest
+
+from llmbase.main.engine.embedding_codec import encode_embedding_response, truncate_dimensions
+
+
+@pytest.fixture
+def embeddings():
+    vectors = np.random.default_rng(0).standard_normal((3, 32)).astype(np.float32)
+    vectors[2] = 0.0
+    return vectors
+
+
+def _decode(embeddings: np.ndarray, encoding_format: str) -> list:
+    response = orjson.loads(encode_embedding_response(embeddings, encoding_format, 'bge', 7))
+    assert response['object'] == 'list' and response['model'] == 'bge'
+    assert response['usage'] == {'prompt_tokens': 7, 'completion_tokens': 0, 'total_tokens': 7}
+    assert [item['index'] for item in response['data']] == list(range(len(embeddings)))
+    return response['data']
+
+
+def test_float_and_base64_keep_openai_shape(embeddings):
+    data = _decode(embeddings, 'float')
+    assert set(data[0]) == {'object', 'embedding', 'index'}
+    assert np.allclose(np.array([item['embedding'] for item in data], dtype=np.float32), embeddings)
+
+    data = _decode(embeddings, 'base64')
+    assert set(data[0]) == {'object', 'embedding', 'index'}
+    decoded = np.stack([np.frombuffer(base64.b64decode(item['embedding']), dtype='<f4') for item in data])
+    assert np.array_equal(decoded, embeddings)
+
+
+def test_float16_round_trip(embeddings):
+    decoded = np.stack([np.frombuffer(base64.b64decode(item['embedding']), dtype='<f2')
+                        for item in _decode(embeddings, 'float16')])
+    assert np.allclose(decoded, embeddings, rtol=1e-3, atol=1e-3)
+
+
+def test_int8_round_trip_with_scale(embeddings):
+    data = _decode(embeddings, 'int8')
+    assert set(data[0]) == {'object', 'embedding', 'index', 'scale'}
+    for item, vector in zip(data, embeddings):
+        quantized = np.frombuffer(base64.b64decode(item['embedding']), dtype=np.int8)
+        assert np.abs(quantized).max() in (0, 127)
+        assert np.allclose(quantized * item['scale'], vector, atol=item['scale'] / 2 + 1e-6)
+    # 全零向量的scale为1
+    assert data[2]['scale'] == 1.0
+
+
+def test_binary_round_trip(embeddings):
+    data = _decode(embeddings, 'binary')
+    bits = np.stack([np.unpackbits(np.frombuffer(base64.b64decode(item['embedding']), dtype=np.uint8))
+                     for item in data])
+    assert np.array_equal(bits[:, :32].astype(bool), embeddings > 0)
+
+
+def test_unknown_format(embeddings):
+    with pytest.raises(ValueError):
+        encode_embedding_response(embeddings, 'int4', 'bge', 1)
+
+
+def test_dimensions_renormalise(embeddings):
+    truncated = truncate_dimensions(embeddings, 8)
+    assert truncated.shape == (3, 8)
+    assert np.allclose(np.linalg.norm(truncated[:2], axis=1), 1.0)
+    assert np.allclose(truncated[0], embeddings[0, :8] / np.linalg.norm(embeddings[0, :8]))
+    # 全零向量保持为零
+    assert not truncated[2].any()
+    assert truncate_dimensions(embeddings, None) is embeddings
+    assert truncate_dimensions(embeddings, 64) is embeddings
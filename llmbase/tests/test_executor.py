@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llmbase.main.common.tool import timing
+from llmbase.main.engine.executor import IsolatedExecutor, QueueFullError
+
+
+def _wait(predicate, timeout: float = 5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end
+        time.sleep(0.005)
+
+
+def test_rejects_when_workers_and_queue_are_full():
+    executor = IsolatedExecutor('test', max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def main():
+        # 一个执行中, 一个排队, 第三个被拒绝
+        running = asyncio.ensure_future(executor.run(release.wait))
+        queued = asyncio.ensure_future(executor.run(lambda: 'queued'))
+        await asyncio.sleep(0.05)
+        assert executor.stats()['running'] == 1 and executor.stats()['queued'] == 1
+        with pytest.raises(QueueFullError):
+            await executor.run(lambda: 'rejected')
+        release.set()
+        return await running, await queued
+
+    try:
+        assert asyncio.run(main()) == (True, 'queued')
+    finally:
+        executor.shutdown()
+    stats = executor.stats()
+    assert stats['rejected'] == 1 and stats['completed'] == 2
+    assert stats['running'] == 0 and stats['queued'] == 0
+
+
+def test_wait_and_run_stats():
+    executor = IsolatedExecutor('test', max_workers=1, max_queue=4)
+
+    async def main():
+        await asyncio.gather(*(executor.run(time.sleep, 0.05) for _ in range(3)))
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+    stats = executor.stats()
+    assert stats['completed'] == 3
+    assert stats['avg_run_ms'] >= 50
+    # 单个worker, 后两个调用分别等待约50ms和100ms
+    assert stats['max_wait_ms'] >= 95
+    assert stats['avg_wait_ms'] >= 45
+
+
+def test_cancelled_caller_keeps_slot_until_worker_finishes():
+    executor = IsolatedExecutor('test', max_workers=1, max_queue=0)
+    started, release = threading.Event(), threading.Event()
+
+    def work():
+        started.set()
+        release.wait()
+
+    async def main():
+        task = asyncio.ensure_future(executor.run(work))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # 工作线程仍在执行, 名额不能提前释放
+        with pytest.raises(QueueFullError):
+            await executor.run(lambda: None)
+        release.set()
+        await asyncio.get_running_loop().run_in_executor(None, _wait, lambda: executor.stats()['completed'] == 1)
+        return await executor.run(lambda: 'next')
+
+    try:
+        assert asyncio.run(main()) == 'next'
+    finally:
+        executor.shutdown()
+
+
+def test_runs_with_caller_context():
+    executor = IsolatedExecutor('test')
+
+    async def timed():
+        timer = timing.start(1.0, '/v1/embeddings')
+
+        def work():
+            with timing.phase('encode'):
+                time.sleep(0.01)
+            return timing.current()
+
+        assert await executor.run(work) is timer
+        return timer
+
+    try:
+        timer = asyncio.run(timed())
+    finally:
+        executor.shutdown()
+    assert timer.phases['encode'] >= 0.01
+
+
+def test_queue_full_is_503(monkeypatch):
+    from fastapi import HTTPException
+
+    from llmbase.main.common.god import cosmos
+    from llmbase.main.llm.chatglm3.model import EmbeddingRequest
+    from llmbase.main.routers import openai
+    from llmbase.main.services.chatglm4_service import ChatGLM4Service
+
+    class _FullExecutor(object):
+        async def run(self, fn, *args):
+            raise QueueFullError('embedding queue is full')
+
+    monkeypatch.setattr(cosmos, 'embedding_executor', _FullExecutor(), raising=False)
+    monkeypatch.setattr(ChatGLM4Service, 'require_ready', staticmethod(lambda: None))
+    monkeypatch.setattr(ChatGLM4Service, 'admit', staticmethod(lambda request: None))
+    monkeypatch.setattr(ChatGLM4Service, 'route', staticmethod(lambda request: (None, [])))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(openai.get_embeddings(EmbeddingRequest(input=['hello'], model='bge')))
+    assert error.value.status_code == 503
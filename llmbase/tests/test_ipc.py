@@ -0,0 +1,167 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from fastapi import HTTPException
+from sse_starlette.sse import EventSourceResponse
+
+from llmbase.main.ipc.client import EngineClient
+from llmbase.main.ipc.protocol import CHUNK, END, ERROR, REQUEST, RESULT, read_frame, write_frame
+from llmbase.main.ipc.server import EngineServer
+
+
+class _Writer(object):
+    def __init__(self):
+        self.data = b''
+
+    def writelines(self, chunks):
+        self.data += b''.join(chunks)
+
+
+def test_frames_round_trip():
+    frames = [(REQUEST, b'chat\n{"model": "glm"}'), (CHUNK, '数据'.encode()), (END, b''), (RESULT, b'x' * 70000),
+              (ERROR, b'{}')]
+    writer = _Writer()
+    for kind, payload in frames:
+        write_frame(writer, kind, payload)
+    # 1字节类型 + 4字节大端长度
+    assert writer.data[:5] == bytes([REQUEST]) + len(frames[0][1]).to_bytes(4, 'big')
+
+    async def _read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(writer.data[:-1])
+        reader.feed_eof()
+        decoded = [await read_frame(reader) for _ in frames[:-1]]
+        with pytest.raises(asyncio.IncompleteReadError):
+            await read_frame(reader)
+        return decoded
+
+    assert asyncio.run(_read()) == frames[:-1]
+
+
+def _serve(methods: dict, scenario):
+    """
+    Run `scenario(client)` against an EngineServer whose methods are replaced by `methods`.
+    """
+    async def _run(socket_path):
+        server = EngineServer(socket_path)
+        server._methods = methods
+        serving = asyncio.ensure_future(server.serve_forever())
+        while not os.path.exists(socket_path):
+            await asyncio.sleep(0.01)
+        try:
+            return await scenario(EngineClient(socket_path, connect_timeout=1.0))
+        finally:
+            serving.cancel()
+
+    # Unix socket路径长度有限, 不使用pytest的tmp_path
+    with tempfile.TemporaryDirectory(prefix='ipc', dir='/tmp') as directory:
+        return asyncio.run(_run(os.path.join(directory, 'engine.sock')))
+
+
+async def _overloaded(body, connection):
+    raise HTTPException(status_code=429, headers={'Retry-After': '3'}, detail='chat is overloaded')
+
+
+async def _echo(body, connection):
+    return {'echo': body.decode()}
+
+
+async def _failing(body, connection):
+    raise RuntimeError('boom')
+
+
+def test_errors_keep_status_detail_and_headers():
+    async def scenario(client):
+        errors = []
+        for method in ('overloaded', 'failing', 'missing'):
+            with pytest.raises(HTTPException) as excinfo:
+                await client.call(method)
+            errors.append(excinfo.value)
+        return errors, await client.call('echo', b'hello')
+
+    errors, result = _serve({'overloaded': _overloaded, 'failing': _failing, 'echo': _echo}, scenario)
+    assert (errors[0].status_code, errors[0].detail, errors[0].headers) == (429, 'chat is overloaded',
+                                                                            {'Retry-After': '3'})
+    assert (errors[1].status_code, errors[1].detail) == (500, 'boom')
+    assert errors[2].status_code == 404
+    assert result == b'{"echo":"hello"}'
+
+
+def test_unreachable_engine_is_503():
+    async def scenario():
+        return await EngineClient('/tmp/no-such-engine.sock', connect_timeout=0.5).call('models')
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(scenario())
+    assert excinfo.value.status_code == 503
+
+
+def test_eof_cancels_streaming_request():
+    closed = []
+
+    async def _stream(body, connection):
+        async def events():
+            try:
+                for index in range(1000):
+                    yield f'event {index}'
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.append('closed')
+        return EventSourceResponse(events())
+
+    async def scenario(client):
+        call = await client.open('stream')
+        chunks = call.chunks()
+        received = [await chunks.__anext__(), await chunks.__anext__()]
+        # 前端关闭连接, 引擎关闭事件的迭代器
+        await chunks.aclose()
+        for _ in range(100):
+            if closed:
+                break
+            await asyncio.sleep(0.01)
+        return received
+
+    assert _serve({'stream': _stream}, scenario) == ['event 0', 'event 1']
+    assert closed == ['closed']
+
+
+def test_eof_marks_non_streaming_request_disconnected():
+    seen = []
+
+    async def _slow(body, connection):
+        while not await connection.is_disconnected():
+            await asyncio.sleep(0.01)
+        seen.append('disconnected')
+        raise HTTPException(status_code=499, detail='Client closed request')
+
+    async def scenario(client):
+        opening = asyncio.ensure_future(client.open('slow'))
+        await asyncio.sleep(0.1)
+        # 取消等待中的请求会关闭连接
+        opening.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await opening
+        for _ in range(100):
+            if seen:
+                break
+            await asyncio.sleep(0.01)
+
+    _serve({'slow': _slow}, scenario)
+    assert seen == ['disconnected']
+
+
+def test_streamed_chunks_and_end():
+    async def _stream(body, connection):
+        async def events():
+            for text in ('a', '中', 'c'):
+                yield text
+        return EventSourceResponse(events())
+
+    async def scenario(client):
+        call = await client.open('stream')
+        assert call.streaming
+        return [chunk async for chunk in call.chunks()]
+
+    assert _serve({'stream': _stream}, scenario) == ['a', '中', 'c']
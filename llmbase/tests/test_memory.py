@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+
+import pytest
+
+from llmbase.main.engine import memory
+from llmbase.main.engine.memory import MemoryManager
+
+
+class _FakeCuda(object):
+    """
+    Two GPUs of 100 bytes each, allocated bytes set by the test; counts empty_cache calls.
+    """
+
+    def __init__(self):
+        self.allocated = [0, 0]
+        self.empty_cache_calls = 0
+
+    def is_available(self):
+        return True
+
+    def device_count(self):
+        return len(self.allocated)
+
+    def get_device_properties(self, device):
+        return SimpleNamespace(total_memory=100)
+
+    def memory_allocated(self, device):
+        return self.allocated[device]
+
+    def empty_cache(self):
+        self.empty_cache_calls += 1
+
+
+class _FakeGC(object):
+
+    def __init__(self):
+        self.collects = 0
+        self.frozen = 0
+
+    def collect(self):
+        self.collects += 1
+
+    def freeze(self):
+        self.frozen = 42
+
+    def get_freeze_count(self):
+        return self.frozen
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    cuda, fake_gc, clock = _FakeCuda(), _FakeGC(), SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(memory.torch, 'cuda', cuda)
+    monkeypatch.setattr(memory, 'gc', fake_gc)
+    monkeypatch.setattr(memory, 'time', SimpleNamespace(time=lambda: clock.now))
+    return SimpleNamespace(cuda=cuda, gc=fake_gc, clock=clock)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        MemoryManager(policy='sometimes')
+
+
+def test_allocated_fraction_is_highest_device(fakes):
+    fakes.cuda.allocated = [30, 85]
+    assert MemoryManager.allocated_fraction() == 0.85
+
+
+def test_watermark_reclaims_only_above_high_watermark(fakes):
+    manager = MemoryManager(policy='watermark', high_watermark=0.8, min_interval=5.0)
+    fakes.cuda.allocated = [50, 79]
+    manager.after_request()
+    assert fakes.gc.collects == 0 and fakes.cuda.empty_cache_calls == 0
+
+    fakes.cuda.allocated = [50, 81]
+    manager.after_request()
+    assert fakes.gc.collects == 1 and fakes.cuda.empty_cache_calls == 1
+    assert manager.stats()['reclaims'] == 1
+
+
+def test_watermark_throttled_by_min_interval(fakes):
+    manager = MemoryManager(policy='watermark', high_watermark=0.5, min_interval=5.0)
+    fakes.cuda.allocated = [90, 0]
+    manager.after_request()
+    # 间隔不足min_interval, 即使仍超过水位也不回收
+    fakes.clock.now += 4.9
+    manager.after_request()
+    assert manager.stats()['reclaims'] == 1
+    fakes.clock.now += 0.2
+    manager.after_request()
+    assert manager.stats()['reclaims'] == 2
+
+
+def test_always_and_never(fakes):
+    always = MemoryManager(policy='always', min_interval=60.0)
+    for _ in range(3):
+        always.after_request()
+    # always不受水位和min_interval限制
+    assert always.stats()['reclaims'] == 3 and fakes.cuda.empty_cache_calls == 3
+
+    never = MemoryManager(policy='never')
+    fakes.cuda.allocated = [100, 100]
+    never.after_request()
+    assert never.stats()['reclaims'] == 0 and fakes.gc.collects == 3
+
+
+def test_reclaim_counters(fakes, monkeypatch):
+    manager = MemoryManager(policy='always')
+    # 每次回收的gc.collect耗时20ms
+    monkeypatch.setattr(fakes.gc, 'collect', lambda: setattr(fakes.clock, 'now', fakes.clock.now + 0.02))
+    manager.after_request()
+    manager.after_request()
+    stats = manager.stats()
+    assert stats['reclaims'] == 2
+    assert stats['reclaim_ms'] == pytest.approx(40.0)
+    assert stats['avg_reclaim_ms'] == pytest.approx(20.0)
+
+
+def test_freeze(fakes):
+    MemoryManager(freeze_after_load=False).freeze()
+    assert fakes.gc.collects == 0 and fakes.gc.frozen == 0
+
+    manager = MemoryManager()
+    manager.freeze()
+    assert fakes.gc.collects == 1
+    assert manager.stats()['frozen_objects'] == 42
@@ -0,0 +1,114 @@
+import re
+from collections import defaultdict
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llmbase.main.common.tool import metrics
+from llmbase.main.routers.metrics import router
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _parse(text: str):
+    """
+    Prometheus text format -> ({name: type}, [(name, labels, value)]).
+    """
+    types, samples = {}, []
+    assert text.endswith('\n')
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            types[name] = kind
+        elif line.startswith('# HELP '):
+            continue
+        else:
+            match = _SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            samples.append((name, dict(_LABEL.findall(labels or '')), float(value)))
+    return types, samples
+
+
+def _scrape() -> str:
+    app = FastAPI()
+    app.include_router(router)
+    response = TestClient(app).get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'] == metrics.CONTENT_TYPE
+    return response.text
+
+
+def test_histogram_buckets_are_cumulative():
+    for value in (0.01, 0.07, 0.07, 0.3, 2.0, 45.0):
+        metrics.TIME_TO_FIRST_TOKEN.labels('metrics-test').observe(value)
+    metrics.record_tokens('metrics-test', 'chat', 12, 5)
+
+    types, samples = _parse(_scrape())
+    assert types['llm_time_to_first_token_seconds'] == 'histogram'
+    assert types['llm_prompt_tokens'] == 'counter'
+
+    buckets = [(labels['le'], value) for name, labels, value in samples
+               if name == 'llm_time_to_first_token_seconds_bucket' and labels['model'] == 'metrics-test']
+    bounds = [le for le, _ in buckets]
+    assert bounds[-1] == '+Inf'
+    assert [float(le) for le in bounds[:-1]] == sorted(metrics.TIME_TO_FIRST_TOKEN.buckets)
+    # 整数边界不带小数点, 例如le="1"
+    assert '1' in bounds and '0.025' in bounds
+    counts = [count for _, count in buckets]
+    assert counts == sorted(counts)
+    assert dict(buckets)['0.05'] == 1 and dict(buckets)['0.1'] == 3 and dict(buckets)['30'] == 5
+
+    by_name = {name: value for name, labels, value in samples if labels.get('model') == 'metrics-test'
+               and name in ('llm_time_to_first_token_seconds_count', 'llm_time_to_first_token_seconds_sum')}
+    assert by_name['llm_time_to_first_token_seconds_count'] == counts[-1] == 6
+    assert abs(by_name['llm_time_to_first_token_seconds_sum'] - 47.45) < 1e-9
+    assert ('llm_completion_tokens_total', {'model': 'metrics-test', 'endpoint': 'chat'}, 5.0) in samples
+
+
+def test_every_histogram_series_is_consistent():
+    metrics.REQUEST_DURATION.labels('chat', '200').observe(0.2)
+    _, samples = _parse(_scrape())
+    series = defaultdict(list)
+    counts = {}
+    for name, labels, value in samples:
+        key = tuple(sorted((k, v) for k, v in labels.items() if k != 'le'))
+        if name.endswith('_bucket'):
+            series[(name[:-len('_bucket')], key)].append(value)
+        elif name.endswith('_count'):
+            counts[(name[:-len('_count')], key)] = value
+    assert series
+    for key, values in series.items():
+        assert values == sorted(values) and values[-1] == counts[key], key
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter('escape_test', 'Escaping.', ('path',))
+    counter.labels('a"b\\c\nd').inc()
+    assert counter.render().splitlines()[-1] == 'escape_test_total{path="a\\"b\\\\c\\nd"} 1'
+
+
+def test_load_gauges_sample_once_per_gauge(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', metrics.MetricsRegistry())
+    calls = []
+
+    def sample():
+        calls.append(1)
+        return {'running': 3, 'queue_depth': 1, 'pressure': 0.25}
+
+    # max_age=0: 每次读取都重新采样
+    metrics.bind_load(sample, max_age=0.0)
+    types, samples = _parse(_scrape())
+    assert types['llm_running_sequences'] == 'gauge'
+    values = {name: value for name, _, value in samples}
+    assert values['llm_running_sequences'] == 3 and values['llm_pressure'] == 0.25
+    # 负载中没有的键不输出样本
+    assert 'llm_inflight_tokens' not in values
+    assert len(calls) <= 5
+
+    calls.clear()
+    monkeypatch.setattr(metrics, 'REGISTRY', metrics.MetricsRegistry())
+    metrics.bind_load(sample)
+    metrics.REGISTRY.render()
+    assert len(calls) == 1
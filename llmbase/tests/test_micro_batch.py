@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from llmbase.main.engine.micro_batch import MicroBatcher, MicroBatcherStopped
+
+
+class _Recorder(object):
+    """
+    run_batch that records every call and can be held until released.
+    """
+
+    def __init__(self, hold: bool = False):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def __call__(self, key, items):
+        self.calls.append((key, list(items)))
+        self.started.set()
+        self.release.wait(5)
+        return [f'{key}:{item}' for item in items]
+
+
+def _submit_all(batcher, requests):
+    with ThreadPoolExecutor(len(requests)) as pool:
+        return list(pool.map(lambda request: batcher.submit(*request), requests))
+
+
+def test_window_groups_by_key():
+    recorder = _Recorder()
+    batcher = MicroBatcher(recorder, window_ms=200, max_batch_size=32)
+    batcher.start()
+    try:
+        requests = [('a', 1), ('b', 2), ('a', 3), ('b', 4), ('a', 5)]
+        results = _submit_all(batcher, requests)
+    finally:
+        batcher.stop()
+    assert results == [f'{key}:{item}' for key, item in requests]
+    # 同一窗口内按key分组, 每组一次run_batch
+    assert sorted((key, sorted(items)) for key, items in recorder.calls) == [('a', [1, 3, 5]), ('b', [2, 4])]
+    assert batcher.stats()['batches'] == 2 and batcher.stats()['requests'] == 5
+
+
+def test_max_batch_size_closes_window_early():
+    recorder = _Recorder()
+    batcher = MicroBatcher(recorder, window_ms=5000, max_batch_size=2)
+    batcher.start()
+    try:
+        start_time = time.time()
+        _submit_all(batcher, [('a', item) for item in range(4)])
+        # 不等窗口到期
+        assert time.time() - start_time < 2
+    finally:
+        batcher.stop()
+    assert [len(items) for _, items in recorder.calls] == [2, 2]
+
+
+def test_stop_fails_pending_requests():
+    recorder = _Recorder(hold=True)
+    batcher = MicroBatcher(recorder, window_ms=1, max_batch_size=1)
+    batcher.start()
+    pool = ThreadPoolExecutor(4)
+    try:
+        running = pool.submit(batcher.submit, 'a', 1)
+        assert recorder.started.wait(5)
+        queued = [pool.submit(batcher.submit, 'a', item) for item in (2, 3)]
+        while batcher.stats()['queued'] < 2:
+            time.sleep(0.01)
+        stopping = pool.submit(batcher.stop)
+        time.sleep(0.05)
+        recorder.release.set()
+        stopping.result(5)
+        # 正在执行的批次完成, 排队中的请求失败而不是一直阻塞
+        assert running.result(5) == 'a:1'
+        for future in queued:
+            with pytest.raises(MicroBatcherStopped):
+                future.result(5)
+        with pytest.raises(MicroBatcherStopped):
+            batcher.submit('a', 4)
+    finally:
+        recorder.release.set()
+        pool.shutdown(wait=False)
+    assert [items for _, items in recorder.calls] == [[1]]
@@ -0,0 +1,150 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from llmbase.main.llm.registry import LOADED, OFFLOADED, UNLOADED, ModelNotFound, ModelRegistry
+
+MODEL_BYTES = 400
+
+
+def _llm(name: str):
+    # 100个float32参数, 400字节
+    return SimpleNamespace(name=name, model=torch.nn.Linear(100, 1, bias=False), replicas=None)
+
+
+class Runtime(object):
+    """
+    load/attach/detach callbacks of the registry, records what was called.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def load(self, llm_config: dict):
+        self.calls.append(('load', llm_config['name']))
+        return _llm(llm_config['name'])
+
+    def attach(self, llm):
+        self.calls.append(('attach', llm.name))
+
+    def detach(self, llm):
+        self.calls.append(('detach', llm.name))
+
+
+def _registry(runtime: Runtime, models=('a', 'b'), **kwargs) -> ModelRegistry:
+    registry = ModelRegistry(runtime.load, runtime.attach, runtime.detach, **kwargs)
+    registry.register('default', {'name': 'default'}, llm=_llm('default'), pinned=True, default=True)
+    for name in models:
+        registry.register(name, {'name': name})
+    return registry
+
+
+def _states(registry: ModelRegistry) -> dict:
+    return {name: model['state'] for name, model in registry.stats()['models'].items()}
+
+
+def test_unknown_model_is_not_found_unless_fallback():
+    registry = _registry(Runtime())
+    with pytest.raises(ModelNotFound):
+        registry.acquire('gpt-4')
+    assert registry.acquire(None).llm.name == 'default'
+    assert registry.acquire('gpt-4', fallback_to_default=True).llm.name == 'default'
+    assert _registry(Runtime(), fallback_to_default=True).resolve('gpt-4').name == 'default'
+
+
+def test_lru_eviction_offloads_and_restores():
+    runtime = Runtime()
+    # 默认模型常驻, 另外只能放下一个模型
+    registry = _registry(runtime, models=('a', 'b', 'c'), max_memory=2 * MODEL_BYTES)
+    registry.acquire('a').release()
+    registry.acquire('b').release()
+    assert _states(registry) == {'default': LOADED, 'a': OFFLOADED, 'b': LOADED, 'c': UNLOADED}
+    assert ('detach', 'a') in runtime.calls
+
+    # a恢复到原设备, b被淘汰
+    runtime.calls.clear()
+    lease = registry.acquire('a')
+    assert runtime.calls == [('detach', 'b'), ('attach', 'a')]
+    assert _states(registry) == {'default': LOADED, 'a': LOADED, 'b': OFFLOADED, 'c': UNLOADED}
+    assert registry.stats()['resident_bytes'] == 2 * MODEL_BYTES
+    lease.release()
+
+    registry.acquire('b').release()
+    registry.acquire('c').release()
+    # 最近最少使用的a先被淘汰
+    assert _states(registry)['a'] == OFFLOADED and _states(registry)['b'] == OFFLOADED
+    stats = registry.stats()['models']
+    assert stats['a']['loads'] == 2 and stats['a']['evictions'] == 2
+    assert stats['default']['evictions'] == 0
+
+
+def test_leased_model_is_not_evicted():
+    registry = _registry(Runtime(), max_memory=2 * MODEL_BYTES)
+    lease = registry.acquire('a')
+    assert registry.stats()['models']['a']['inflight'] == 1
+    # a正在使用, 超出预算也不淘汰
+    registry.acquire('b').release()
+    assert _states(registry) == {'default': LOADED, 'a': LOADED, 'b': LOADED}
+
+    lease.release()
+    lease.release()
+    assert registry.stats()['models']['a']['inflight'] == 0
+    assert registry.stats()['resident_bytes'] == 3 * MODEL_BYTES
+
+
+def test_unload_eviction_loads_again():
+    runtime = Runtime()
+    registry = _registry(runtime, max_memory=2 * MODEL_BYTES, eviction='unload')
+    registry.acquire('a').release()
+    registry.acquire('b').release()
+    assert _states(registry)['a'] == UNLOADED and registry.resolve('a').llm is None
+    registry.acquire('a').release()
+    assert [call for call in runtime.calls if call[0] == 'load'] == [('load', 'a'), ('load', 'b'), ('load', 'a')]
+
+
+def test_first_load_budget_uses_checkpoint_size(tmp_path):
+    base = tmp_path / 'base'
+    base.mkdir()
+    (base / 'model-00001.safetensors').write_bytes(b'\0' * 300)
+    (base / 'config.json').write_text('{}')
+    adapter = tmp_path / 'adapter'
+    adapter.mkdir()
+    (adapter / 'adapter_model.bin').write_bytes(b'\0' * 50)
+    (adapter / 'adapter_config.json').write_text(json.dumps({'base_model_name_or_path': str(base)}))
+
+    runtime = Runtime()
+    registry = _registry(runtime, models=('a',), max_memory=2 * MODEL_BYTES)
+    registry.register('tuned', {'name': 'tuned', 'pretrained_model_path': str(adapter)})
+    registry.register('sized', {'name': 'sized', 'memory_bytes': 123})
+    # 加载前按权重文件估算, adapter加上基座模型
+    assert registry.stats()['models']['tuned']['bytes'] == 350
+    assert registry.stats()['models']['sized']['bytes'] == 123
+
+    registry.acquire('a').release()
+    # 估算的350字节放不下, 加载之前就淘汰a
+    runtime.calls.clear()
+    registry.acquire('tuned').release()
+    assert runtime.calls[:2] == [('detach', 'a'), ('load', 'tuned')]
+    assert registry.stats()['models']['tuned']['bytes'] == MODEL_BYTES
+
+
+def test_route_returns_404_for_unknown_chat_model(monkeypatch):
+    from fastapi import HTTPException
+
+    from llmbase.main.common.god import cosmos
+    from llmbase.main.llm.chatglm3.model import ChatCompletionRequest, ChatMessage, EmbeddingRequest
+    from llmbase.main.services.chatglm4_service import ChatGLM4Service
+
+    monkeypatch.setattr(cosmos, 'llm', None, raising=False)
+    monkeypatch.setattr(cosmos, 'model_registry', _registry(Runtime()), raising=False)
+    with pytest.raises(HTTPException) as excinfo:
+        ChatGLM4Service.route(ChatCompletionRequest(model='gpt-4', messages=[ChatMessage(role='user', content='hi')]))
+    assert excinfo.value.status_code == 404 and excinfo.value.detail.startswith('model_not_found')
+
+    # embeddings请求的model是向量模型名, 由默认模型处理
+    llm, holds = ChatGLM4Service.route(EmbeddingRequest(model='bge-large-zh', input=['hi']))
+    assert llm.name == 'default'
+    for hold in holds:
+        hold.release()
@@ -0,0 +1,169 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import nacos
+import pytest
+
+from llmbase.main.utils.nacos_reporter import NacosReporter
+
+SERVICE = {
+    'name': 'glm-4-9b-chat',
+    'ip': '127.0.0.1',
+    'port': 8000,
+    'cluster_name': None,
+    'weight': 1.0,
+    'metadata': {'gpu': 0.0, 'memory': 0.0},
+    'enable': True,
+    'healthy': True,
+    'ephemeral': False,
+    'group_name': 'DEFAULT_GROUP'
+}
+
+
+class StandInRegistry(BaseHTTPRequestHandler):
+    """
+    本地替代的Nacos注册中心, 只实现实例的注册(POST)和修改(PUT)
+    """
+    instances = {}
+
+    def _params(self) -> dict:
+        params = dict(parse_qsl(urlparse(self.path).query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode()))
+        return params
+
+    def _instance(self, method: str):
+        if urlparse(self.path).path != '/nacos/v1/ns/instance':
+            self.send_error(404)
+            return
+        params = self._params()
+        key = (params['serviceName'], params['ip'], params['port'])
+        if method == 'PUT' and key not in self.instances:
+            self.send_error(400, 'instance not found')
+            return
+        instance = self.instances.setdefault(key, {})
+        instance.update(params)
+        if 'metadata' in params:
+            instance['metadata'] = json.loads(params['metadata'])
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def do_POST(self):
+        self._instance('POST')
+
+    def do_PUT(self):
+        self._instance('PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def registry():
+    """
+    Stand-in registry on a free port with the instance of SERVICE registered, yields (client, server).
+    """
+    StandInRegistry.instances = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInRegistry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = nacos.NacosClient(server_addresses=f'127.0.0.1:{server.server_port}', namespace='public')
+    client.add_naming_instance(service_name=SERVICE['name'], ip=SERVICE['ip'], port=SERVICE['port'],
+                               weight=SERVICE['weight'], metadata=SERVICE['metadata'], enable=SERVICE['enable'],
+                               healthy=SERVICE['healthy'], ephemeral=SERVICE['ephemeral'],
+                               group_name=SERVICE['group_name'])
+    yield client, server
+    server.shutdown()
+    server.server_close()
+
+
+def _instance() -> dict:
+    return StandInRegistry.instances[(SERVICE['name'], SERVICE['ip'], str(SERVICE['port']))]
+
+
+class _Load(object):
+    """
+    sample() of the reporter, one pressure per call, 500 more decoded tokens each time.
+    """
+
+    def __init__(self, pressures: list):
+        self.pressures = list(pressures)
+        self.decoded_tokens = 0
+
+    def __call__(self) -> dict:
+        self.decoded_tokens += 500
+        pressure = self.pressures.pop(0) if len(self.pressures) > 1 else self.pressures[0]
+        return {'queue_depth': 3, 'running': 8, 'inflight_requests': 8, 'inflight_tokens': 4096, 'memory': 0.5,
+                'admitted_tokens_per_second': 0.0, 'decoded_tokens': self.decoded_tokens, 'pressure': pressure}
+
+
+def _wait(predicate, timeout: float = 5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end
+        time.sleep(0.02)
+
+
+def test_weight_follows_pressure_with_floor(registry):
+    client, _ = registry
+    reporter = NacosReporter(client, dict(SERVICE, weight=2.0), sample=_Load([0.0, 0.3, 0.7, 0.94]))
+    weights = []
+    for _ in range(4):
+        reporter.report()
+        weights.append(float(_instance()['weight']))
+    # weight = 2.0 * (1 - pressure), 不低于 2.0 * min_weight
+    assert weights == pytest.approx([2.0, 1.4, 0.6, 0.2])
+    assert reporter.stats()['weight'] == pytest.approx(0.2) and reporter.stats()['enabled']
+
+
+def test_enable_hysteresis(registry):
+    client, _ = registry
+    pressures = [0.0, 0.3, 0.7, 0.97, 0.9, 0.75, 0.2]
+    expected = [(1.0, 'true'), (0.7, 'true'), (0.3, 'true'), (0.1, 'false'), (0.1, 'false'), (0.25, 'true'),
+                (0.8, 'true')]
+    reporter = NacosReporter(client, SERVICE, sample=_Load(pressures))
+    reported = []
+    for _ in pressures:
+        reporter.report()
+        reported.append((float(_instance()['weight']), _instance()['enable'].lower()))
+    # 达到0.95下线, 回到0.8以下才重新上线
+    assert reported == [(pytest.approx(weight), enable) for weight, enable in expected]
+    assert reporter.stats()['enabled'] is True
+
+
+def test_metadata_carries_load(registry):
+    client, _ = registry
+    reporter = NacosReporter(client, SERVICE, sample=_Load([0.5]))
+    reporter.report()
+    time.sleep(0.05)
+    reporter.report()
+    metadata = _instance()['metadata']
+    assert metadata['queue_depth'] == 3 and metadata['inflight_tokens'] == 4096 and metadata['pressure'] == 0.5
+    # 注册时的metadata保留, 解码速度按两次上报之间的间隔计算
+    assert metadata['gpu'] == 0.0 and metadata['tokens_per_second'] > 0
+    assert 'decoded_tokens' not in metadata
+
+
+def test_background_reports_count_failures(registry):
+    client, server = registry
+    reporter = NacosReporter(client, SERVICE, sample=_Load([0.5]), interval=0.05)
+    reporter.start()
+    try:
+        _wait(lambda: reporter.stats()['reports'] >= 2)
+        assert reporter.stats()['errors'] == 0
+        # 注册中心不可用时记录错误并继续
+        server.shutdown()
+        server.server_close()
+        _wait(lambda: reporter.stats()['errors'] >= 2)
+    finally:
+        reporter.stop()
+    assert not reporter._thread.is_alive()
+
+
+def test_rejects_inverted_thresholds():
+    with pytest.raises(ValueError):
+        NacosReporter(None, SERVICE, sample=_Load([0.0]), disable_pressure=0.5, enable_pressure=0.8)
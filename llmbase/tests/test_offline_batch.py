@@ -0,0 +1,63 @@
+import json
+
+from conftest import echo_llm
+from llmbase.main.services.offline_batch_service import OfflineBatchRunner
+
+
+def _write_input(path, rows: int):
+    with open(path, 'w', encoding='utf-8') as f:
+        for index in range(rows):
+            f.write(json.dumps({'custom_id': f'row-{index}', 'method': 'POST', 'url': '/v1/chat/completions',
+                                'body': {'model': 'tiny', 'max_tokens': 4,
+                                         'messages': [{'role': 'user', 'content': f'question {index}'}]}}) + '\n')
+
+
+def _runner(llm, tmp_path) -> OfflineBatchRunner:
+    return OfflineBatchRunner(llm, input_path=str(tmp_path / 'input.jsonl'), output_path=str(tmp_path / 'out.jsonl'),
+                              max_batch_rows=3)
+
+
+def _custom_ids(tmp_path) -> list:
+    with open(tmp_path / 'out.jsonl', encoding='utf-8') as f:
+        return [json.loads(line)['custom_id'] for line in f]
+
+
+def test_resume_skips_finished_batches(tmp_path):
+    _write_input(tmp_path / 'input.jsonl', 8)
+    llm = echo_llm()
+
+    # 第一次运行在两批之后停止
+    batches = iter(range(3))
+    stats = _runner(llm, tmp_path).run(should_stop=lambda: next(batches) >= 2)
+    assert stats['rows'] == 6 and not stats['finished']
+    assert llm.model.prompts == 6
+    # 模拟写了一半就崩溃的批次, 续跑时应被截掉
+    with open(tmp_path / 'out.jsonl', 'ab') as f:
+        f.write(b'{"custom_id": "row-6", "trunc')
+
+    stats = _runner(llm, tmp_path).run()
+    assert stats['finished'] and stats['resumed_rows'] == 6 and stats['rows'] == 2
+    # 已完成的批次没有重新生成
+    assert llm.model.prompts == 8
+    assert _custom_ids(tmp_path) == [f'row-{index}' for index in range(8)]
+
+    # 全部完成后再运行不重复输出
+    stats = _runner(llm, tmp_path).run()
+    assert stats['finished'] and stats['rows'] == 0
+    assert _custom_ids(tmp_path) == [f'row-{index}' for index in range(8)]
+    assert llm.model.prompts == 8
+
+
+def test_invalid_rows_are_reported(tmp_path):
+    with open(tmp_path / 'input.jsonl', 'w', encoding='utf-8') as f:
+        f.write('not json\n')
+        f.write(json.dumps({'custom_id': 'bad', 'body': {'model': 'tiny'}}) + '\n')
+        f.write(json.dumps({'custom_id': 'ok', 'body': {'model': 'tiny', 'max_tokens': 4,
+                                                        'messages': [{'role': 'user', 'content': 'hi'}]}}) + '\n')
+    llm = echo_llm()
+    stats = _runner(llm, tmp_path).run()
+    assert stats['rows'] == 3 and stats['failed'] == 2
+    with open(tmp_path / 'out.jsonl', encoding='utf-8') as f:
+        outputs = [json.loads(line) for line in f]
+    assert [output['error'] is not None for output in outputs] == [True, True, False]
+    assert outputs[2]['response']['body']['choices'][0]['finish_reason'] == 'stop'
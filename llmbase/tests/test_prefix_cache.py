@@ -0,0 +1,81 @@
+import torch
+
+from llmbase.main.engine.prefix_cache import PrefixCache
+from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+
+
+def _past(input_ids):
+    # [batch, heads, seq, dim], 每个位置的值等于它的token id, 便于检查截取的范围
+    k = torch.tensor(input_ids, dtype=torch.float32).view(1, 1, -1, 1).expand(1, 1, -1, 4).contiguous()
+    return ((k, k + 0.5),)
+
+
+def test_lookup_hits_block_boundaries():
+    cache = PrefixCache(seq_dim=2, block_size=4)
+    prompt = list(range(3, 14))
+    cache.insert(prompt, _past(prompt))
+    # 11个token只缓存前两个完整的块
+    assert cache.stats()['entries'] == 1
+
+    # 只共享第一个块的prompt命中4个token
+    prefix_len, past = cache.lookup(prompt[:4] + [40, 41, 42, 43, 44])
+    assert prefix_len == 4
+    assert past[0][0].shape == (1, 1, 4, 4) and past[0][0][0, 0, :, 0].tolist() == prompt[:4]
+    assert torch.equal(past[0][1], past[0][0] + 0.5)
+    assert cache.lookup(prompt[:8] + [40])[0] == 8
+    # 首个块不同时不命中
+    assert cache.lookup([40] + prompt[1:]) == (0, None)
+
+
+def test_lookup_leaves_one_token_uncached():
+    cache = PrefixCache(seq_dim=2, block_size=4)
+    prompt = list(range(3, 11))
+    cache.insert(prompt, _past(prompt))
+    # prompt正好是两个块时只命中第一个块, 最后一个token需要prefill得到logits
+    assert cache.lookup(prompt)[0] == 4
+    assert cache.lookup(prompt + [20])[0] == 8
+    assert cache.lookup(prompt[:4])[0] == 0
+    stats = cache.stats()
+    assert stats['lookups'] == 3 and stats['hits'] == 2 and stats['hit_rate'] == 2 / 3
+
+
+def test_lru_eviction_by_bytes():
+    # 每个条目4个token: 2个张量 * 4个位置 * 4维 * 4字节
+    entry_bytes = 2 * 4 * 4 * 4
+    cache = PrefixCache(seq_dim=2, block_size=4, max_bytes=2 * entry_bytes)
+    first, second, third = [3, 4, 5, 6, 7], [8, 9, 10, 11, 12], [13, 14, 15, 16, 17]
+    cache.insert(first, _past(first))
+    cache.insert(second, _past(second))
+    assert cache.stats()['bytes'] == 2 * entry_bytes
+
+    # 访问first之后second是最久未使用的
+    assert cache.lookup(first)[0] == 4
+    cache.insert(third, _past(third))
+    assert cache.lookup(second) == (0, None)
+    assert cache.lookup(first)[0] == 4 and cache.lookup(third)[0] == 4
+    assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] == 2 * entry_bytes
+
+    # 超过上限的条目不缓存
+    small = PrefixCache(seq_dim=2, block_size=4, max_bytes=entry_bytes - 1)
+    small.insert(first, _past(first))
+    assert small.stats()['entries'] == 0
+
+
+def test_engine_output_unchanged_by_prefix_hits(tiny_model, tiny_tokenizer):
+    model = tiny_model('seq_first')
+    engine = ContinuousBatchingEngine(model, tiny_tokenizer, prefix_cache={'block_size': 4})
+    engine.start()
+    try:
+        shared = [5, 9, 12, 17, 22, 30, 31, 33]
+        outputs = []
+        for suffix in ([4, 6], [7], [8, 10, 11, 13, 14]):
+            seq = engine.submit(shared + suffix, max_new_tokens=6, temperature=0.0)
+            outputs.append([token_id for token_ids in seq.stream() for token_id in token_ids])
+        stats = engine.stats()['prefix_cache']
+    finally:
+        engine.stop()
+
+    for suffix, output in zip(([4, 6], [7], [8, 10, 11, 13, 14]), outputs):
+        *_, total_ids = model.stream_generate(torch.tensor([shared + suffix]), max_new_tokens=6)
+        assert output == total_ids[0, len(shared + suffix):].tolist()
+    assert stats['hits'] == 2
@@ -0,0 +1,81 @@
+import pytest
+
+from llmbase.main.llm.replicas import ReplicaPool
+
+
+def _pool(balance: str = 'tokens', size: int = 3) -> ReplicaPool:
+    return ReplicaPool([f'llm{index}' for index in range(size)], [f'cuda:{index}' for index in range(size)],
+                       balance=balance)
+
+
+def _inflight(pool: ReplicaPool, key: str) -> list:
+    return [replica[key] for replica in pool.stats()['replicas']]
+
+
+def test_least_loaded_by_tokens():
+    pool = _pool()
+    leases = [pool.acquire(cost) for cost in (100, 10, 30)]
+    assert [lease.llm for lease in leases] == ['llm0', 'llm1', 'llm2']
+    # llm1的在途token最少
+    assert pool.acquire(5).llm == 'llm1'
+    assert _inflight(pool, 'inflight_tokens') == [100, 15, 30]
+
+    leases[0].release()
+    leases[0].release()
+    assert pool.acquire(50).llm == 'llm0'
+    assert _inflight(pool, 'inflight_requests') == [1, 2, 1]
+    assert pool.stats()['replicas'][0]['served'] == 1
+
+
+def test_least_loaded_by_requests():
+    pool = _pool('requests')
+    assert [pool.acquire(cost).llm for cost in (1000, 1, 1)] == ['llm0', 'llm1', 'llm2']
+    # 请求数相同时在途token少的优先
+    assert [pool.acquire(1).llm for _ in range(2)] == ['llm1', 'llm2']
+    # 按队列深度, token最多的llm0也会被选中
+    assert pool.acquire(1).llm == 'llm0'
+    assert _inflight(pool, 'inflight_requests') == [2, 2, 2]
+
+
+def test_split_balances_projected_load():
+    pool = _pool(size=2)
+    busy = pool.acquire(50)
+    assignments = pool.split([40, 10, 30, 20])
+    # 从大到小分配到预计负载最小的副本: 40->llm1, 30->llm1 (70 vs 50), 20->llm0, 10->llm0
+    assert [(lease.llm, indices, lease.cost) for lease, indices in assignments] == \
+           [('llm0', [1, 3], 30), ('llm1', [0, 2], 70)]
+    busy.release()
+    for lease, _ in assignments:
+        lease.release()
+    assert _inflight(pool, 'inflight_tokens') == [0, 0]
+    # 没有分配到条目的副本不占用租约
+    assert [(lease.llm, indices) for lease, indices in pool.split([5])] == [('llm0', [0])]
+    assert _inflight(pool, 'inflight_requests') == [1, 0]
+
+
+def test_unknown_balance_policy():
+    with pytest.raises(ValueError):
+        _pool('random')
+
+
+def test_shutdown_stops_every_replica(monkeypatch):
+    from types import SimpleNamespace
+
+    from llmbase.main import shutdown_runtime
+    from llmbase.main.common.god import cosmos
+
+    class _Stoppable(object):
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    llms = [SimpleNamespace(engine=_Stoppable(), micro_batcher=_Stoppable(), replicas=None) for _ in range(3)]
+    llms[0].replicas = ReplicaPool(llms, ['cpu'] * 3)
+    engines, batchers = [llm.engine for llm in llms], [llm.micro_batcher for llm in llms]
+    for name in ('startup', 'nacos_reporter', 'model_registry', 'batch_worker', 'embedding_executor'):
+        monkeypatch.setattr(cosmos, name, None, raising=False)
+    monkeypatch.setattr(cosmos, 'llm', llms[0], raising=False)
+    shutdown_runtime()
+    assert all(engine.stopped for engine in engines) and all(batcher.stopped for batcher in batchers)
+    assert all(llm.engine is None and llm.micro_batcher is None for llm in llms)
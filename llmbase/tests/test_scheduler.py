@@ -0,0 +1,178 @@
+import pytest
+import torch
+
+from llmbase.main.engine.scheduler import ContinuousBatchingEngine
+
+PROMPTS = [[3, 5, 7, 9, 11], [4, 6], [13, 2, 8, 21, 30, 31, 40, 1], [17, 19, 23]]
+
+
+def _reference(model, input_ids, max_new_tokens):
+    *_, total_ids = model.stream_generate(torch.tensor([input_ids]), max_new_tokens=max_new_tokens)
+    return total_ids[0, len(input_ids):].tolist()
+
+
+def _engine(model, tokenizer, kv_layout):
+    """
+    Engine driven step by step from the test instead of its thread.
+    """
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=8, max_prefill_per_step=1,
+                                      kv_layout=kv_layout)
+    engine._batch_dim, engine._seq_dim = engine._resolve_kv_layout()
+    return engine
+
+
+def _submit(engine, input_ids, max_new_tokens):
+    return engine.submit(input_ids, max_new_tokens=max_new_tokens, temperature=0.0)
+
+
+@pytest.mark.parametrize('layout,kv_layout', [('batch_first', 'auto'), ('seq_first', 'auto'),
+                                              ('batch_first', 'batch_first'), ('seq_first', 'seq_first')])
+def test_resolve_kv_layout(tiny_model, tiny_tokenizer, layout, kv_layout):
+    engine = _engine(tiny_model(layout), tiny_tokenizer, kv_layout)
+    assert (engine._batch_dim, engine._seq_dim) == ((0, 2) if layout == 'batch_first' else (1, 0))
+
+
+@pytest.mark.parametrize('layout', ['batch_first', 'seq_first'])
+def test_staggered_arrivals_match_stream_generate(tiny_model, tiny_tokenizer, layout):
+    model = tiny_model(layout)
+    engine = _engine(model, tiny_tokenizer, 'auto')
+    max_new_tokens = [12, 9, 6, 10]
+    sequences = []
+    # 每个解码步之间到达一个新序列, 长度各不相同, 合并时两侧都需要左侧padding
+    for input_ids, limit in zip(PROMPTS, max_new_tokens):
+        sequences.append(_submit(engine, input_ids, limit))
+        engine._admit(block=False)
+        engine._decode_step()
+    while engine._running:
+        engine._decode_step()
+
+    for seq, input_ids, limit in zip(sequences, PROMPTS, max_new_tokens):
+        assert seq.output_ids == _reference(model, input_ids, limit)
+        assert seq.finish_reason == 'length'
+    assert engine.is_idle() and engine._past is None
+
+
+@pytest.mark.parametrize('layout', ['batch_first', 'seq_first'])
+def test_retire_keeps_kv_of_other_rows(tiny_model, tiny_tokenizer, layout):
+    model = tiny_model(layout)
+    engine = _engine(model, tiny_tokenizer, 'auto')
+    # 最长的prompt最先结束, 退出后其余序列共同的左侧padding被裁掉
+    short = _submit(engine, PROMPTS[1], 8)
+    longest = _submit(engine, PROMPTS[2], 2)
+    middle = _submit(engine, PROMPTS[3], 8)
+    for _ in range(3):
+        engine._admit(block=False)
+    engine._decode_step()
+    assert longest.finish_reason == 'length'
+    assert engine._running == [short, middle]
+
+    for row, seq in enumerate(engine._running):
+        ids = seq.input_ids + seq.output_ids[:-1]
+        expected = model(torch.tensor([ids])).past_key_values[0][0]
+        cached = engine._past[0][0].narrow(engine._batch_dim, row, 1)
+        # 每行左侧是padding, 右侧cache_len个位置与单独计算的KV相同
+        cached = cached.narrow(engine._seq_dim, engine._cache_len - seq.cache_len, seq.cache_len)
+        assert seq.cache_len == len(ids)
+        assert torch.allclose(cached, expected)
+    assert engine._cache_len == max(seq.cache_len for seq in engine._running)
+
+    while engine._running:
+        engine._decode_step()
+    assert short.output_ids == _reference(model, PROMPTS[1], 8)
+    assert middle.output_ids == _reference(model, PROMPTS[3], 8)
+
+
+def test_engine_thread_streams_concurrent_requests(tiny_model, tiny_tokenizer):
+    model = tiny_model()
+    engine = ContinuousBatchingEngine(model, tiny_tokenizer, max_batch_size=2)
+    engine.start()
+    try:
+        sequences = [_submit(engine, input_ids, 7) for input_ids in PROMPTS]
+        outputs = [[token_id for token_ids in seq.stream() for token_id in token_ids] for seq in sequences]
+    finally:
+        engine.stop()
+    assert outputs == [_reference(model, input_ids, 7) for input_ids in PROMPTS]
+    assert engine.stats()['finished'] == len(PROMPTS)
+
+
+def test_eos_and_cancel(tiny_model, tiny_tokenizer):
+    model = tiny_model()
+    engine = _engine(model, tiny_tokenizer, 'auto')
+    expected = _reference(model, PROMPTS[0], 6)
+    # 第一个此前未生成过的token作为eos
+    stop_at = next(index for index in range(1, len(expected)) if expected[index] not in expected[:index])
+    stopped = engine.submit(PROMPTS[0], max_new_tokens=6, temperature=0.0, eos_token_id=[expected[stop_at]])
+    cancelled = _submit(engine, PROMPTS[3], 6)
+    engine._admit(block=False)
+    engine._admit(block=False)
+    cancelled.cancel()
+    engine._drop_stopped()
+    while engine._running:
+        engine._decode_step()
+    assert stopped.output_ids == expected[:stop_at] and stopped.finish_reason == 'stop'
+    assert cancelled.finish_reason == 'abort' and engine.stats()['cancelled'] == 1
+
+
+class _FailingPrefillLM(torch.nn.Module):
+    """
+    prompt超过max_prompt_len时prefill报错, 与超长prompt或OOM相同.
+    """
+
+    def __init__(self, model, max_prompt_len):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+        self.max_prompt_len = max_prompt_len
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def forward(self, input_ids, **kwargs):
+        if input_ids.shape[1] > self.max_prompt_len:
+            raise RuntimeError('prompt too long')
+        return self.model(input_ids, **kwargs)
+
+
+def test_prefill_error_only_fails_its_sequence(tiny_model, tiny_tokenizer):
+    model = tiny_model()
+    engine = ContinuousBatchingEngine(_FailingPrefillLM(model, max_prompt_len=10), tiny_tokenizer, max_batch_size=4,
+                                      kv_layout='batch_first')
+    engine.start()
+    try:
+        running = _submit(engine, PROMPTS[0], 20)
+        # 等running开始解码后再提交超长的prompt
+        next(running.stream())
+        bad = _submit(engine, list(range(3, 40)), 5)
+        with pytest.raises(RuntimeError, match='prompt too long'):
+            list(bad.stream())
+        list(running.stream())
+    finally:
+        engine.stop()
+    assert bad.finish_reason == 'error'
+    assert running.finish_reason == 'length'
+    assert running.output_ids == _reference(model, PROMPTS[0], 20)
+
+
+def test_stop_finishes_queued_and_running_sequences(tiny_model, tiny_tokenizer):
+    engine = _engine(tiny_model(), tiny_tokenizer, 'auto')
+    running = _submit(engine, PROMPTS[0], 20)
+    engine._admit(block=False)
+    waiting = _submit(engine, PROMPTS[1], 20)
+    engine.stop()
+    for seq in (running, waiting):
+        assert seq.finish_reason == 'abort'
+        list(seq.stream())
+    assert engine.is_idle() and engine._past is None
+
+
+def test_fail_all_reaches_waiting_sequences(tiny_model, tiny_tokenizer):
+    engine = _engine(tiny_model(), tiny_tokenizer, 'auto')
+    running = _submit(engine, PROMPTS[0], 20)
+    engine._admit(block=False)
+    waiting = _submit(engine, PROMPTS[1], 20)
+    engine._fail_all(RuntimeError('decode failed'))
+    for seq in (running, waiting):
+        with pytest.raises(RuntimeError, match='decode failed'):
+            list(seq.stream())
+    assert engine.is_idle()
@@ -0,0 +1,67 @@
+import torch
+
+from conftest import TinyCausalLM
+from llmbase.main.llm.shared_weights import SharedWeights, load_shared_model
+
+
+class TiedLM(torch.nn.Module):
+    """
+    Submodules, a tied output projection, buffers of several dtypes and an empty tensor.
+    """
+
+    def __init__(self, seed: int = 0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.embed = torch.nn.Embedding(32, 8)
+        self.norm = torch.nn.BatchNorm1d(8)
+        self.blocks = torch.nn.ModuleList([torch.nn.Linear(8, 8).half() for _ in range(2)])
+        self.head = torch.nn.Linear(8, 32, bias=False)
+        self.head.weight = self.embed.weight
+        self.register_buffer('empty', torch.zeros(0, 4))
+        self.norm.eval()
+
+    def forward(self, input_ids):
+        hidden = self.norm(self.embed(input_ids).transpose(1, 2)).transpose(1, 2)
+        for block in self.blocks:
+            hidden = hidden + block(hidden.half()).float()
+        return self.head(hidden)
+
+
+def test_mapped_model_matches_private_load(tmp_path):
+    loads = []
+
+    def load():
+        loads.append(1)
+        return TinyCausalLM(seed=3)
+
+    shared = load_shared_model(str(tmp_path), load, lambda: TinyCausalLM(seed=99))
+    # 第二个工作进程直接映射已有的文件
+    second = load_shared_model(str(tmp_path), load, lambda: TinyCausalLM(seed=99))
+    private = TinyCausalLM(seed=3)
+
+    assert loads == [1]
+    input_ids = torch.tensor([[5, 9, 14, 20, 33]])
+    with torch.inference_mode():
+        assert torch.equal(shared(input_ids).logits, private(input_ids).logits)
+        assert torch.equal(second(input_ids).logits, private(input_ids).logits)
+    *_, expected = private.stream_generate(input_ids, max_new_tokens=6)
+    *_, actual = shared.stream_generate(input_ids, max_new_tokens=6)
+    assert torch.equal(actual, expected)
+
+
+def test_tied_weights_buffers_and_copy_on_write(tmp_path):
+    shared = load_shared_model(str(tmp_path), lambda: TiedLM(seed=1), lambda: TiedLM(seed=2))
+    private = TiedLM(seed=1)
+    input_ids = torch.tensor([[1, 2, 3, 31]])
+    with torch.inference_mode():
+        assert torch.equal(shared(input_ids), private(input_ids))
+    for (name, tensor), (_, expected) in zip(shared.state_dict().items(), private.state_dict().items()):
+        assert tensor.dtype == expected.dtype and torch.equal(tensor, expected), name
+    # 绑定的张量只写一次, 映射后仍是同一个张量
+    assert shared.head.weight.data_ptr() == shared.embed.weight.data_ptr()
+
+    # MAP_PRIVATE: 一个进程修改权重不影响文件和其他进程
+    with torch.no_grad():
+        shared.blocks[0].weight.add_(1)
+    other = SharedWeights(str(tmp_path)).attach(TiedLM(seed=2))
+    assert torch.equal(other.blocks[0].weight, private.blocks[0].weight)
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llmbase.main.common.god import cosmos
+from llmbase.main.engine.startup import StartupCancelled, StartupProgress
+from llmbase.main.routers import openai
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(cosmos, 'startup', StartupProgress(), raising=False)
+    app = FastAPI()
+    app.include_router(openai.router)
+    return TestClient(app)
+
+
+def _wait(predicate, timeout: float = 5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_ready_is_503_until_loaded(client):
+    release = threading.Event()
+
+    def load(startup):
+        startup.declare('model', 'runtime')
+        startup.declare('nacos', required=False)
+        with startup.phase('model'):
+            release.wait(5)
+        with startup.phase('runtime'):
+            pass
+        try:
+            with startup.phase('nacos', required=False):
+                raise ConnectionError('nacos unreachable')
+        except ConnectionError:
+            pass
+
+    cosmos.startup.start(load)
+    _wait(lambda: cosmos.startup.stats()['components'].get('model', {}).get('state') == 'loading')
+    response = client.get('/v1/ready')
+    assert response.status_code == 503
+    assert {name: component['state'] for name, component in response.json()['components'].items()} == \
+           {'model': 'loading', 'runtime': 'pending', 'nacos': 'pending'}
+    # 加载期间请求返回503并带Retry-After
+    response = client.get('/v1/models')
+    assert response.status_code == 503 and response.headers['Retry-After'] == '5'
+    assert response.json()['detail'] == 'model is loading'
+
+    release.set()
+    _wait(lambda: cosmos.startup.finished is not None)
+    response = client.get('/v1/ready')
+    # 非必需的组件失败不影响就绪
+    assert response.status_code == 200 and response.json()['ready'] is True
+    assert response.json()['components']['nacos']['state'] == 'failed'
+
+
+def test_ready_is_503_after_failure(client):
+    def load(startup):
+        startup.declare('model', 'runtime')
+        with startup.phase('model'):
+            raise OSError("Can't load the configuration of '/var/llm/missing'")
+
+    cosmos.startup.start(load)
+    _wait(lambda: cosmos.startup.finished is not None)
+    response = client.get('/v1/ready')
+    assert response.status_code == 503
+    body = response.json()
+    assert body['ready'] is False and 'missing' in body['error']
+    assert body['components']['model']['state'] == 'failed' and body['components']['runtime']['state'] == 'pending'
+    assert client.get('/v1/models').json()['detail'] == 'model failed to load'
+
+
+def test_cancel_stops_between_phases(client):
+    startup = cosmos.startup
+    startup.declare('model', 'runtime')
+    with startup.phase('model'):
+        startup.cancel()
+    with pytest.raises(StartupCancelled):
+        with startup.phase('runtime'):
+            pass
+    startup.finished = time.time()
+    assert client.get('/v1/ready').status_code == 503
+    assert startup.stats()['components']['runtime']['state'] == 'pending'
+
+
+def test_parallel_loaders_report_each_component():
+    startup = StartupProgress()
+    results = startup.run_parallel({'tokenizer': lambda: 'tok', 'model': lambda: 'model'})
+    assert results == {'tokenizer': 'tok', 'model': 'model'}
+    with pytest.raises(ValueError):
+        startup.run_parallel({'embedding': _raise, 'other': lambda: None})
+    assert startup.stats()['components']['embedding']['state'] == 'failed'
+    assert startup.stats()['components']['other']['state'] == 'ready'
+
+
+def _raise():
+    raise ValueError('bad embedding path')
@@ -0,0 +1,50 @@
+import pytest
+
+from llmbase.main.llm.chatglm3.model import (ChatCompletionResponse, ChatCompletionResponseStreamChoice,
+                                             DeltaMessage)
+from llmbase.main.llm.chatglm3.stream_encoder import ChatCompletionChunkEncoder
+
+MODEL_ID = 'chatglm3-6b'
+# 引号, 反斜杠, 控制字符, 非ASCII, 以及pydantic不转义的字符
+DELTAS = ['你好', ',', ' world', '"quoted"', 'back\\slash', 'line\nbreak\r\n', 'tab\t', '\x01\x1f\b\f', '\x7f',
+          'a/b', '  ', 'emoji 😀', 'é', '']
+FINISH_REASONS = [None, 'stop', 'length', 'function_call']
+CREATED = [None, 1718000000]
+
+
+def _chunk(delta: DeltaMessage, finish_reason=None, created=None, model_id=MODEL_ID, chunk_id="") -> str:
+    kwargs = {} if created is None else {'created': created}
+    chunk = ChatCompletionResponse(model=model_id, id=chunk_id, object="chat.completion.chunk", choices=[
+        ChatCompletionResponseStreamChoice(index=0, delta=delta, finish_reason=finish_reason)], **kwargs)
+    return chunk.model_dump_json(exclude_unset=True)
+
+
+@pytest.mark.parametrize('created', CREATED)
+@pytest.mark.parametrize('finish_reason', FINISH_REASONS)
+@pytest.mark.parametrize('text', DELTAS)
+def test_content_matches_pydantic(text, finish_reason, created):
+    encoder = ChatCompletionChunkEncoder(MODEL_ID)
+    assert encoder.content(text, finish_reason, created=created) == \
+           _chunk(DeltaMessage(content=text, role="assistant", function_call=None), finish_reason, created)
+    assert encoder.content(text, finish_reason, created=created, with_function_call=False) == \
+           _chunk(DeltaMessage(content=text, role="assistant"), finish_reason, created)
+
+
+@pytest.mark.parametrize('created', CREATED)
+@pytest.mark.parametrize('finish_reason', FINISH_REASONS)
+def test_role_and_stop_match_pydantic(finish_reason, created):
+    encoder = ChatCompletionChunkEncoder(MODEL_ID)
+    assert encoder.role(finish_reason, created=created) == \
+           _chunk(DeltaMessage(role="assistant"), finish_reason, created)
+    if finish_reason is not None:
+        assert encoder.stop(finish_reason, created=created) == _chunk(DeltaMessage(), finish_reason, created)
+
+
+@pytest.mark.parametrize('model_id,chunk_id', [('glm-4 "9b"\\chat', 'chatcmpl-1'), ('模型\n', '')])
+def test_envelope_escapes_model_and_id(model_id, chunk_id):
+    encoder = ChatCompletionChunkEncoder(model_id, chunk_id)
+    # 同一个finish_reason的后缀缓存后, 带与不带created仍然正确
+    for created in CREATED + CREATED:
+        assert encoder.content('x"y', 'stop', created=created) == \
+               _chunk(DeltaMessage(content='x"y', role="assistant", function_call=None), 'stop', created,
+                      model_id, chunk_id)
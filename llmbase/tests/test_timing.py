@@ -0,0 +1,91 @@
+import contextvars
+import re
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llmbase.main import init_middleware
+from llmbase.main.common.god import cosmos
+from llmbase.main.common.tool import timing
+
+# name;dur=毫秒(两位小数), 逗号分隔, 最后一项为total
+_SERVER_TIMING = re.compile(r'^[a-z_]+;dur=\d+\.\d{2}(, [a-z_]+;dur=\d+\.\d{2})*$')
+
+
+def _durations(header: str) -> dict:
+    assert _SERVER_TIMING.match(header), header
+    return {name: float(duration) for name, duration in re.findall(r'([a-z_]+);dur=([\d.]+)', header)}
+
+
+def test_server_timing_format():
+    timer = timing.PhaseTimer('/v1/chat/completions')
+    timer.add('tokenize', 0.0012345)
+    timer.add('decode', 0.25)
+    timer.add('decode', 0.5)
+    timer.add('queue', -1.0)
+    header = timer.server_timing()
+    assert header.startswith('tokenize;dur=1.23, decode;dur=750.00, queue;dur=0.00, total;dur=')
+    assert list(_durations(header)) == ['tokenize', 'decode', 'queue', 'total']
+
+    record = timer.record()
+    assert record['path'] == '/v1/chat/completions'
+    assert record['phases_ms'] == {'tokenize': 1.234, 'decode': 750.0, 'queue': 0.0}
+
+
+def test_sampling():
+    def sampled():
+        assert timing.start(0.0) is None
+        assert timing.start(1.0, '/v1/embeddings') is timing.current()
+        with timing.phase('serialize'):
+            pass
+        return timing.current()
+
+    # 在单独的context中运行, 计时器不留给其他测试
+    timer = contextvars.copy_context().run(sampled)
+    assert 'serialize' in timer.phases and timing.current() is None
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    """
+    App with an interactive and a non-interactive route behind init_middleware.
+    """
+    monkeypatch.setattr(cosmos, 'activity_monitor', None, raising=False)
+
+    def _make(timing_config: dict) -> TestClient:
+        monkeypatch.setattr(cosmos, 'config', SimpleNamespace(TIMING_CONFIG=timing_config), raising=False)
+        app = FastAPI()
+
+        @app.post('/v1/embeddings')
+        def embeddings():
+            # 同步路由在线程池中执行, 计时器经contextvar传入
+            with timing.phase('tokenize'):
+                time.sleep(0.01)
+            return {}
+
+        @app.get('/v1/stats')
+        def stats():
+            return {}
+
+        init_middleware(app)
+        return TestClient(app)
+
+    return _make
+
+
+def test_middleware_adds_server_timing(make_client):
+    client = make_client({'enable': True, 'sample_rate': 1.0})
+    response = client.post('/v1/embeddings')
+    durations = _durations(response.headers['Server-Timing'])
+    assert list(durations) == ['tokenize', 'total']
+    assert 10 <= durations['tokenize'] <= durations['total']
+    # 只对交互请求计时
+    assert 'Server-Timing' not in client.get('/v1/stats').headers
+
+
+@pytest.mark.parametrize('timing_config', [{'enable': False, 'sample_rate': 1.0}, {'enable': True, 'sample_rate': 0.0}])
+def test_unsampled_requests_have_no_header(make_client, timing_config):
+    assert 'Server-Timing' not in make_client(timing_config).post('/v1/embeddings').headers
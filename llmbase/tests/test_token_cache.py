@@ -0,0 +1,129 @@
+import json
+import re
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from llmbase.main.engine.token_cache import ChatTemplateCache
+from llmbase.main.llm.chatglm3.utils import build_batch_input_ids
+
+COMMANDS = {'[gMASK]': 64790, 'sop': 64792, '<|system|>': 64794, '<|user|>': 64795, '<|assistant|>': 64796,
+            '<|observation|>': 64797}
+
+
+class _SentencePiece(object):
+    sp_model = None
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text: str):
+        self.calls += 1
+        return [100 + ord(char) for char in text]
+
+
+class ChatGLM3StandIn(object):
+    """
+    The template helpers of ChatGLM3's tokenization_chatglm.py over a character level sentencepiece stand-in.
+    """
+
+    def __init__(self):
+        self.tokenizer = _SentencePiece()
+        self.encode_special_tokens = False
+
+    def get_command(self, token):
+        return COMMANDS[token]
+
+    def get_prefix_tokens(self):
+        return [self.get_command('[gMASK]'), self.get_command('sop')]
+
+    def build_single_message(self, role, metadata, message):
+        role_tokens = [self.get_command(f'<|{role}|>')] + self.tokenizer.encode(f'{metadata}\n')
+        return role_tokens + self.tokenizer.encode(message)
+
+    def build_chat_input(self, query, history=None, role='user'):
+        input_ids = []
+        for item in history or []:
+            content = item['content']
+            if item['role'] == 'system' and 'tools' in item:
+                content = content + '\n' + json.dumps(item['tools'], indent=4, ensure_ascii=False)
+            input_ids.extend(self.build_single_message(item['role'], item.get('metadata', ''), content))
+        input_ids.extend(self.build_single_message(role, '', query))
+        input_ids.extend([self.get_command('<|assistant|>')])
+        return self.batch_encode_plus([input_ids], return_tensors='pt', is_split_into_words=True)
+
+    def batch_encode_plus(self, batch, return_tensors=None, is_split_into_words=False):
+        input_ids = torch.tensor([self.get_prefix_tokens() + list(ids) for ids in batch])
+        return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}
+
+    def __call__(self, texts):
+        assert self.encode_special_tokens
+        batch = []
+        for text in texts:
+            input_ids = self.get_prefix_tokens()
+            for piece in re.split(r'(<\|(?:system|user|assistant|observation)\|>)', text):
+                if piece in COMMANDS:
+                    input_ids.append(COMMANDS[piece])
+                elif piece:
+                    input_ids.extend(self.tokenizer.encode(piece))
+            batch.append(input_ids)
+        return {'input_ids': batch}
+
+
+TOOLS = [{'name': 'get_weather', 'description': '查询天气', 'parameters': {'city': {'type': 'string'}}}]
+
+HISTORIES = [
+    [],
+    [{'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好, 有什么可以帮你?'}],
+    [{'role': 'system', 'content': 'You are a helpful assistant.'},
+     {'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}],
+    [{'role': 'system', 'content': 'Answer with tools.', 'tools': TOOLS},
+     {'role': 'user', 'content': '北京天气怎么样'},
+     {'role': 'assistant', 'metadata': 'get_weather', 'content': "tool_call(city='北京')"},
+     {'role': 'observation', 'content': '{"weather": "晴"}'}],
+]
+
+
+@pytest.mark.parametrize('history', HISTORIES)
+def test_build_chat_input_matches_tokenizer(history):
+    tokenizer = ChatGLM3StandIn()
+    cache = ChatTemplateCache(tokenizer)
+    expected = tokenizer.build_chat_input('明天呢?', history=history)
+    for _ in range(2):
+        actual = cache.build_chat_input('明天呢?', history=history)
+        assert torch.equal(actual['input_ids'], expected['input_ids'])
+
+
+def test_batch_template_matches_tokenizer():
+    tokenizer = ChatGLM3StandIn()
+    cache = ChatTemplateCache(tokenizer)
+    conversations = [
+        [{'role': 'user', 'content': 'hello'}],
+        [{'role': 'system', 'content': '你是一个助手'}, {'role': 'user', 'content': '你好'},
+         {'role': 'assistant', 'content': '你好!'}, {'role': 'user', 'content': '再见'}],
+        [{'role': 'user', 'content': 'weather?'}, {'role': 'function', 'content': '{"weather": "sunny"}'}],
+    ]
+    assert build_batch_input_ids(tokenizer, conversations, cache) == build_batch_input_ids(tokenizer, conversations)
+
+
+def test_multi_turn_only_tokenizes_new_segments():
+    tokenizer = ChatGLM3StandIn()
+    cache = ChatTemplateCache(tokenizer)
+    history = HISTORIES[2]
+    cache.build_chat_input('first question', history=history)
+    calls = tokenizer.tokenizer.calls
+    cache.build_chat_input('second question', history=history + [{'role': 'user', 'content': 'first question'},
+                                                                 {'role': 'assistant', 'content': 'answer'}])
+    # 只有'second question'和'answer'需要分词
+    assert tokenizer.tokenizer.calls - calls == 2
+    assert cache.stats()['hits'] > 0
+
+
+def test_supports_only_chatglm3():
+    assert ChatTemplateCache.supports(ChatGLM3StandIn())
+    # ChatGLM4的tokenizer同样有这些方法, 但底层是tiktoken
+    chatglm4 = ChatGLM3StandIn()
+    chatglm4.tokenizer = SimpleNamespace(encode=lambda text: [])
+    assert not ChatTemplateCache.supports(chatglm4)
+    assert not ChatTemplateCache.supports(SimpleNamespace(encode=lambda text: []))